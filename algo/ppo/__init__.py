@@ -1,3 +1,4 @@
 from .ppo import PPO
-from .storage import RolloutStorage
+from .storage import RolloutStorage, MemmapRolloutStorage, TemporalRolloutStorage
 from .module import Actor, Critic
+from .split_step import SplitStepRollout
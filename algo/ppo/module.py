@@ -2,6 +2,7 @@ import torch.nn as nn
 import numpy as np
 import torch
 from torch.distributions import Normal
+from raisimGymTorch.algo.TCN.TCN import TemporalConvNet
 import pdb
 
 class Actor:
@@ -114,6 +115,59 @@ class MLP(nn.Module):
          enumerate(mod for mod in sequential if isinstance(mod, nn.Linear))]
 
 
+class TCN(nn.Module):
+    def __init__(self, num_channels, kernel_size, shape, actionvation_fn, input_size, output_size, window=None, tcn_activation='leakyrelu'):
+        """
+        TemporalConvNet encoder followed by an MLP head, evaluated on observation windows (n_batch, window, input_size).
+        The encoder output at the last time step is fed to the head.
+
+        Windows come from TemporalRolloutStorage (training) or ObservationWindow (rollout / evaluation) with the
+        steps before the start of the episode set to zero.
+
+        :param num_channels: channels of the temporal blocks (dilation doubles every block)
+        :param window: history length, defaults to the receptive field of the encoder
+        """
+        super(TCN, self).__init__()
+        self.receptive_field = 1 + 2 * (kernel_size - 1) * (2 ** len(num_channels) - 1)
+        self.window = self.receptive_field if window is None else window
+        self.architecture = TCNEncoderHead(TemporalConvNet(input_size, num_channels, kernel_size, dropout=0., activation=tcn_activation),
+                                           MLP(shape, actionvation_fn, num_channels[-1], output_size).architecture)
+        self.input_shape = [input_size]
+        self.output_shape = [output_size]
+
+
+class TCNEncoderHead(nn.Module):
+    def __init__(self, encoder, head):
+        super(TCNEncoderHead, self).__init__()
+        self.encoder = encoder
+        self.head = head
+
+    def forward(self, obs_window):
+        # (n_batch, window, feature) -> (n_batch, feature, window), a view of the window
+        return self.head(self.encoder(obs_window.transpose(1, 2), only_last=True))
+
+
+class ObservationWindow:
+    def __init__(self, num_envs, window, obs_dim, device='cpu'):
+        """
+        Rolling observation history for evaluating a TCN policy outside of PPO (e.g. the evaluation loop of runner.py).
+        Steps before the start of the current episode are zero, as in TemporalRolloutStorage.
+        """
+        self.window = torch.zeros(num_envs, window, obs_dim, device=device)
+        self.device = device
+
+    def reset(self, dones=None):
+        if dones is None:
+            self.window.zero_()
+        else:
+            self.window[torch.from_numpy(dones.astype(bool)).to(self.device)] = 0.
+
+    def update(self, obs):
+        self.window = torch.roll(self.window, -1, dims=1)
+        self.window[:, -1] = torch.from_numpy(obs).to(self.device)
+        return self.window
+
+
 class MultivariateGaussianDiagonalCovariance(nn.Module):
     def __init__(self, dim, init_std):
         super(MultivariateGaussianDiagonalCovariance, self).__init__()
@@ -149,7 +203,7 @@ class MultivariateGaussianDiagonalCovariance(nn.Module):
     def enforce_minimum_std(self, min_std):
         current_std = self.std.detach()
         new_std = torch.maximum(current_std, min_std.detach()).detach()
-        self.std.data = new_std
+        self.std.data.copy_(new_std)
 
 class MultivariateGaussianDiagonalCovariance_two_side_clip(MultivariateGaussianDiagonalCovariance):
     def __init__(self, dim, init_std, clipping_range, device):
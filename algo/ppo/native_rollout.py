@@ -0,0 +1,95 @@
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class RolloutPolicyModule(nn.Module):
+    def __init__(self, actor, critic):
+        """
+        Action mean, action std and value in one module, scripted for the native rollout collector.
+        Shares the parameters of actor and critic, so parameters() always holds the current weights.
+        """
+        super(RolloutPolicyModule, self).__init__()
+        self.std = actor.distribution.std
+        self.actor = actor.architecture.architecture
+        self.critic = critic.architecture.architecture
+
+    def forward(self, obs):
+        return self.actor(obs), self.std, self.critic(obs)
+
+
+class NativeRollout:
+    def __init__(self, env, ppo, actor, critic, script_path, seed=0):
+        """
+        Rollout collected by the environment itself (VectorizedEnvironment::collectRollout, in a module built with
+        -DRSG_WITH_TORCH against libtorch). Actor and critic are scripted once to script_path and loaded by the
+        environment, which then runs all n_steps without returning to python: commands of the schedule, observation
+        and its normalization, Gaussian action sampling, value prediction, step and reward terms. Before every rollout
+        only the flat parameter vector is copied over, the transitions come back in buffers handed over once and go to
+        ppo.storage in one copy.
+
+        The policy runs on the CPU of the environment's process (torch intra-op threads) while the OpenMP envs wait,
+        keep num_threads + torch threads at the number of cores as for split stepping.
+
+        :param env: RaisimGymVecEnv with native_obs_normalization
+        :param ppo: PPO with an MLP actor (ppo_module.Actor) and shared_obs storage
+        """
+        assert hasattr(env.wrapper, 'collectRollout'), "The environment module is built without libtorch (-DRSG_WITH_TORCH)"
+        assert env.native_normalization, "Native rollout collection needs native_obs_normalization: True"
+        assert ppo.window is None, "Native rollout collection is not available for temporal policies"
+        assert ppo.storage.shared_obs, "Native rollout collection needs shared_obs"
+        assert not hasattr(actor, 'final_activation_fn'), "Native rollout collection samples around the raw action mean"
+        self.env = env
+        self.ppo = ppo
+        self.n_steps = ppo.num_transitions_per_env
+        self.num_envs = env.num_envs
+
+        self.module = RolloutPolicyModule(actor, critic)
+        torch.jit.save(torch.jit.script(copy.deepcopy(self.module).cpu()), script_path)
+        env.wrapper.loadRolloutPolicy(script_path, seed)
+        assert env.wrapper.getRolloutPolicyParameterCount() == sum(p.numel() for p in self.module.parameters()), \
+            "Scripted rollout policy does not match the actor and critic"
+
+        n_rows = self.n_steps * self.num_envs
+        self.obs = np.zeros([n_rows, env.num_obs], dtype=np.float32)
+        self.raw_obs = np.zeros([n_rows, env.num_obs], dtype=np.float32)
+        self.actions = np.zeros([n_rows, env.num_acts], dtype=np.float32)
+        self.actions_log_prob = np.zeros(n_rows, dtype=np.float32)
+        self.values = np.zeros(n_rows, dtype=np.float32)
+        self.rewards = np.zeros(n_rows, dtype=np.float32)
+        self.dones = np.zeros(n_rows, dtype=bool)
+        self.reward_terms = np.zeros([n_rows, len(env.reward_term_names)], dtype=np.float32)
+        self.last_obs = np.zeros([self.num_envs, env.num_obs], dtype=np.float32)
+        self._last_raw_obs = np.zeros([self.num_envs, env.num_obs], dtype=np.float32)
+
+    def sync(self):
+        """
+        Copies the current actor / critic weights (and action std) to the environment's policy.
+        """
+        with torch.no_grad():
+            flat = torch.nn.utils.parameters_to_vector(self.module.parameters()).cpu().numpy().astype(np.float32)
+        self.env.wrapper.setRolloutPolicyParameters(flat)
+
+    def run(self, commands, command_period_steps):
+        """
+        :param commands: (n_periods, num_envs, 3) user commands, period k starts at step k * command_period_steps
+        :return: observation of all envs after the last step (for the bootstrap value of ppo.update)
+        """
+        self.sync()
+        commands = np.ascontiguousarray(commands, dtype=np.float32).reshape(-1, 3)
+        self.env.wrapper.collectRollout(self.n_steps, command_period_steps, commands, self.obs, self.raw_obs, self.actions,
+                                        self.actions_log_prob, self.values, self.rewards, self.dones, self.reward_terms,
+                                        self.last_obs, self._last_raw_obs)
+        shape = (self.n_steps, self.num_envs)
+        self.ppo.storage.add_rollout(self.obs.reshape(*shape, -1), self.actions.reshape(*shape, -1), self.rewards.reshape(shape),
+                                     self.dones.reshape(shape), self.values.reshape(shape), self.actions_log_prob.reshape(shape))
+        return self.last_obs.copy()
+
+    def reward_breakdown(self, names):
+        """
+        :param names: reward term names in the order wanted (e.g. the reward section of cfg.yaml and 'reward_sum')
+        :return: (num_envs, n_steps, len(names)) weighted reward terms of the last rollout
+        """
+        columns = [self.env.reward_term_names.index(name) for name in names]
+        return np.swapaxes(self.reward_terms.reshape(self.n_steps, self.num_envs, -1)[:, :, columns], 0, 1)
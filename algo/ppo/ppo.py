@@ -3,9 +3,8 @@ import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.tensorboard import SummaryWriter
-from .storage import RolloutStorage
-import wandb
+from .storage import RolloutStorage, MemmapRolloutStorage, TemporalRolloutStorage
+from .update import EagerUpdate, FusedUpdate, make_optimizer
 
 
 class PPO:
@@ -26,19 +25,48 @@ class PPO:
                  use_clipped_value_loss=True,
                  log_dir='run',
                  device='cpu',
-                 shuffle_batch=True):
+                 shuffle_batch=True,
+                 shared_obs=False,
+                 obs_dtype=torch.float32,
+                 strict_obs_dtype=False,
+                 storage_backend='memory',
+                 storage_dir=None,
+                 compile_update=False,
+                 desired_kl=None,
+                 kl_stop_factor=1.5,
+                 adaptive_lr=False,
+                 min_learning_rate=1e-5,
+                 max_learning_rate=1e-2):
 
         # PPO components
         self.actor = actor
         self.critic = critic
-        self.storage = RolloutStorage(num_envs, num_transitions_per_env, actor.obs_shape, critic.obs_shape, actor.action_shape, device)
+        assert storage_backend in ['memory', 'memmap'], "Unavailable storage backend."
+        # temporal (TCN) actor: observation history windows instead of single observations
+        self.window = getattr(actor.architecture, 'window', None)
+        self.temporal_critic = getattr(critic.architecture, 'window', None) is not None
+        if self.window is not None:
+            assert storage_backend == 'memory', "Temporal policies are only available with the memory storage backend"
+            assert not self.temporal_critic or critic.architecture.window == self.window, "Actor and critic windows should match"
+            self.storage = TemporalRolloutStorage(num_envs, num_transitions_per_env, actor.obs_shape, actor.action_shape, device,
+                                                  window=self.window, obs_dtype=obs_dtype, strict_obs_dtype=strict_obs_dtype)
+        elif storage_backend == 'memmap':
+            # rollouts larger than RAM: buffers are memory-mapped files under storage_dir
+            self.storage = MemmapRolloutStorage(num_envs, num_transitions_per_env, actor.obs_shape, critic.obs_shape, actor.action_shape, device,
+                                                shared_obs=shared_obs, obs_dtype=obs_dtype, strict_obs_dtype=strict_obs_dtype,
+                                                storage_dir=storage_dir)
+        else:
+            self.storage = RolloutStorage(num_envs, num_transitions_per_env, actor.obs_shape, critic.obs_shape, actor.action_shape, device,
+                                          shared_obs=shared_obs, obs_dtype=obs_dtype, strict_obs_dtype=strict_obs_dtype)
 
         if shuffle_batch:
             self.batch_sampler = self.storage.mini_batch_generator_shuffle
         else:
             self.batch_sampler = self.storage.mini_batch_generator_inorder
 
-        self.optimizer = optim.Adam([*self.actor.parameters(), *self.critic.parameters()], lr=learning_rate)
+        # compile_update: torch.compile'd forward / loss / backward of actor and critic, flat parameter and gradient buffers,
+        # fused (or foreach) Adam. See update.py, `autotune.py --compare_update` benchmarks it against the eager update
+        self.optimizer = make_optimizer([*self.actor.parameters(), *self.critic.parameters()], learning_rate, fused=compile_update)
         self.device = device
 
         # env parameters
@@ -56,6 +84,23 @@ class PPO:
         self.max_grad_norm = max_grad_norm
         self.use_clipped_value_loss = use_clipped_value_loss
 
+        # KL guard (desired_kl=None disables it): the remaining minibatch steps of an update are skipped once the approximate KL
+        # of a minibatch exceeds kl_stop_factor * desired_kl. adaptive_lr scales the learning rate by 1.5 when the KL leaves
+        # [desired_kl / 2, 2 * desired_kl]
+        self.desired_kl = desired_kl
+        self.kl_stop_factor = kl_stop_factor
+        self.adaptive_lr = adaptive_lr
+        self.learning_rate = learning_rate
+        self.min_learning_rate = min_learning_rate
+        self.max_learning_rate = max_learning_rate
+        assert not adaptive_lr or desired_kl is not None, "Adaptive learning rate needs desired_kl"
+        self.total_skipped_minibatches = 0
+
+        update_class = FusedUpdate if compile_update else EagerUpdate
+        self.minibatch_update = update_class(self.actor, self.critic, self.optimizer, max_grad_norm,
+                                             clip_param=clip_param, value_loss_coef=value_loss_coef, entropy_coef=entropy_coef,
+                                             use_clipped_value_loss=use_clipped_value_loss)
+
         # Log
         self.log_dir = os.path.join(log_dir, datetime.now().strftime('%b%d_%H-%M-%S'))
         # self.writer = SummaryWriter(log_dir=self.log_dir, flush_secs=10)
@@ -66,20 +111,52 @@ class PPO:
         self.actions = None
         self.actions_log_prob = None
         self.actor_obs = None
+        self.obs_window = None
+        # per env group (split stepping): first env -> actor obs, value obs, actions, log prob, values
+        self.group_temps = {}
 
     def observe(self, actor_obs):
         self.actor_obs = actor_obs
-        self.actions, self.actions_log_prob = self.actor.sample(torch.from_numpy(actor_obs).to(self.device))
+        if self.window is not None:
+            self.obs_window = self.storage.observe_window(actor_obs)
+            self.actions, self.actions_log_prob = self.actor.sample(self.obs_window)
+        else:
+            self.actions, self.actions_log_prob = self.actor.sample(torch.from_numpy(actor_obs).to(self.device))
         # self.actions = np.clip(self.actions.numpy(), self.env.action_space.low, self.env.action_space.high)
         return self.actions.cpu().numpy()
 
     def step(self, value_obs, rews, dones):
-        values = self.critic.predict(torch.from_numpy(value_obs).to(self.device))
+        if self.window is not None:
+            values = self.critic.predict(self._critic_input(self.obs_window))
+        else:
+            values = self.critic.predict(torch.from_numpy(value_obs).to(self.device))
         self.storage.add_transitions(self.actor_obs, value_obs, self.actions, rews, dones, values,
                                      self.actions_log_prob)
 
+    def observe_group(self, actor_obs, envs, value_obs=None):
+        """
+        observe() for the envs of one group (split stepping, see algo/ppo/split_step.py). The values are predicted here
+        as well, so that step_group() only stores the transitions once the group finished its step.
+
+        :param envs: slice of the envs of the group
+        :param value_obs: critic observation of the group (default: actor_obs)
+        """
+        assert self.window is None, "Split stepping is not available for temporal policies"
+        value_obs = actor_obs if value_obs is None else value_obs
+        actions, actions_log_prob = self.actor.sample(torch.from_numpy(actor_obs).to(self.device))
+        values = self.critic.predict(torch.from_numpy(value_obs).to(self.device))
+        self.group_temps[envs.start] = (actor_obs, value_obs, actions, actions_log_prob, values)
+        return actions.cpu().numpy()
+
+    def step_group(self, rews, dones, envs):
+        actor_obs, value_obs, actions, actions_log_prob, values = self.group_temps.pop(envs.start)
+        self.storage.add_transitions(actor_obs, value_obs, actions, rews, dones, values, actions_log_prob, envs=envs)
+
     def update(self, actor_obs, value_obs, log_this_iteration, update):
-        last_values = self.critic.predict(torch.from_numpy(value_obs).to(self.device))
+        if self.window is not None:
+            last_values = self.critic.predict(self._critic_input(self.storage.observe_window(value_obs)))
+        else:
+            last_values = self.critic.predict(torch.from_numpy(value_obs).to(self.device))
 
         # Learning step
         self.storage.compute_returns(last_values.to(self.device), self.gamma, self.lam)
@@ -90,6 +167,8 @@ class PPO:
             self.log({**locals(), **infos, 'it': update})
 
     def log(self, variables, width=80, pad=28):
+        # imported on first use, the logging stack is slow to import and not needed to construct the learner
+        import wandb
         self.tot_timesteps += self.num_transitions_per_env * self.num_envs
         mean_std = self.actor.distribution.std.mean()
 
@@ -97,11 +176,21 @@ class PPO:
         # self.writer.add_scalar('Loss/surrogate', variables['mean_surrogate_loss'], variables['it'])
         # self.writer.add_scalar('Policy/mean_noise_std', mean_std.item(), variables['it'])
 
-        wandb.log({'Loss/value_function': variables['mean_value_loss'],
+        log_dict = {'Loss/value_function': variables['mean_value_loss'],
                     'Loss/surrogate': variables['mean_surrogate_loss'],
-                    'Policy/mean_noise_std': mean_std.item()})
+                    'Policy/mean_noise_std': mean_std.item()}
+        if self.storage.obs_dtype != torch.float32:
+            log_dict['Storage/obs_quantization_error'] = self.storage.obs_quantization_error
+        if self.desired_kl is not None:
+            log_dict['Policy/approx_kl'] = variables['mean_approx_kl']
+            log_dict['Policy/learning_rate'] = self.learning_rate
+            log_dict['KL_guard/cut_epochs'] = variables['cut_epochs']
+            log_dict['KL_guard/skipped_minibatches'] = variables['skipped_minibatches']
+            log_dict['KL_guard/total_skipped_minibatches'] = self.total_skipped_minibatches
+        wandb.log(log_dict)
     
     def reward_std_logging(self, reward_names, reward_std_values, step=None):
+        import wandb
         reward_log_dict = dict()
         for name, std in zip(reward_names, reward_std_values):
             logging_name = f"Reward/std/{name}"
@@ -109,52 +198,81 @@ class PPO:
         wandb.log(reward_log_dict)
 
     def reward_logging(self, reward_names, reward_values, step=None):
+        import wandb
         reward_log_dict = dict()
         for name, value in zip(reward_names, reward_values):
             logging_name = f"Reward/value/{name}"
             reward_log_dict[logging_name] = value
         wandb.log(reward_log_dict)
 
+    def state_dict(self):
+        """
+        Learner state besides the network weights: optimizer, (adapted) learning rate and the logging counters.
+        """
+        return {'optimizer': self.optimizer.state_dict(),
+                'learning_rate': self.learning_rate,
+                'total_skipped_minibatches': self.total_skipped_minibatches,
+                'tot_timesteps': self.tot_timesteps,
+                'tot_time': self.tot_time}
+
+    def load_state_dict(self, state):
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.learning_rate = state['learning_rate']
+        for param_group in self.optimizer.param_groups:
+            param_group['lr'] = self.learning_rate
+        self.total_skipped_minibatches = state['total_skipped_minibatches']
+        self.tot_timesteps = state['tot_timesteps']
+        self.tot_time = state['tot_time']
+
+    def _critic_input(self, obs):
+        # an MLP critic next to a TCN actor only sees the current step of the window
+        if self.window is not None and not self.temporal_critic:
+            return obs[:, -1]
+        return obs
+
     def _train_step(self):
         mean_value_loss = 0
         mean_surrogate_loss = 0
+        mean_approx_kl = 0
+        num_updates = 0
+        max_kl = None if self.desired_kl is None else self.kl_stop_factor * self.desired_kl
+        kl_exceeded = False
         for epoch in range(self.num_learning_epochs):
             for actor_obs_batch, critic_obs_batch, actions_batch, target_values_batch, advantages_batch, returns_batch, old_actions_log_prob_batch \
                     in self.batch_sampler(self.num_mini_batches):
 
-                actions_log_prob_batch, entropy_batch = self.actor.evaluate(actor_obs_batch, actions_batch)
-                value_batch = self.critic.evaluate(critic_obs_batch)
-
-                # Surrogate loss
-                ratio = torch.exp(actions_log_prob_batch - torch.squeeze(old_actions_log_prob_batch))
-                surrogate = -torch.squeeze(advantages_batch) * ratio
-                surrogate_clipped = -torch.squeeze(advantages_batch) * torch.clamp(ratio, 1.0 - self.clip_param,
-                                                                                   1.0 + self.clip_param)
-                surrogate_loss = torch.max(surrogate, surrogate_clipped).mean()
-
-                # Value function loss
-                if self.use_clipped_value_loss:
-                    value_clipped = target_values_batch + (value_batch - target_values_batch).clamp(-self.clip_param,
-                                                                                                    self.clip_param)
-                    value_losses = (value_batch - returns_batch).pow(2)
-                    value_losses_clipped = (value_clipped - returns_batch).pow(2)
-                    value_loss = torch.max(value_losses, value_losses_clipped).mean()
-                else:
-                    value_loss = (returns_batch - value_batch).pow(2).mean()
-
-                loss = surrogate_loss + self.value_loss_coef * value_loss - self.entropy_coef * entropy_batch.mean()
-
-                # Gradient step
-                self.optimizer.zero_grad()
-                loss.backward()
-                nn.utils.clip_grad_norm_([*self.actor.parameters(), *self.critic.parameters()], self.max_grad_norm)
-                self.optimizer.step()
+                surrogate_loss, value_loss, approx_kl, stepped = self.minibatch_update.step(
+                    actor_obs_batch, self._critic_input(critic_obs_batch), actions_batch, target_values_batch, advantages_batch,
+                    returns_batch, old_actions_log_prob_batch, max_kl=max_kl)
+                if not stepped:
+                    kl_exceeded = True
+                    break
 
                 mean_value_loss += value_loss.item()
                 mean_surrogate_loss += surrogate_loss.item()
+                mean_approx_kl += approx_kl.item()
+                num_updates += 1
+
+                if self.adaptive_lr:
+                    self._adapt_learning_rate(approx_kl.item())
+            if kl_exceeded:
+                break
 
-        num_updates = self.num_learning_epochs * self.num_mini_batches
+        skipped_minibatches = self.num_learning_epochs * self.num_mini_batches - num_updates
+        cut_epochs = skipped_minibatches // self.num_mini_batches
+        self.total_skipped_minibatches += skipped_minibatches
+
+        num_updates = max(num_updates, 1)
         mean_value_loss /= num_updates
         mean_surrogate_loss /= num_updates
+        mean_approx_kl /= num_updates
 
         return mean_value_loss, mean_surrogate_loss, locals()
+
+    def _adapt_learning_rate(self, approx_kl):
+        if approx_kl > 2. * self.desired_kl:
+            self.learning_rate = max(self.min_learning_rate, self.learning_rate / 1.5)
+        elif 0. < approx_kl < self.desired_kl / 2.:
+            self.learning_rate = min(self.max_learning_rate, self.learning_rate * 1.5)
+        for param_group in self.optimizer.param_groups:
+            param_group['lr'] = self.learning_rate
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class SplitStepRollout:
+    def __init__(self, env, ppo, n_groups=2):
+        """
+        Rollout with the envs split into groups that are stepped one after the other on a worker thread (GIL released),
+        while the policy computes the actions (and values) of the next group on the calling thread. With two groups the
+        inference of one half of the envs is hidden behind the simulation of the other half.
+
+        Per step: group k starts stepping, the actions of group k + 1 are computed (those of group 0 for the next step
+        during the last group), then the transitions of group k are stored (RolloutStorage.add_transitions(envs=...)).
+        After the last group no env is stepping, the callbacks of run() are called there.
+
+        The OpenMP threads of the envs (num_threads) and torch's threads run at the same time, keep their sum at the number
+        of cores (torch.set_num_threads).
+
+        :param env: RaisimGymVecEnv
+        :param ppo: PPO with a non-temporal actor
+        """
+        self.env = env
+        self.ppo = ppo
+        self.groups = env.env_groups(n_groups)
+        self.reward = np.zeros(env.num_envs, dtype=np.float32)
+        self.dones = np.zeros(env.num_envs, dtype=bool)
+
+    def run(self, n_steps, before_step=None, after_step=None, raw_obs=None):
+        """
+        :param before_step: before_step(step), called before every step while no group is stepping (e.g. to set commands).
+                            A command set here enters the observation at the next step of the env (as in the plain
+                            rollout), so the pending actions stay valid.
+        :param after_step: after_step(step, reward, dones) once all groups finished the step, (num_envs,) arrays
+        :param raw_obs: optional (n_steps, num_envs, ob_dim) array receiving the observation of every step before normalization
+        :return: observation of all envs after the last step (for the bootstrap value of ppo.update)
+        """
+        groups = self.groups
+        if before_step is not None:
+            before_step(0)
+        obs, raw = self.env.observe()
+        if raw_obs is not None:
+            raw_obs[0] = raw
+        obs = [obs[envs] for envs in groups]
+        actions = [None] * len(groups)
+        actions[0] = self.ppo.observe_group(obs[0], groups[0])
+
+        for step in range(n_steps):
+            for k, envs in enumerate(groups):
+                self.env.step_group_async(actions[k], envs)
+                if k + 1 < len(groups):
+                    actions[k + 1] = self.ppo.observe_group(obs[k + 1], groups[k + 1])
+                elif step + 1 < n_steps:
+                    actions[0] = self.ppo.observe_group(obs[0], groups[0])
+                obs[k], self.reward[envs], self.dones[envs] = self.env.wait_group()
+                if raw_obs is not None and step + 1 < n_steps:
+                    raw_obs[step + 1, envs] = self.env.group_raw_observation(envs)
+                self.ppo.step_group(self.reward[envs], self.dones[envs], envs)
+
+            if after_step is not None:
+                after_step(step, self.reward, self.dones)
+            if before_step is not None and step + 1 < n_steps:
+                before_step(step + 1)
+
+        return np.concatenate(obs)
@@ -1,44 +1,131 @@
+import os
+import shutil
+import tempfile
+import warnings
+import weakref
+import numpy as np
 import torch
 from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
+from raisimGymTorch.helper.prefetch import prefetch
+
+
+# largest round-trip error accepted for normalized observations (clipped to +-10) stored in reduced precision
+OBS_DTYPE_TOLERANCE = {torch.float16: 1e-2, torch.bfloat16: 5e-2}
 
 
 class RolloutStorage:
-    def __init__(self, num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape, actions_shape, device):
+    def __init__(self, num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape, actions_shape, device,
+                 shared_obs=False, obs_dtype=torch.float32, strict_obs_dtype=False):
+        """
+
+        :param shared_obs: store a single observation tensor used by both actor and critic
+                           (the caller must pass the same observation as actor_obs and critic_obs, checked on every transition)
+        :param obs_dtype: storage precision of the observations (torch.float32, torch.float16 or torch.bfloat16),
+                          minibatches are always upcast to float32
+        :param strict_obs_dtype: raise instead of warning when the round-trip error of a reduced-precision observation
+                                 exceeds OBS_DTYPE_TOLERANCE
+        """
         self.device = device
+        self.shared_obs = shared_obs
+        self.obs_dtype = obs_dtype
+        self.strict_obs_dtype = strict_obs_dtype
+        assert obs_dtype in [torch.float32, torch.float16, torch.bfloat16], "Unavailable observation dtype."
+        if shared_obs:
+            assert list(actor_obs_shape) == list(critic_obs_shape), "Shared observation needs identical actor and critic observation shapes"
+
+        # accuracy checks (evaluated on every added transition), largest round-trip error seen so far
+        self.obs_quantization_error = 0.
 
         # Core
-        self.critic_obs = torch.zeros(num_transitions_per_env, num_envs, *critic_obs_shape).to(self.device)
-        self.actor_obs = torch.zeros(num_transitions_per_env, num_envs, *actor_obs_shape).to(self.device)
-        self.rewards = torch.zeros(num_transitions_per_env, num_envs, 1).to(self.device)
-        self.actions = torch.zeros(num_transitions_per_env, num_envs, *actions_shape).to(self.device)
-        self.dones = torch.zeros(num_transitions_per_env, num_envs, 1).byte().to(self.device)
+        self.actor_obs = self._allocate('actor_obs', (num_transitions_per_env, num_envs, *actor_obs_shape), obs_dtype)
+        if shared_obs:
+            self.critic_obs = self.actor_obs
+        else:
+            self.critic_obs = self._allocate('critic_obs', (num_transitions_per_env, num_envs, *critic_obs_shape), obs_dtype)
+        self.rewards = self._allocate('rewards', (num_transitions_per_env, num_envs, 1))
+        self.actions = self._allocate('actions', (num_transitions_per_env, num_envs, *actions_shape))
+        self.dones = self._allocate('dones', (num_transitions_per_env, num_envs, 1), torch.uint8)
 
         # For PPO
-        self.actions_log_prob = torch.zeros(num_transitions_per_env, num_envs, 1).to(self.device)
-        self.values = torch.zeros(num_transitions_per_env, num_envs, 1).to(self.device)
-        self.returns = torch.zeros(num_transitions_per_env, num_envs, 1).to(self.device)
-        self.advantages = torch.zeros(num_transitions_per_env, num_envs, 1).to(self.device)
+        self.actions_log_prob = self._allocate('actions_log_prob', (num_transitions_per_env, num_envs, 1))
+        self.values = self._allocate('values', (num_transitions_per_env, num_envs, 1))
+        self.returns = self._allocate('returns', (num_transitions_per_env, num_envs, 1))
+        self.advantages = self._allocate('advantages', (num_transitions_per_env, num_envs, 1))
 
         self.num_transitions_per_env = num_transitions_per_env
         self.num_envs = num_envs
         self.device = device
 
         self.step = 0
+        # envs written at the current step by add_transitions(envs=...) (split stepping)
+        self._filled_envs = 0
 
-    def add_transitions(self, actor_obs, critic_obs, actions, rewards, dones, values, actions_log_prob):
+    def add_transitions(self, actor_obs, critic_obs, actions, rewards, dones, values, actions_log_prob, envs=None):
+        """
+        :param envs: slice of the envs the transitions belong to (split stepping, every env once per step, groups in any order),
+                     None: all envs. The step advances once all envs of the step are written.
+        """
         if self.step >= self.num_transitions_per_env:
             raise AssertionError("Rollout buffer overflow")
-        self.critic_obs[self.step].copy_(torch.from_numpy(critic_obs).to(self.device))
-        self.actor_obs[self.step].copy_(torch.from_numpy(actor_obs).to(self.device))
-        self.actions[self.step].copy_(actions.to(self.device))
-        self.rewards[self.step].copy_(torch.from_numpy(rewards).view(-1, 1).to(self.device))
-        self.dones[self.step].copy_(torch.from_numpy(dones).view(-1, 1).to(self.device))
-        self.values[self.step].copy_(values.to(self.device))
-        self.actions_log_prob[self.step].copy_(actions_log_prob.view(-1, 1).to(self.device))
-        self.step += 1
+        if envs is None:
+            envs = slice(0, self.num_envs)
+            assert self._filled_envs == 0, "Transitions of all envs added while a split step is incomplete"
+        self._check_obs_accuracy(actor_obs, critic_obs)
+        self.actor_obs[self.step, envs].copy_(torch.from_numpy(actor_obs).to(self.device))
+        if not self.shared_obs:
+            self.critic_obs[self.step, envs].copy_(torch.from_numpy(critic_obs).to(self.device))
+        self.actions[self.step, envs].copy_(actions.to(self.device))
+        self.rewards[self.step, envs].copy_(torch.from_numpy(rewards).view(-1, 1).to(self.device))
+        self.dones[self.step, envs].copy_(torch.from_numpy(dones).view(-1, 1).to(self.device))
+        self.values[self.step, envs].copy_(values.to(self.device))
+        self.actions_log_prob[self.step, envs].copy_(actions_log_prob.view(-1, 1).to(self.device))
+
+        self._filled_envs += envs.stop - envs.start
+        if self._filled_envs == self.num_envs:
+            self._filled_envs = 0
+            self.step += 1
+
+    def add_rollout(self, actor_obs, actions, rewards, dones, values, actions_log_prob):
+        """
+        All transitions of a rollout at once (native rollout collection, see algo/ppo/native_rollout.py).
+        (num_transitions_per_env, num_envs, ...) arrays, the observation is used by actor and critic (shared_obs).
+        """
+        assert self.shared_obs, "A whole rollout needs the shared observation storage"
+        assert self.step == 0 and self._filled_envs == 0, "Rollout added to a storage that is not empty"
+        assert actor_obs.shape[0] == self.num_transitions_per_env, "Rollout length does not match the storage"
+        self._check_obs_accuracy(actor_obs, actor_obs)
+        self.actor_obs.copy_(torch.from_numpy(actor_obs).to(self.device))
+        self.actions.copy_(torch.from_numpy(actions).to(self.device))
+        self.rewards.copy_(torch.from_numpy(rewards).view(*self.rewards.shape).to(self.device))
+        self.dones.copy_(torch.from_numpy(dones).view(*self.dones.shape).to(self.device))
+        self.values.copy_(torch.from_numpy(values).view(*self.values.shape).to(self.device))
+        self.actions_log_prob.copy_(torch.from_numpy(actions_log_prob).view(*self.actions_log_prob.shape).to(self.device))
+        self.step = self.num_transitions_per_env
 
     def clear(self):
         self.step = 0
+        self._filled_envs = 0
+
+    def _allocate(self, name, shape, dtype=torch.float32):
+        return torch.zeros(*shape, dtype=dtype).to(self.device)
+
+    def _check_obs_accuracy(self, actor_obs, critic_obs):
+        if self.shared_obs and critic_obs is not actor_obs and not np.array_equal(critic_obs, actor_obs):
+            raise ValueError("Shared observation storage got different actor and critic observations")
+
+        if self.obs_dtype != torch.float32:
+            obs = torch.from_numpy(actor_obs)
+            error = (obs.to(self.obs_dtype).float() - obs).abs().max().item()
+            self.obs_quantization_error = max(self.obs_quantization_error, error)
+            if error > OBS_DTYPE_TOLERANCE[self.obs_dtype]:
+                message = "{} observation storage error {:.4f} exceeds {:.4f}, check the observation normalization" \
+                    .format(self.obs_dtype, error, OBS_DTYPE_TOLERANCE[self.obs_dtype])
+                if self.strict_obs_dtype:
+                    raise ValueError(message)
+                warnings.warn(message)
+
+    def _obs_batch(self, obs, indices):
+        return obs.view(-1, *obs.size()[2:])[indices].float()
 
     def reward_normalize(self):
         self.rewards -= torch.mean(self.rewards)
@@ -61,17 +148,17 @@ class RolloutStorage:
             advantage = delta + next_is_not_terminal * gamma * lam * advantage
             self.returns[step] = advantage + self.values[step]
 
-        # Compute and normalize the advantages
-        self.advantages = self.returns - self.values
-        self.advantages = (self.advantages - self.advantages.mean()) / (self.advantages.std() + 1e-8)
+        # Compute and normalize the advantages (in place, the buffer may be file backed)
+        torch.sub(self.returns, self.values, out=self.advantages)
+        self.advantages.sub_(self.advantages.mean()).div_(self.advantages.std() + 1e-8)
 
     def mini_batch_generator_shuffle(self, num_mini_batches):
         batch_size = self.num_envs * self.num_transitions_per_env
         mini_batch_size = batch_size // num_mini_batches
 
         for indices in BatchSampler(SubsetRandomSampler(range(batch_size)), mini_batch_size, drop_last=True):
-            actor_obs_batch = self.actor_obs.view(-1, *self.actor_obs.size()[2:])[indices]
-            critic_obs_batch = self.critic_obs.view(-1, *self.critic_obs.size()[2:])[indices]
+            actor_obs_batch = self._obs_batch(self.actor_obs, indices)
+            critic_obs_batch = actor_obs_batch if self.shared_obs else self._obs_batch(self.critic_obs, indices)
             actions_batch = self.actions.view(-1, self.actions.size(-1))[indices]
             values_batch = self.values.view(-1, 1)[indices]
             returns_batch = self.returns.view(-1, 1)[indices]
@@ -84,10 +171,162 @@ class RolloutStorage:
         mini_batch_size = batch_size // num_mini_batches
 
         for batch_id in range(num_mini_batches):
-            yield self.actor_obs.view(-1, *self.actor_obs.size()[2:])[batch_id*mini_batch_size:(batch_id+1)*mini_batch_size], \
-                self.critic_obs.view(-1, *self.critic_obs.size()[2:])[batch_id*mini_batch_size:(batch_id+1)*mini_batch_size], \
+            batch = slice(batch_id*mini_batch_size, (batch_id+1)*mini_batch_size)
+            actor_obs_batch = self._obs_batch(self.actor_obs, batch)
+            critic_obs_batch = actor_obs_batch if self.shared_obs else self._obs_batch(self.critic_obs, batch)
+            yield actor_obs_batch, \
+                critic_obs_batch, \
                 self.actions.view(-1, self.actions.size(-1))[batch_id*mini_batch_size:(batch_id+1)*mini_batch_size], \
                 self.values.view(-1, 1)[batch_id*mini_batch_size:(batch_id+1)*mini_batch_size], \
                 self.advantages.view(-1, 1)[batch_id*mini_batch_size:(batch_id+1)*mini_batch_size], \
                 self.returns.view(-1, 1)[batch_id*mini_batch_size:(batch_id+1)*mini_batch_size], \
                 self.actions_log_prob.view(-1, 1)[batch_id*mini_batch_size:(batch_id+1)*mini_batch_size]
+
+
+class MemmapRolloutStorage(RolloutStorage):
+    def __init__(self, num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape, actions_shape, device='cpu',
+                 shared_obs=False, obs_dtype=torch.float32, strict_obs_dtype=False, storage_dir=None, prefetch=2):
+        """
+        RolloutStorage whose buffers live in memory-mapped files instead of RAM, for rollouts that do not fit in memory.
+        The buffers are torch tensors sharing memory with the maps, so add_transitions / compute_returns are unchanged.
+        Minibatches are read as contiguous blocks and copied into RAM by a background thread, `prefetch` batches ahead.
+
+        Shuffling permutes whole time steps (num_envs consecutive transitions) instead of single transitions,
+        so that every read stays sequential.
+
+        :param storage_dir: parent directory of the buffer files (default: system temp directory), removed on close()
+        """
+        assert str(device) == 'cpu', "Memory-mapped storage is only available on cpu"
+        self.storage_dir = tempfile.mkdtemp(prefix='rollout_storage_', dir=storage_dir)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.storage_dir, True)
+        self.prefetch = prefetch
+        super(MemmapRolloutStorage, self).__init__(num_envs, num_transitions_per_env, actor_obs_shape, critic_obs_shape,
+                                                   actions_shape, device, shared_obs=shared_obs, obs_dtype=obs_dtype,
+                                                   strict_obs_dtype=strict_obs_dtype)
+
+    def _allocate(self, name, shape, dtype=torch.float32):
+        # numpy has no bfloat16, the map is allocated as int16 and reinterpreted
+        np_dtype = {torch.float32: np.float32, torch.float16: np.float16, torch.bfloat16: np.int16, torch.uint8: np.uint8}[dtype]
+        array = np.lib.format.open_memmap(os.path.join(self.storage_dir, name + '.npy'), mode='w+', dtype=np_dtype, shape=shape)
+        tensor = torch.from_numpy(array)
+        return tensor.view(torch.bfloat16) if dtype == torch.bfloat16 else tensor
+
+    def close(self):
+        self._finalizer()
+
+    def mini_batch_generator_shuffle(self, num_mini_batches):
+        steps_per_batch = self.num_transitions_per_env // num_mini_batches
+        step_order = torch.randperm(self.num_transitions_per_env)
+
+        def batches():
+            for batch_id in range(num_mini_batches):
+                steps = torch.sort(step_order[batch_id*steps_per_batch:(batch_id+1)*steps_per_batch])[0]
+                yield self._read_batch(lambda tensor: tensor[steps].reshape(-1, *tensor.size()[2:]))
+
+        return self._prefetched(batches())
+
+    def mini_batch_generator_inorder(self, num_mini_batches):
+        batch_size = self.num_envs * self.num_transitions_per_env
+        mini_batch_size = batch_size // num_mini_batches
+
+        def batches():
+            for batch_id in range(num_mini_batches):
+                batch = slice(batch_id*mini_batch_size, (batch_id+1)*mini_batch_size)
+                yield self._read_batch(lambda tensor: tensor.view(-1, *tensor.size()[2:])[batch].clone())
+
+        return self._prefetched(batches())
+
+    def _read_batch(self, read):
+        actor_obs_batch = read(self.actor_obs).float()
+        critic_obs_batch = actor_obs_batch if self.shared_obs else read(self.critic_obs).float()
+        return actor_obs_batch, critic_obs_batch, read(self.actions), read(self.values), read(self.advantages), \
+            read(self.returns), read(self.actions_log_prob)
+
+    def _prefetched(self, batches):
+        return prefetch(batches, self.prefetch, name="rollout_storage_prefetch")
+
+
+class TemporalRolloutStorage(RolloutStorage):
+    def __init__(self, num_envs, num_transitions_per_env, obs_shape, actions_shape, device, window, obs_dtype=torch.float32,
+                 strict_obs_dtype=False):
+        """
+        RolloutStorage for temporal (TCN) policies. Every env's observation stream is stored once, (window - 1 + T + 1, num_envs, dim):
+        window - 1 rows of (masked) history before the first step, one row per step and one row for the bootstrap observation.
+        History windows are strided views into the stream, so memory does not grow with the window length.
+        Only the gathered minibatch is copied.
+
+        Episode boundaries are handled by masking: every row carries an episode id (number of dones before it) and the steps of a window
+        that belong to an earlier episode are zeroed. runner.py resets all envs before every rollout, so the history rows in front of
+        the first step are always masked.
+
+        The actor and critic share the observation stream.
+
+        :param window: history length of the windows (steps, including the current one)
+        """
+        self.window = window
+        super(TemporalRolloutStorage, self).__init__(num_envs, num_transitions_per_env, obs_shape, obs_shape, actions_shape, device,
+                                                     shared_obs=True, obs_dtype=obs_dtype, strict_obs_dtype=strict_obs_dtype)
+        self._window_mask = None
+        self.clear()
+
+    def _allocate(self, name, shape, dtype=torch.float32):
+        if name != 'actor_obs':
+            return super(TemporalRolloutStorage, self)._allocate(name, shape, dtype)
+        n_rows = self.window + shape[0]
+        self.obs_stream = super(TemporalRolloutStorage, self)._allocate('obs_stream', (n_rows, *shape[1:]), dtype)
+        self.episode_ids = super(TemporalRolloutStorage, self)._allocate('episode_ids', (n_rows, shape[1]), torch.int32)
+        # actor_obs stays the (T, num_envs, dim) view of the per-step rows, e.g. for the rollout exporter
+        return self.obs_stream[self.window - 1:self.window - 1 + shape[0]]
+
+    def observe_window(self, obs):
+        """
+        Appends the observation of the current step to the stream (the bootstrap observation after the last step)
+        and returns the history window of every env, (num_envs, window, dim).
+        """
+        row = self.window - 1 + self.step
+        self.obs_stream[row].copy_(torch.from_numpy(obs).to(self.device))
+        return self._masked_windows(row - self.window + 1, 1).squeeze(0)
+
+    def add_transitions(self, actor_obs, critic_obs, actions, rewards, dones, values, actions_log_prob, envs=None):
+        # the observation is already in the stream (observe_window)
+        assert envs is None, "Split stepping is not available for temporal policies"
+        if self.step >= self.num_transitions_per_env:
+            raise AssertionError("Rollout buffer overflow")
+        self._check_obs_accuracy(actor_obs, critic_obs)
+        row = self.window - 1 + self.step
+        dones = torch.from_numpy(dones).to(self.device)
+        self.episode_ids[row + 1] = self.episode_ids[row] + dones.int()
+        self.actions[self.step].copy_(actions.to(self.device))
+        self.rewards[self.step].copy_(torch.from_numpy(rewards).view(-1, 1).to(self.device))
+        self.dones[self.step].copy_(dones.view(-1, 1))
+        self.values[self.step].copy_(values.to(self.device))
+        self.actions_log_prob[self.step].copy_(actions_log_prob.view(-1, 1).to(self.device))
+        self.step += 1
+
+    def clear(self):
+        self.step = 0
+        self._window_mask = None
+        self.episode_ids[:self.window - 1] = -1
+        self.episode_ids[self.window - 1] = 0
+
+    def _strided_windows(self, tensor, first_row, n_windows):
+        # windows[i, env] = tensor[first_row + i:first_row + i + window, env], without copy
+        stride = tensor.stride()
+        return tensor.as_strided((n_windows, self.num_envs, self.window, *tensor.size()[2:]),
+                                 (stride[0], stride[1], stride[0], *stride[2:]),
+                                 tensor.storage_offset() + first_row * stride[0])
+
+    def _mask(self, first_row, n_windows):
+        ids = self._strided_windows(self.episode_ids, first_row, n_windows)
+        return (ids == ids[:, :, -1:]).unsqueeze(-1)
+
+    def _masked_windows(self, first_row, n_windows):
+        windows = self._strided_windows(self.obs_stream, first_row, n_windows)
+        return windows.float() * self._mask(first_row, n_windows)
+
+    def _obs_batch(self, obs, indices):
+        # (T * num_envs, window, dim) view over the stream, merging the step and env dimensions keeps it a view
+        windows = self._strided_windows(self.obs_stream, 0, self.num_transitions_per_env).view(-1, self.window, self.obs_stream.size(-1))
+        if self._window_mask is None:
+            self._window_mask = self._mask(0, self.num_transitions_per_env).view(-1, self.window, 1)
+        return windows[indices].float() * self._window_mask[indices]
@@ -0,0 +1,205 @@
+import time
+import warnings
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+
+def ppo_loss(actor, critic, actor_obs_batch, critic_obs_batch, actions_batch, target_values_batch, advantages_batch, returns_batch,
+             old_actions_log_prob_batch, clip_param, value_loss_coef, entropy_coef, use_clipped_value_loss):
+    """
+    Clipped surrogate + value loss of one minibatch, shared by the eager and the compiled update.
+
+    :return: loss, surrogate_loss, value_loss, approx_kl (detached estimate of KL(old || new) on the minibatch)
+    """
+    actions_log_prob_batch, entropy_batch = actor.evaluate(actor_obs_batch, actions_batch)
+    value_batch = critic.evaluate(critic_obs_batch)
+
+    # Surrogate loss
+    log_ratio = actions_log_prob_batch - torch.squeeze(old_actions_log_prob_batch)
+    ratio = torch.exp(log_ratio)
+    surrogate = -torch.squeeze(advantages_batch) * ratio
+    surrogate_clipped = -torch.squeeze(advantages_batch) * torch.clamp(ratio, 1.0 - clip_param, 1.0 + clip_param)
+    surrogate_loss = torch.max(surrogate, surrogate_clipped).mean()
+
+    # Value function loss
+    if use_clipped_value_loss:
+        value_clipped = target_values_batch + (value_batch - target_values_batch).clamp(-clip_param, clip_param)
+        value_losses = (value_batch - returns_batch).pow(2)
+        value_losses_clipped = (value_clipped - returns_batch).pow(2)
+        value_loss = torch.max(value_losses, value_losses_clipped).mean()
+    else:
+        value_loss = (returns_batch - value_batch).pow(2).mean()
+
+    loss = surrogate_loss + value_loss_coef * value_loss - entropy_coef * entropy_batch.mean()
+
+    # unbiased, non-negative estimator (ratio - 1) - log(ratio) of the KL divergence, from the log-ratio above
+    approx_kl = ((ratio - 1.) - log_ratio).mean().detach()
+    return loss, surrogate_loss, value_loss, approx_kl
+
+
+def make_optimizer(parameters, learning_rate, fused=False):
+    """
+    Adam over the actor and critic parameters. With fused=True the single-kernel (fused) implementation is used when the
+    installed torch has it for the device, the multi-tensor (foreach) implementation otherwise.
+    """
+    parameters = list(parameters)
+    if not fused:
+        return optim.Adam(parameters, lr=learning_rate)
+    try:
+        return optim.Adam(parameters, lr=learning_rate, fused=True)
+    except (RuntimeError, TypeError):
+        return optim.Adam(parameters, lr=learning_rate, foreach=True)
+
+
+class EagerUpdate:
+    def __init__(self, actor, critic, optimizer, max_grad_norm, **loss_kwargs):
+        """
+        Reference minibatch update (eager autograd, torch.nn.utils.clip_grad_norm_).
+
+        :param loss_kwargs: clip_param, value_loss_coef, entropy_coef, use_clipped_value_loss (see ppo_loss)
+        """
+        self.actor = actor
+        self.critic = critic
+        self.optimizer = optimizer
+        self.max_grad_norm = max_grad_norm
+        self.loss_kwargs = loss_kwargs
+        self.parameters = [*self.actor.parameters(), *self.critic.parameters()]
+
+    def step(self, *batch, max_kl=None):
+        """
+        :param batch: minibatch in the order of the RolloutStorage generators
+        :param max_kl: skip the gradient step if the approximate KL to the rollout policy already exceeds max_kl
+        :return: surrogate_loss, value_loss, approx_kl (detached), whether the gradient step was taken
+        """
+        loss, surrogate_loss, value_loss, approx_kl = ppo_loss(self.actor, self.critic, *batch, **self.loss_kwargs)
+        if max_kl is not None and approx_kl.item() > max_kl:
+            return surrogate_loss.detach(), value_loss.detach(), approx_kl, False
+
+        # Gradient step
+        self.optimizer.zero_grad()
+        loss.backward()
+        nn.utils.clip_grad_norm_(self.parameters, self.max_grad_norm)
+        self.optimizer.step()
+        return surrogate_loss.detach(), value_loss.detach(), approx_kl, True
+
+
+class FusedUpdate(EagerUpdate):
+    def __init__(self, actor, critic, optimizer, max_grad_norm, compile_backend='inductor', **loss_kwargs):
+        """
+        Minibatch update with the forward / loss / backward of both networks compiled as one graph (torch.compile).
+
+        The parameters and their gradients are moved into one contiguous buffer each (the parameters become views),
+        so gradient clipping is a single norm and scale over the gradient buffer and the optimizer (see make_optimizer)
+        works on tensors of one allocation. Parameter objects are kept, so state dicts and checkpoints are unchanged.
+        The gradients are only views into the buffer as long as .grad is never reset to None, so the optimizer's
+        zero_grad is replaced by zero_grad below, which zeroes the buffer in place.
+
+        Falls back to the eager loss (still with the flat buffers) when torch.compile is not available.
+
+        :param compile_backend: torch.compile backend, 'inductor' generates fused C++/OpenMP kernels on cpu
+        """
+        super(FusedUpdate, self).__init__(actor, critic, optimizer, max_grad_norm, **loss_kwargs)
+        self.flat_parameters, self.flat_gradients = self._flatten(self.parameters)
+        self.gradient_views = [parameter.grad for parameter in self.parameters]
+        # zero_grad(set_to_none=True) would detach .grad from the buffer and clip / step would see stale gradients
+        self.optimizer.zero_grad = self.zero_grad
+
+        self.loss = self._loss
+        if hasattr(torch, 'compile'):
+            self.loss = torch.compile(self._loss, backend=compile_backend)
+        else:
+            warnings.warn("torch.compile is not available (torch < 2.0), the fused update runs the eager loss")
+
+    @staticmethod
+    def _flatten(parameters):
+        numel = sum(parameter.numel() for parameter in parameters)
+        device, dtype = parameters[0].device, parameters[0].dtype
+        assert all(parameter.device == device and parameter.dtype == dtype for parameter in parameters), \
+            "Flat parameter buffers need a single device and dtype"
+        flat_parameters = torch.empty(numel, device=device, dtype=dtype)
+        flat_gradients = torch.zeros(numel, device=device, dtype=dtype)
+
+        offset = 0
+        for parameter in parameters:
+            n = parameter.numel()
+            flat_parameters[offset:offset + n].copy_(parameter.data.view(-1))
+            parameter.data = flat_parameters[offset:offset + n].view_as(parameter)
+            # autograd accumulates in place into an existing .grad, so the gradients stay in the buffer
+            parameter.grad = flat_gradients[offset:offset + n].view_as(parameter)
+            offset += n
+        return flat_parameters, flat_gradients
+
+    def _loss(self, *batch):
+        return ppo_loss(self.actor, self.critic, *batch, **self.loss_kwargs)
+
+    def zero_grad(self, set_to_none=None):
+        """
+        Zeroes the gradient buffer in place, set_to_none is ignored (the gradients have to stay views into the buffer).
+        """
+        self.flat_gradients.zero_()
+
+    def _assert_gradient_views(self):
+        assert all(parameter.grad is not None and parameter.grad.data_ptr() == view.data_ptr()
+                   for parameter, view in zip(self.parameters, self.gradient_views)), \
+            "Parameter gradients are no longer views into the flat gradient buffer (.grad was reset or reassigned)"
+
+    def step(self, *batch, max_kl=None):
+        # the backward graph of the compiled loss is compiled as well (AOTAutograd)
+        loss, surrogate_loss, value_loss, approx_kl = self.loss(*batch)
+        if max_kl is not None and approx_kl.item() > max_kl:
+            return surrogate_loss.detach(), value_loss.detach(), approx_kl, False
+
+        self._assert_gradient_views()
+        self.zero_grad()
+        loss.backward()
+
+        # clip_grad_norm_ on the single gradient buffer
+        total_norm = torch.linalg.vector_norm(self.flat_gradients)
+        self.flat_gradients.mul_(torch.clamp(self.max_grad_norm / (total_norm + 1e-6), max=1.0))
+        self.optimizer.step()
+        return surrogate_loss.detach(), value_loss.detach(), approx_kl, True
+
+
+def benchmark_update(actor, critic, batches, n_repeats=20, learning_rate=5e-4, max_grad_norm=0.5, atol=1e-4, compile_backend='inductor',
+                     **loss_kwargs):
+    """
+    Runs the eager and the fused update from the same initial weights on the same minibatches,
+    checks that the parameters stay within atol and reports the time per minibatch update.
+
+    The networks are deep-copied, actor and critic are left untouched.
+
+    :param batches: list of minibatches (tuples in the order of the RolloutStorage generators)
+    :param compile_backend: torch.compile backend of the fused update
+    :return: dict with eager_time, fused_time, speedup, max_parameter_error, max_loss_error, parity
+    """
+    import copy
+
+    def run(update_class):
+        actor_copy, critic_copy = copy.deepcopy(actor), copy.deepcopy(critic)
+        parameters = [*actor_copy.parameters(), *critic_copy.parameters()]
+        optimizer = make_optimizer(parameters, learning_rate, fused=update_class is FusedUpdate)
+        backend = {'compile_backend': compile_backend} if update_class is FusedUpdate else {}
+        update = update_class(actor_copy, critic_copy, optimizer, max_grad_norm, **backend, **loss_kwargs)
+
+        # the first pass includes the compilation, the parity check uses it, the timing does not
+        losses = [torch.stack(update.step(*batch)[:2]) for batch in batches]
+        parameters_after_first_pass = torch.cat([parameter.detach().reshape(-1).clone() for parameter in parameters])
+        start = time.time()
+        for _ in range(n_repeats):
+            for batch in batches:
+                update.step(*batch)
+        elapsed = (time.time() - start) / (n_repeats * len(batches))
+        return torch.stack(losses), parameters_after_first_pass, elapsed
+
+    eager_losses, eager_parameters, eager_time = run(EagerUpdate)
+    fused_losses, fused_parameters, fused_time = run(FusedUpdate)
+
+    max_parameter_error = (eager_parameters - fused_parameters).abs().max().item()
+    max_loss_error = (eager_losses - fused_losses).abs().max().item()
+    return {'eager_time': eager_time,
+            'fused_time': fused_time,
+            'speedup': eager_time / fused_time,
+            'max_parameter_error': max_parameter_error,
+            'max_loss_error': max_loss_error,
+            'parity': max_parameter_error < atol and max_loss_error < atol}
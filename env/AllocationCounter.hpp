@@ -0,0 +1,111 @@
+//----------------------------//
+// This file is part of RaiSim//
+// Copyright 2020, RaiSim Tech//
+//----------------------------//
+
+#ifndef SRC_RAISIMGYMALLOCATIONCOUNTER_HPP
+#define SRC_RAISIMGYMALLOCATIONCOUNTER_HPP
+
+#include <cstddef>
+#include <cstdlib>
+#include <new>
+#if defined(__GLIBC__)
+#include <malloc.h>
+#endif
+
+/// Debug-only heap allocation counter.
+///
+/// Build with -DRSG_COUNT_ALLOCATIONS to replace the global allocation functions of the binary
+/// (raisim_gym.cpp / debug_app.cpp, which each include this header from exactly one translation unit).
+/// Every thread counts its own allocations, so an OpenMP worker can measure what a single
+/// environment step allocated without any synchronization.
+///
+/// The python module must additionally be linked with -Wl,-Bsymbolic so that calls from Eigen and the
+/// standard library inside the module bind to the counting functions defined here.
+/// Without RSG_COUNT_ALLOCATIONS every counter stays at zero and nothing is replaced.
+
+namespace raisim {
+namespace allocation_counter {
+
+inline thread_local long long threadAllocations_ = 0;
+
+inline constexpr bool enabled() {
+#ifdef RSG_COUNT_ALLOCATIONS
+  return true;
+#else
+  return false;
+#endif
+}
+
+/// number of heap allocations made by the calling thread so far
+inline long long threadAllocations() { return threadAllocations_; }
+
+/// bytes of the native heap in use by the whole process (malloc arenas and mmapped chunks), available in every build.
+/// Unlike the RSS it does not include freed memory that malloc keeps for reuse. Zero outside glibc.
+inline long long heapInUseBytes() {
+#if defined(__GLIBC__) && __GLIBC_PREREQ(2, 33)
+  const struct mallinfo2 info = mallinfo2();
+  return (long long)(info.uordblks + info.hblkhd);
+#elif defined(__GLIBC__)
+  const struct mallinfo info = mallinfo();  // int fields, wrap around above 2 GB
+  return (long long)(unsigned int)info.uordblks + (long long)(unsigned int)info.hblkhd;
+#else
+  return 0;
+#endif
+}
+
+}  // namespace allocation_counter
+}  // namespace raisim
+
+#ifdef RSG_COUNT_ALLOCATIONS
+
+#if defined(__GLIBC__)
+extern "C" {
+void *__libc_malloc(size_t size);
+void *__libc_calloc(size_t nmemb, size_t size);
+void *__libc_realloc(void *ptr, size_t size);
+void __libc_free(void *ptr);
+
+/// Eigen allocates dynamic matrices through std::malloc, so operator new alone would miss them.
+void *malloc(size_t size) noexcept {
+  ++raisim::allocation_counter::threadAllocations_;
+  return __libc_malloc(size);
+}
+
+void *calloc(size_t nmemb, size_t size) noexcept {
+  ++raisim::allocation_counter::threadAllocations_;
+  return __libc_calloc(nmemb, size);
+}
+
+void *realloc(void *ptr, size_t size) noexcept {
+  ++raisim::allocation_counter::threadAllocations_;
+  return __libc_realloc(ptr, size);
+}
+
+void free(void *ptr) noexcept { __libc_free(ptr); }
+}
+#define RSG_COUNTING_MALLOC(size) std::malloc(size)
+#else
+/// no malloc interposition outside glibc: count at the operator new level only
+#define RSG_COUNTING_MALLOC(size) (++raisim::allocation_counter::threadAllocations_, std::malloc(size))
+#endif
+
+void *operator new(std::size_t size) {
+  void *ptr = RSG_COUNTING_MALLOC(size == 0 ? 1 : size);
+  if (!ptr) throw std::bad_alloc();
+  return ptr;
+}
+
+void *operator new[](std::size_t size) { return ::operator new(size); }
+void *operator new(std::size_t size, const std::nothrow_t &) noexcept { return RSG_COUNTING_MALLOC(size == 0 ? 1 : size); }
+void *operator new[](std::size_t size, const std::nothrow_t &) noexcept { return RSG_COUNTING_MALLOC(size == 0 ? 1 : size); }
+void operator delete(void *ptr) noexcept { std::free(ptr); }
+void operator delete[](void *ptr) noexcept { std::free(ptr); }
+void operator delete(void *ptr, std::size_t) noexcept { std::free(ptr); }
+void operator delete[](void *ptr, std::size_t) noexcept { std::free(ptr); }
+
+#undef RSG_COUNTING_MALLOC
+
+#endif //RSG_COUNT_ALLOCATIONS
+
+#endif //SRC_RAISIMGYMALLOCATIONCOUNTER_HPP
@@ -0,0 +1,82 @@
+//----------------------------//
+// This file is part of RaiSim//
+// Copyright 2020, RaiSim Tech//
+//----------------------------//
+
+#ifndef SRC_RAISIMGYMMODELCACHE_HPP
+#define SRC_RAISIMGYMMODELCACHE_HPP
+
+#include <chrono>
+#include <fstream>
+#include <mutex>
+#include <sstream>
+#include <string>
+#include <unordered_map>
+#include "raisim/World.hpp"
+
+/// Robot description files read once per process.
+///
+/// Every environment owns its own raisim::World and has to build its own articulated system,
+/// but the URDF text does not have to be read from disk by each of them. World::addArticulatedSystem
+/// accepts the URDF script itself together with the directory its meshes are resolved against:
+///
+///   world_->addArticulatedSystem(model_cache::urdf(path), model_cache::directory(path));
+///
+/// Only the text is cached: raisim still parses it, loads the meshes and builds the articulated system
+/// once per environment. statistics() reports what the cache saved (see the model_cache_* startup timings).
+///
+/// The cache is safe to use from the OpenMP threads that construct the environments.
+
+namespace raisim {
+namespace model_cache {
+
+/// files read from disk, lookups served from the cache and wall time [s] spent reading
+struct Statistics {
+  long long reads = 0, hits = 0;
+  double readSeconds = 0.;
+};
+
+inline std::mutex &mutex() {
+  static std::mutex mutex;
+  return mutex;
+}
+
+inline Statistics &statisticsUnlocked() {
+  static Statistics statistics;
+  return statistics;
+}
+
+inline Statistics statistics() {
+  std::lock_guard<std::mutex> lock(mutex());
+  return statisticsUnlocked();
+}
+
+inline const std::string &urdf(const std::string &path) {
+  static std::unordered_map<std::string, std::string> scripts;  // element references survive rehashing
+  std::lock_guard<std::mutex> lock(mutex());
+  auto script = scripts.find(path);
+  if (script == scripts.end()) {
+    const auto start = std::chrono::steady_clock::now();
+    std::ifstream file(path);
+    RSFATAL_IF(!file.good(), "Cannot read the robot description " << path)
+    std::stringstream buffer;
+    buffer << file.rdbuf();
+    script = scripts.emplace(path, buffer.str()).first;
+    statisticsUnlocked().reads++;
+    statisticsUnlocked().readSeconds += std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+  } else {
+    statisticsUnlocked().hits++;
+  }
+  return script->second;
+}
+
+/// resource directory of a description file (the directory raisim uses when it is given the path itself)
+inline std::string directory(const std::string &path) {
+  const auto slash = path.find_last_of('/');
+  return slash == std::string::npos ? std::string("./") : path.substr(0, slash + 1);
+}
+
+}  // namespace model_cache
+}  // namespace raisim
+
+#endif //SRC_RAISIMGYMMODELCACHE_HPP
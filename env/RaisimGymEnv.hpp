@@ -14,6 +14,8 @@
 #include "raisim/RaisimServer.hpp"
 #include "Yaml.hpp"
 #include "Reward.hpp"
+#include "StepTimer.hpp"
+#include "ModelCache.hpp"
 
 #define __RSG_MAKE_STR(x) #x
 #define _RSG_MAKE_STR(x) __RSG_MAKE_STR(x)
@@ -28,6 +30,14 @@ using EigenRowMajorMat=Eigen::Matrix<Dtype, -1, -1, Eigen::RowMajor>;
 using EigenVec=Eigen::Matrix<Dtype, -1, 1>;
 using EigenBoolVec=Eigen::Matrix<bool, -1, 1>;
 
+/// placement of an env's robot when several envs share one world (robots_per_world > 1, see VectorizedEnvironment)
+struct WorldSlot {
+  std::shared_ptr<raisim::World> world;  // world of the previous robots, nullptr: the env creates the world
+  int robot = 0;                         // index of the robot in its world
+  int robotsInWorld = 1;
+  double x = 0., y = 0.;                 // origin of the robot in the world
+};
+
 class RaisimGymEnv {
 
     public:
@@ -47,6 +57,8 @@ class RaisimGymEnv {
         virtual void curriculumUpdate() {};
         virtual void close() { if(server_) server_->killServer(); };
         virtual void setSeed(int seed) {};
+        /// seed of env envId of a VectorizedEnvironment (its own generator, resets of different envs run concurrently)
+        virtual void setEnvSeed(int seed, int envId) { setSeed(seed + envId); };
         ////////////////////////////////
 
         void setSimulationTimeStep(double dt) { simulation_dt_ = dt; world_->setTimeStep(dt); }
@@ -56,14 +68,16 @@ class RaisimGymEnv {
         double getControlTimeStep() { return control_dt_; }
         double getSimulationTimeStep() { return simulation_dt_; }
         raisim::World* getWorld() { return world_.get(); }
+        std::shared_ptr<raisim::World> getSharedWorld() { return world_; }
         void turnOffVisualization() { server_->hibernate(); }
         void turnOnVisualization() { server_->wakeup(); }
         void startRecordingVideo(const std::string& videoName ) { server_->startRecordingVideo(videoName); }
         void stopRecordingVideo() { server_->stopRecordingVideo(); }
         raisim::Reward& getRewards() { return rewards_; }
+        raisim::StepTimer& getStepTimer() { return stepTimer_; }
 
     protected:
-        std::unique_ptr<raisim::World> world_;
+        std::shared_ptr<raisim::World> world_;  // shared by the envs of a world with robots_per_world > 1
         double simulation_dt_ = 0.0025; // 0.001
         double control_dt_ = 0.01;
         std::string resourceDir_;
@@ -71,6 +85,7 @@ class RaisimGymEnv {
         int obDim_=0, actionDim_=0;
         std::unique_ptr<raisim::RaisimServer> server_;
         raisim::Reward rewards_;
+        raisim::StepTimer stepTimer_;
 };
 
 }
@@ -7,6 +7,7 @@ import pdb
 import numpy as np
 import platform
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 
 class RaisimGymVecEnv:
@@ -22,7 +23,15 @@ class RaisimGymVecEnv:
         self.num_acts = self.wrapper.getActionDim()
         self._observation = np.zeros([self.num_envs, self.num_obs], dtype=np.float32)
         self.coordinate_observation = np.zeros([self.num_envs, 3], dtype=np.float32)
-        self.obs_rms = RunningMeanStd(shape=[self.num_envs, self.num_obs])
+        # native_obs_normalization (cfg.yaml): observations are normalized in the OpenMP loop of the environment, which
+        # keeps the statistics (obs_rms reads and writes them there)
+        self.native_normalization = normalize_ob and bool(cfg.get("native_obs_normalization", False))
+        if self.native_normalization:
+            self.wrapper.setObservationNormalization(True, clip_obs)
+            self.obs_rms = NativeRunningMeanStd(self.wrapper, shape=[self.num_envs, self.num_obs])
+            self._normalized_observation = np.zeros([self.num_envs, self.num_obs], dtype=np.float32)
+        else:
+            self.obs_rms = RunningMeanStd(shape=[self.num_envs, self.num_obs])
         self.obs_rms_second = None
         self._reward = np.zeros(self.num_envs, dtype=np.float32)
         self._done = np.zeros(self.num_envs, dtype=np.bool)
@@ -36,11 +45,22 @@ class RaisimGymVecEnv:
         except:
             self.reward_log = None
             self.reward_w_cpeff_log = None
+        self.reward_term_names = list(self.wrapper.getRewardNames()) + ['reward_sum']
+        self.reward_terms = np.zeros([self.num_envs, len(self.reward_term_names)], dtype=np.float32)
         self.contact_log = np.zeros([self.num_envs, 4], dtype=np.float32)
         self.torque_and_velocity_log = np.zeros([self.num_envs, 24], dtype=np.float32)
 
         self.potential_computed_heading_direction = np.zeros(2, dtype=np.float32)
 
+        # split stepping (step_group_async / wait_group): persistent buffers the C++ side writes while the GIL is released
+        self._group_action = np.zeros([self.num_envs, self.num_acts], dtype=np.float32)
+        self._group_observation = np.zeros([self.num_envs, self.num_obs], dtype=np.float32)
+        self._group_reward = np.zeros(self.num_envs, dtype=np.float32)
+        self._group_done = np.zeros(self.num_envs, dtype=bool)
+        self._group_executor = None
+        self._group_future = None
+        self._group_envs = None
+
     def seed(self, seed=None):
         self.wrapper.setSeed(seed)
 
@@ -128,6 +148,9 @@ class RaisimGymVecEnv:
         return self.coordinate_observation.copy()
 
     def observe(self, update_mean=True):
+        if self.native_normalization:
+            self.wrapper.observeNormalized(self._normalized_observation, self._observation, update_mean)
+            return self._normalized_observation.copy(), self._observation.copy()
         self.wrapper.observe(self._observation)
         not_normalized_obs = self._observation.copy()
 
@@ -152,6 +175,68 @@ class RaisimGymVecEnv:
             self._reward = np.zeros(self.num_envs, dtype=np.float32)
             self.wrapper.partial_reset(needed_reset)
 
+    def env_groups(self, n_groups=2):
+        """
+        :return: n_groups contiguous slices covering the envs, for split stepping. With robots_per_world > 1 the bounds
+                 are rounded to whole worlds.
+        """
+        robots_per_world = self.robots_per_world
+        n_worlds = -(-self.num_envs // robots_per_world)
+        assert n_groups <= n_worlds, "Cannot split {} worlds into {} groups".format(n_worlds, n_groups)
+        bounds = np.minimum(np.linspace(0, n_worlds, n_groups + 1).astype(int) * robots_per_world, self.num_envs)
+        return [slice(int(begin), int(end)) for begin, end in zip(bounds[:-1], bounds[1:])]
+
+    def step_group_async(self, action, envs):
+        """
+        Starts stepping the envs of the slice `envs` on a worker thread and returns immediately. The environments integrate
+        with the GIL released, so the policy can compute the actions of another group meanwhile. Only one group steps at a
+        time and no other method may be called before wait_group().
+
+        :param action: (group size, action dim)
+        """
+        assert self._group_future is None, "A group is still stepping, call wait_group() first"
+        if self._group_executor is None:
+            self._group_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="raisim_group_step")
+        self._group_action[envs] = action
+        self._group_envs = envs
+        self._group_future = self._group_executor.submit(self.wrapper.stepGroup, envs.start, envs.stop, self._group_action,
+                                                         self._group_reward, self._group_done, self._group_observation)
+
+    def wait_group(self, update_mean=True):
+        """
+
+        :return: observation after the step (normalized like observe()), reward and done of the group of step_group_async
+        """
+        self._group_future.result()
+        envs = self._group_envs
+        self._group_future, self._group_envs = None, None
+        return self._group_obs(envs, update_mean), self._group_reward[envs].copy(), self._group_done[envs].copy()
+
+    def observe_group(self, envs, update_mean=True):
+        self.wrapper.observeGroup(envs.start, envs.stop, self._group_observation)
+        return self._group_obs(envs, update_mean)
+
+    def group_raw_observation(self, envs):
+        """
+        :return: observation of the group before normalization, from its last wait_group() / observe_group()
+        """
+        return self._group_observation[envs].copy()
+
+    def _group_obs(self, envs, update_mean):
+        obs = self._group_observation[envs].copy()
+        if not self.normalize_ob:
+            return obs
+        if self.native_normalization:
+            self.wrapper.normalizeGroup(envs.start, envs.stop, self._group_observation, self._normalized_observation, update_mean)
+            return self._normalized_observation[envs].copy()
+        if update_mean:
+            self.obs_rms.update(obs)
+        # the statistics are stored per env (identical rows) or once
+        mean, var = self.obs_rms.mean, self.obs_rms.var
+        if mean.ndim == 2:
+            mean, var = mean[envs], var[envs]
+        return np.clip((obs - mean) / np.sqrt(var + 1e-8), -self.clip_obs, self.clip_obs)
+
     def _normalize_observation(self, obs, force_normalize=False, type=None):
         if self.normalize_ob:
             return np.clip((obs - self.obs_rms.mean) / np.sqrt(self.obs_rms.var + 1e-8), -self.clip_obs,
@@ -180,6 +265,8 @@ class RaisimGymVecEnv:
             self.obs_rms_second.update(obs)
 
     def close(self):
+        if self._group_executor is not None:
+            self._group_executor.shutdown()
         self.wrapper.close()
 
     def curriculum_callback(self):
@@ -219,6 +306,28 @@ class RaisimGymVecEnv:
                                              steps, delta_t, must_safe_time)
         return rewards_.copy(), collision_idx.copy()
 
+    @property
+    def robots_per_world(self):
+        return self.wrapper.getRobotsPerWorld()
+
+    @property
+    def observation_layout(self):
+        """
+        {channel: (offset, dim)} of the observation spec (observation section of cfg.yaml)
+        """
+        return {name: tuple(segment) for name, segment in self.wrapper.getObservationLayout().items()}
+
+    @property
+    def tracking_indices(self):
+        """
+        observation entries of the body forward / lateral velocity and yaw rate
+        """
+        layout = self.observation_layout
+        assert 'body_linear_velocity' in layout and 'body_angular_velocity' in layout, \
+            "Command tracking needs the body_linear_velocity and body_angular_velocity observation channels"
+        linear, angular = layout['body_linear_velocity'][0], layout['body_angular_velocity'][0]
+        return linear, linear + 1, angular + 2
+
     @property
     def num_envs(self):
         return self.wrapper.getNumOfEnvs()
@@ -229,6 +338,13 @@ class RaisimGymVecEnv:
     def reward_logging(self, n_reward):
         self.wrapper.reward_logging(self.reward_log, self.reward_w_cpeff_log, n_reward)
 
+    def reward_terms_logging(self):
+        """
+        Fills self.reward_terms (num_envs, n_terms + 1) with the coefficient-weighted reward terms of the last step,
+        ordered as self.reward_term_names (the last column is their sum).
+        """
+        self.wrapper.getRewardTerms(self.reward_terms)
+
     def contact_logging(self):
         self.wrapper.contact_logging(self.contact_log)
 
@@ -238,6 +354,134 @@ class RaisimGymVecEnv:
     def get_reward_Info(self):
         return self.wrapper.rewardInfo()
 
+    def get_step_allocations(self):
+        """
+
+        :return: (num_envs,) heap allocations of each environment during its last step
+                 (all zero unless the environment is built with RSG_COUNT_ALLOCATIONS)
+        """
+        return np.asarray(self.wrapper.getStepAllocations(), dtype=np.int64)
+
+    @property
+    def allocation_counter_enabled(self):
+        return self.wrapper.isAllocationCounterEnabled()
+
+    @property
+    def native_memory_stats(self):
+        """
+        native heap in use by the process (bytes), allocations of the last step over all envs, environments and worlds
+        """
+        return dict(self.wrapper.getNativeMemoryStats())
+
+    def numpy_buffer_bytes(self):
+        """
+
+        :return: {name: bytes} of the numpy buffers owned by this wrapper, including the observation statistics
+        """
+        buffers = {name: value.nbytes for name, value in vars(self).items() if isinstance(value, np.ndarray)}
+        for name in ['obs_rms', 'obs_rms_second']:
+            rms = getattr(self, name)
+            if rms is not None:
+                buffers[name] = rms.mean.nbytes + rms.var.nbytes
+        return buffers
+
+    def enable_timing_probes(self, enable=True):
+        self.wrapper.enableTimingProbes(enable)
+
+    def reset_timing_probes(self):
+        self.wrapper.resetTimingProbes()
+
+    @property
+    def step_phase_names(self):
+        return list(self.wrapper.getStepPhaseNames())
+
+    def get_step_timings(self):
+        """
+
+        :return: (num_envs, n_phases) accumulated exclusive time [s] of each step phase since the last reset_timing_probes(),
+                 columns ordered as step_phase_names
+        """
+        timings = np.zeros([self.num_envs, len(self.step_phase_names)], dtype=np.float32)
+        self.wrapper.getStepTimings(timings)
+        return timings
+
+    @property
+    def startup_timings(self):
+        """
+
+        :return: dict with the wall time [s] of the environment construction phases (construction, init, randomization_table,
+                 reset, total), the number of threads used and the robot description cache counters (model_cache_reads,
+                 model_cache_hits, model_cache_read_seconds)
+        """
+        return dict(self.wrapper.getStartupTimings())
+
+    def get_load_imbalance_stats(self):
+        """
+
+        :return: dict with the mean and slowest env step time per step, their ratio and per-thread busy time
+        """
+        return dict(self.wrapper.getLoadImbalanceStats())
+
+    def sample_randomization_table(self, seed, depth):
+        """
+        Samples the randomization (joint offsets, link masses, base COM, initial yaw, external force schedule) of the next
+        `depth` resets of every env in C++ from a single seed. Resets become table lookups and run in parallel.
+        """
+        self.wrapper.sampleRandomizationTable(seed, depth)
+
+    def set_randomization_table(self, table):
+        """
+
+        :param table: (num_envs * depth, randomization dim) float32, rows of env i at i * depth, columns as randomization_table_columns
+        """
+        self.wrapper.setRandomizationTable(np.ascontiguousarray(table, dtype=np.float32))
+
+    def get_randomization_table(self):
+        table = np.zeros([self.wrapper.getRandomizationTableRows(), self.wrapper.getRandomizationDim()], dtype=np.float32)
+        self.wrapper.getRandomizationTable(table)
+        return table
+
+    def disable_randomization_table(self):
+        self.wrapper.disableRandomizationTable()
+
+    @property
+    def randomization_table_columns(self):
+        return list(self.wrapper.getRandomizationNames())
+
+    def export_randomization_table(self, file_name):
+        table = self.get_randomization_table()
+        np.savez(file_name, table=table, columns=np.array(self.randomization_table_columns),
+                 depth=table.shape[0] // self.num_envs)
+
+    def get_state(self):
+        """
+        State restored by set_state: observation normalization (with its sample count), curriculum and reset generator of
+        every env and the randomization table with the position of every env in it. The dynamics randomized once in init()
+        are not part of it, they follow from the seed of the run (setSeed / randomization_table/seed).
+        """
+        state = {'obs_rms': self.obs_rms.state_dict(),
+                 'obs_rms_second': None if self.obs_rms_second is None else self.obs_rms_second.state_dict(),
+                 'curriculum': np.array(self.wrapper.getCurriculumState(), dtype=np.float64),
+                 'generators': self.wrapper.getGeneratorStates(),
+                 'randomization_table': None,
+                 'randomization_resets': None}
+        if self.wrapper.isRandomizationTableEnabled():
+            state['randomization_table'] = self.get_randomization_table()
+            state['randomization_resets'] = np.array(self.wrapper.getRandomizationResets(), dtype=np.int64)
+        return state
+
+    def set_state(self, state):
+        self.obs_rms.load_state_dict(state['obs_rms'])
+        if state['obs_rms_second'] is not None:
+            self.obs_rms_second.load_state_dict(state['obs_rms_second'])
+        self.wrapper.setCurriculumState(state['curriculum'].tolist())
+        # snapshots written before the envs had their own generators
+        if state.get('generators') is not None:
+            self.wrapper.setGeneratorStates(state['generators'])
+        if state['randomization_table'] is not None:
+            self.set_randomization_table(state['randomization_table'])
+            self.wrapper.setRandomizationResets(state['randomization_resets'].tolist())
+
     def initialize_n_step(self):
         self.wrapper.initialize_n_step()
 
@@ -297,3 +541,73 @@ class RunningMeanStd(object):
         self.var = new_var
         self.count = new_count
 
+    def state_dict(self):
+        return {'mean': self.mean.copy(), 'var': self.var.copy(), 'count': self.count}
+
+    def load_state_dict(self, state):
+        self.mean = state['mean'].copy()
+        self.var = state['var'].copy()
+        self.count = state['count']
+
+
+class NativeRunningMeanStd(object):
+    def __init__(self, wrapper, shape):
+        """
+        RunningMeanStd whose statistics live in the vectorized environment (native_obs_normalization), which updates
+        them in its OpenMP loop. mean / var are read and assigned as for RunningMeanStd, with the per-env shape
+        [num_envs, num_obs] of the mean / var files (identical rows, the first one is used on assignment).
+        """
+        self.wrapper = wrapper
+        self.shape = shape
+
+    def _statistics(self):
+        mean = np.zeros(self.shape[-1], dtype=np.float32)
+        var = np.zeros(self.shape[-1], dtype=np.float32)
+        count = self.wrapper.getObservationStatistics(mean, var)
+        return mean, var, count
+
+    def _set(self, mean=None, var=None, count=None):
+        current_mean, current_var, current_count = self._statistics()
+        mean = current_mean if mean is None else np.asarray(mean, dtype=np.float32).reshape(-1, self.shape[-1])[0]
+        var = current_var if var is None else np.asarray(var, dtype=np.float32).reshape(-1, self.shape[-1])[0]
+        self.wrapper.setObservationStatistics(np.ascontiguousarray(mean), np.ascontiguousarray(var),
+                                              current_count if count is None else float(count))
+
+    @property
+    def mean(self):
+        return np.broadcast_to(self._statistics()[0], self.shape).copy()
+
+    @mean.setter
+    def mean(self, value):
+        self._set(mean=value)
+
+    @property
+    def var(self):
+        return np.broadcast_to(self._statistics()[1], self.shape).copy()
+
+    @var.setter
+    def var(self, value):
+        self._set(var=value)
+
+    @property
+    def count(self):
+        return self._statistics()[2]
+
+    @count.setter
+    def count(self, value):
+        self._set(count=value)
+
+    def update(self, arr):
+        self.update_from_moments(np.mean(arr, axis=0), np.var(arr, axis=0), arr.shape[0])
+
+    def update_from_moments(self, batch_mean, batch_var, batch_count):
+        rms = RunningMeanStd(shape=self.shape)
+        rms.load_state_dict(self.state_dict())
+        rms.update_from_moments(batch_mean, batch_var, batch_count)
+        self.load_state_dict(rms.state_dict())
+
+    def state_dict(self):
+        return {'mean': self.mean, 'var': self.var, 'count': self.count}
+
+    def load_state_dict(self, state):
+        self._set(state['mean'], state['var'], state['count'])
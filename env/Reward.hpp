@@ -7,85 +7,136 @@
 
 #include <initializer_list>
 #include <string>
+#include <string_view>
 #include <map>
+#include <vector>
 #include "Yaml.hpp"
 
 
 namespace raisim {
 
 struct RewardElement {
-  float coefficient;
-  float reward;
-  float integral;
+  float coefficient = 0.f;
+  float reward = 0.f;
+  float integral = 0.f;
 };
 
+/// Rewards are registered once (constructor or initializeFromConfigurationFile) and stored in a flat array.
+/// Resolve a name to its slot with getSlot() outside the control loop and record by slot in the hot path;
+/// recording by name is kept for convenience but costs a map lookup per call.
 class Reward {
  public:
   Reward (std::initializer_list<std::string> names) {
     for(auto& nm: names)
-      rewards_[nm] = raisim::RewardElement();
+      addElement(nm);
   }
 
   Reward () = default;
 
   void initializeFromConfigurationFile(const Yaml::Node& cfg) {
     for(auto rw = cfg.Begin(); rw != cfg.End(); rw++) {
-      rewards_[(*rw).first] = raisim::RewardElement();
-      rewards_[(*rw).first].coefficient = (*rw).second["coeff"].template As<float>();
+      size_t slot = addElement((*rw).first);
+      rewards_[slot].coefficient = (*rw).second["coeff"].template As<float>();
     }
   }
 
+  /// slot of a registered reward, valid for the lifetime of this object
+  size_t getSlot (std::string_view name) const {
+    auto it = slots_.find(name);
+    RSFATAL_IF(it == slots_.end(), name<<" was not found in the configuration file")
+    return it->second;
+  }
+
+  size_t size() const { return rewards_.size(); }
+
+  /// reward names in slot order
+  const std::vector<std::string>& getNames() const { return names_; }
+
   const float& operator [] (const std::string& name) {
-    return rewards_[name].reward;
+    return rewards_[getSlot(name)].reward;
   }
 
-  void record (const std::string& name, float reward, bool accumulate = false) {
-    RSFATAL_IF(rewards_.find(name) == rewards_.end(), name<<" was not found in the configuration file")
-    RSISNAN_MSG(reward, name<<" is nan")
+  const float& operator [] (size_t slot) const {
+    return rewards_[slot].reward;
+  }
 
+  void record (size_t slot, float reward, bool accumulate = false) {
+    RSISNAN_MSG(reward, names_[slot]<<" is nan")
+
+    auto& rw = rewards_[slot];
     if(!accumulate)
-      rewards_[name].reward = 0.f;
-    rewards_[name].reward += reward * rewards_[name].coefficient;
-//    rewards_[name].integral += rewards_[name].reward;
+      rw.reward = 0.f;
+    rw.reward += reward * rw.coefficient;
+//    rw.integral += rw.reward;
+  }
+
+  void record (std::string_view name, float reward, bool accumulate = false) {
+    record(getSlot(name), reward, accumulate);
   }
 
   float sum() {
     float sum = 0.f;
     for(auto& rw: rewards_)
-      sum += rw.second.reward;
+      sum += rw.reward;
 
     return sum;
   }
 
   void setZero() {
     for(auto& rw: rewards_)
-      rw.second.reward = 0.f;
+      rw.reward = 0.f;
   }
 
   void reset() {
     for(auto& rw: rewards_) {
-      rw.second.integral = 0.f;
-      rw.second.reward = 0.f;
+      rw.integral = 0.f;
+      rw.reward = 0.f;
+    }
+  }
+
+  /// writes the reward of every slot followed by their sum, i.e. size() + 1 values
+  template<typename Row>
+  void exportTo(Row&& row) {
+    float sum = 0.f;
+    for(size_t i = 0; i < rewards_.size(); i++) {
+      row[i] = rewards_[i].reward;
+      sum += rewards_[i].reward;
     }
+    row[rewards_.size()] = sum;
   }
 
   const std::map<std::string, float>& getStdMapOfRewardIntegral() {
-    for(auto& rw: rewards_)
-      costSum_[rw.first] = rw.second.integral;
+    for(size_t i = 0; i < rewards_.size(); i++)
+      costSum_[names_[i]] = rewards_[i].integral;
 
     return costSum_;
   }
 
   const std::map<std::string, float>& getStdMap() {
-    for(auto& rw: rewards_)
-      rewardMap_[rw.first] = rw.second.reward;
+    for(size_t i = 0; i < rewards_.size(); i++)
+      rewardMap_[names_[i]] = rewards_[i].reward;
     rewardMap_["reward_sum"] = sum();
 
     return rewardMap_;
   }
 
  private:
-  std::map<std::string, raisim::RewardElement> rewards_;
+  size_t addElement(const std::string& name) {
+    auto it = slots_.find(name);
+    if(it != slots_.end()) {
+      rewards_[it->second] = raisim::RewardElement();
+      return it->second;
+    }
+
+    slots_[name] = rewards_.size();
+    names_.push_back(name);
+    rewards_.push_back(raisim::RewardElement());
+    return rewards_.size() - 1;
+  }
+
+  std::vector<raisim::RewardElement> rewards_;
+  std::vector<std::string> names_;
+  std::map<std::string, size_t, std::less<>> slots_;
   std::map<std::string, float> costSum_;
   std::map<std::string, float> rewardMap_;
 };
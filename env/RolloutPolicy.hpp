@@ -0,0 +1,81 @@
+//----------------------------//
+// This file is part of RaiSim//
+// Copyright 2020, RaiSim Tech//
+//----------------------------//
+
+#ifndef SRC_RAISIMGYMROLLOUTPOLICY_HPP
+#define SRC_RAISIMGYMROLLOUTPOLICY_HPP
+
+/// Policy of the native rollout collector (VectorizedEnvironment::collectRollout), only built with -DRSG_WITH_TORCH
+/// against libtorch. Without it the collector methods are not compiled and RaisimGymVecEnv keeps the python rollout.
+#ifdef RSG_WITH_TORCH
+
+#include <cmath>
+#include <torch/script.h>
+#include <ATen/CPUGeneratorImpl.h>
+#include "RaisimGymEnv.hpp"
+
+namespace raisim {
+
+/// actor and critic of the training run as one TorchScript module (scripted by algo/ppo/native_rollout.py):
+/// forward(obs) -> (action mean, action std, value). Runs on the CPU without gradients.
+class RolloutPolicy {
+ public:
+  void load(const std::string &path, uint64_t seed) {
+    module_ = torch::jit::load(path, torch::kCPU);
+    module_.eval();
+    parameters_.clear();
+    numParameters_ = 0;
+    for (const auto &parameter: module_.parameters()) {
+      parameters_.push_back(parameter);
+      numParameters_ += parameter.numel();
+    }
+    generator_ = at::detail::createCPUGenerator(seed);
+    loaded_ = true;
+  }
+
+  bool isLoaded() const { return loaded_; }
+
+  int64_t getNumParameters() const { return numParameters_; }
+
+  /// copies the flat parameter vector (parameters() of the scripted module, in the same order) into the module
+  void setParameters(const Eigen::Ref<const EigenVec> &flat) {
+    RSFATAL_IF(flat.size() != numParameters_, "rollout policy has "<<numParameters_<<" parameters, got "<<flat.size())
+    torch::NoGradGuard noGrad;
+    int64_t offset = 0;
+    for (auto &parameter: parameters_) {
+      const int64_t n = parameter.numel();
+      parameter.view({-1}).copy_(torch::from_blob(const_cast<float *>(flat.data()) + offset, {n}, torch::kFloat32));
+      offset += n;
+    }
+  }
+
+  /// samples actions ~ N(mean, std) for the observations (n, obDim), writes the actions (n, actDim), their log
+  /// probability (n) and the values (n). All buffers are contiguous and row-major.
+  void act(const float *obs, int n, int obDim, float *actions, float *logProb, float *value, int actDim) {
+    torch::NoGradGuard noGrad;
+    auto input = torch::from_blob(const_cast<float *>(obs), {n, obDim}, torch::kFloat32);
+    auto output = module_.forward({input}).toTuple();
+    auto mean = output->elements()[0].toTensor();
+    auto std = output->elements()[1].toTensor().reshape({1, actDim}).expand({n, actDim});
+    auto noise = torch::randn({n, actDim}, generator_);
+
+    /// log N(mean + std * noise; mean, std), as Normal.log_prob summed over the action dimensions
+    torch::from_blob(actions, {n, actDim}, torch::kFloat32).copy_(mean + std * noise);
+    torch::from_blob(logProb, {n}, torch::kFloat32).copy_((-0.5 * noise.square() - std.log() - 0.5 * std::log(2. * M_PI)).sum(1));
+    torch::from_blob(value, {n}, torch::kFloat32).copy_(output->elements()[2].toTensor().reshape({n}));
+  }
+
+ private:
+  torch::jit::Module module_;
+  std::vector<torch::Tensor> parameters_;
+  int64_t numParameters_ = 0;
+  at::Generator generator_;
+  bool loaded_ = false;
+};
+
+}
+
+#endif //RSG_WITH_TORCH
+
+#endif //SRC_RAISIMGYMROLLOUTPOLICY_HPP
@@ -0,0 +1,101 @@
+//----------------------------//
+// This file is part of RaiSim//
+// Copyright 2020, RaiSim Tech//
+//----------------------------//
+
+#ifndef SRC_RAISIMGYMSTEPTIMER_HPP
+#define SRC_RAISIMGYMSTEPTIMER_HPP
+
+#include <array>
+#include <chrono>
+
+namespace raisim {
+
+/// phases of an environment step. The timer records exclusive (self) time, i.e. a nested phase
+/// (contacts inside observation) is not counted again in its parent.
+enum StepPhase : int {
+  PHASE_ACTION = 0,
+  PHASE_INTEGRATE,
+  PHASE_VISUALIZATION_LOCK,
+  PHASE_OBSERVATION,
+  PHASE_CONTACTS,
+  PHASE_COST,
+  PHASE_TERMINAL_CHECK,
+  PHASE_RESET,
+  N_STEP_PHASES
+};
+
+inline const std::array<const char*, N_STEP_PHASES>& stepPhaseNames() {
+  static const std::array<const char*, N_STEP_PHASES> names = {
+      "action", "integrate", "visualization_lock", "observation", "contacts", "cost", "terminal_check", "reset"};
+  return names;
+}
+
+/// Per-environment accumulator. Each environment is stepped by one OpenMP thread at a time, so the
+/// accumulators need no synchronization; the cache line alignment keeps neighbouring environments
+/// from sharing a line.
+class alignas(64) StepTimer {
+ public:
+  using Clock = std::chrono::steady_clock;
+
+  void setEnabled(bool enabled) { enabled_ = enabled; active_ = -1; }
+  bool isEnabled() const { return enabled_; }
+
+  void clear() {
+    seconds_.fill(0.);
+    lastStepSeconds_ = 0.;
+  }
+
+  /// switches the running phase to phase and returns the phase that was running before
+  int enter(int phase) {
+    const auto now = Clock::now();
+    if (active_ >= 0)
+      seconds_[active_] += std::chrono::duration<double>(now - since_).count();
+    const int previous = active_;
+    active_ = phase;
+    since_ = now;
+    return previous;
+  }
+
+  void leave(int previous) {
+    const auto now = Clock::now();
+    if (active_ >= 0)
+      seconds_[active_] += std::chrono::duration<double>(now - since_).count();
+    active_ = previous;
+    since_ = now;
+  }
+
+  double getSeconds(int phase) const { return seconds_[phase]; }
+
+  /// wall time of the last VectorizedEnvironment step of this environment (used for load imbalance)
+  void setLastStepSeconds(double seconds) { lastStepSeconds_ = seconds; }
+  double getLastStepSeconds() const { return lastStepSeconds_; }
+
+ private:
+  std::array<double, N_STEP_PHASES> seconds_{};
+  double lastStepSeconds_ = 0.;
+  Clock::time_point since_;
+  int active_ = -1;
+  bool enabled_ = false;
+};
+
+/// times the enclosing scope as the given phase when the timer is enabled
+class ScopedStepPhase {
+ public:
+  ScopedStepPhase(StepTimer &timer, StepPhase phase) : timer_(timer.isEnabled() ? &timer : nullptr) {
+    if (timer_) previous_ = timer_->enter(phase);
+  }
+
+  ~ScopedStepPhase() { if (timer_) timer_->leave(previous_); }
+
+  ScopedStepPhase(const ScopedStepPhase&) = delete;
+  ScopedStepPhase& operator=(const ScopedStepPhase&) = delete;
+
+ private:
+  StepTimer *timer_;
+  int previous_ = -1;
+};
+
+}
+
+#endif //SRC_RAISIMGYMSTEPTIMER_HPP
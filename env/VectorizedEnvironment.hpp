@@ -7,9 +7,15 @@
 #define SRC_RAISIMGYMVECENV_HPP
 
 #include "RaisimGymEnv.hpp"
+#include "AllocationCounter.hpp"
+#include "RolloutPolicy.hpp"
 #include "omp.h"
 #include "Yaml.hpp"
 #include <time.h>
+#include <chrono>
+#include <algorithm>
+#include <random>
+#include <cmath>
 
 namespace raisim {
 
@@ -36,9 +42,21 @@ class VectorizedEnvironment {
   const std::string& getCfgString() const { return cfgString_; }
 
   void init() {
-
-    omp_set_num_threads(cfg_["num_threads"].template As<int>());
+    const auto startupStart = std::chrono::steady_clock::now();
+    auto lap = startupStart;
+    auto lapSeconds = [&lap]() {
+      const auto now = std::chrono::steady_clock::now();
+      const double seconds = std::chrono::duration<double>(now - lap).count();
+      lap = now;
+      return seconds;
+    };
+
+    /// omp_set_num_threads only applies to the calling thread, loops run from other threads (stepGroup / observeGroup on
+    /// the worker of RaisimGymVecEnv.step_group_async) request numThreads_ explicitly
+    numThreads_ = std::max(1, cfg_["num_threads"].template As<int>());
+    omp_set_num_threads(numThreads_);
     num_envs_ = cfg_["num_envs"].template As<int>();
+    threadBusy_.assign(numThreads_, ThreadBusyTime());
 
     /// Set seed and obstacle grid size for generating random environment
     bool evaluate = cfg_["evaluate"].template As<bool>();
@@ -78,39 +96,102 @@ class VectorizedEnvironment {
 //    std::cout << "Environment 1 (field): " << std::to_string(n_type_1 / num_envs_) << "\n";
 //    std::cout << "Environment 2 (corridor): " << std::to_string(n_type_2 / num_envs_) << "\n";
 
-    environments_.reserve(num_envs_);
-    rewardInformation_.reserve(num_envs_);
-    for (int i = 0; i < num_envs_; i++) {
-        environments_.push_back(new ChildEnvironment(resourceDir_, cfg_, render_ && i == 0, env_type[i], seed_seq[i]));
-        environments_.back()->setSimulationTimeStep(cfg_["simulation_dt"].template As<double>());
-        environments_.back()->setControlTimeStep(cfg_["control_dt"].template As<double>());
-        rewardInformation_.push_back(environments_.back()->getRewards().getStdMap());
+    startupTimings_["threads"] = numThreads_;
+    startupTimings_["cfg"] = lapSeconds();
+
+    /// the envs only share the parsed cfg (read-only) and the robot description cache (see ModelCache.hpp), the
+    /// randomization of init() below draws from the generator of every env, seeded once all envs are constructed
+    const bool parallelConstruction = cfg_["parallel_construction"].template As<bool>(true);
+    const double simulationDt = cfg_["simulation_dt"].template As<double>();
+    const double controlDt = cfg_["control_dt"].template As<double>();
+    /// robots_per_world > 1: consecutive envs share one world, their robots are placed on a grid robot_spacing apart
+    robotsPerWorld_ = std::max(1, std::min(cfg_["robots_per_world"].template As<int>(1), num_envs_));
+    /// every robot of a shared world gets its own collision group, raisim has 63 besides the static one
+    RSFATAL_IF(robotsPerWorld_ > 63, "robots_per_world is limited to 63 (one collision group per robot), got "<<robotsPerWorld_)
+    numWorlds_ = (num_envs_ + robotsPerWorld_ - 1) / robotsPerWorld_;
+    const double robotSpacing = cfg_["robot_spacing"].template As<double>(5.);
+    const int gridSide = int(std::ceil(std::sqrt(double(robotsPerWorld_))));
+    environments_.assign(num_envs_, nullptr);
+#pragma omp parallel if(parallelConstruction)
+    {
+      /// looking up a key of a Yaml::Node may insert it, so every thread reads its own copy of the cfg
+      Yaml::Node threadCfg;
+#pragma omp critical(vectorized_environment_cfg)
+      threadCfg = cfg_;
+
+      /// the robots of a world are added by one thread
+#pragma omp for schedule(dynamic)
+      for (int w = 0; w < numWorlds_; w++) {
+        WorldSlot slot;
+        slot.robotsInWorld = worldEnd(w) - worldBegin(w);
+        for (int i = worldBegin(w); i < worldEnd(w); i++) {
+          slot.robot = i - worldBegin(w);
+          slot.x = robotSpacing * (slot.robot % gridSide);
+          slot.y = robotSpacing * (slot.robot / gridSide);
+          // only the first environment is visualized
+          environments_[i] = new ChildEnvironment(resourceDir_, threadCfg, render_ && i == 0, env_type[i], seed_seq[i], slot);
+          environments_[i]->setSimulationTimeStep(simulationDt);
+          environments_[i]->setControlTimeStep(controlDt);
+          slot.world = environments_[i]->getSharedWorld();
+        }
+      }
     }
 
+    rewardInformation_.reserve(num_envs_);
+    stepAllocations_.assign(num_envs_, 0);
+    for (auto *env: environments_)
+      rewardInformation_.push_back(env->getRewards().getStdMap());
+    startupTimings_["parallel_construction"] = parallelConstruction;
+    startupTimings_["worlds"] = numWorlds_;
+    startupTimings_["robots_per_world"] = robotsPerWorld_;
+    startupTimings_["construction"] = lapSeconds();
+    /// robot description files read from disk and the reads saved by the cache (ModelCache.hpp), counted since the
+    /// start of the process. The read time per file times the hits estimates what the cache saves
+    const auto modelCache = model_cache::statistics();
+    startupTimings_["model_cache_reads"] = double(modelCache.reads);
+    startupTimings_["model_cache_hits"] = double(modelCache.hits);
+    startupTimings_["model_cache_read_seconds"] = modelCache.readSeconds;
+
     setSeed(0);
 
-    for (int i = 0; i < num_envs_; i++) {
-      // only the first environment is visualized
+    for (int i = 0; i < num_envs_; i++)
       environments_[i]->init();
-      environments_[i]->reset();
-    }
-
+    startupTimings_["init"] = lapSeconds();
+
+    /// pre-sampled randomization table, see sampleRandomizationTable
+    perResetDynamics_ = cfg_["randomization_table"]["per_reset_dynamics"].template As<bool>(false);
+    if (cfg_["randomization_table"]["enable"].template As<bool>(false))
+      sampleRandomizationTable(cfg_["randomization_table"]["seed"].template As<int>(0),
+                               cfg_["randomization_table"]["depth"].template As<int>(64));
+    startupTimings_["randomization_table"] = lapSeconds();
+    reset();
+    startupTimings_["reset"] = lapSeconds();
+    startupTimings_["total"] = std::chrono::duration<double>(lap - startupStart).count();
+
+    rewardNames_ = environments_[0]->getRewards().getNames();
     obDim_ = environments_[0]->getObDim();
     actionDim_ = environments_[0]->getActionDim();
     RSFATAL_IF(obDim_ == 0 || actionDim_ == 0, "Observation/Action dimension must be defined in the constructor of each environment!")
+    terminalObservation_.setZero(num_envs_, obDim_);
   }
 
   // resets all environments and returns observation
   void reset() {
-    for (auto env: environments_)
-      env->reset();
+    /// every env draws from its own generator (or its table row), so the worlds are reset in parallel, the robots of a
+    /// shared world one after the other on its thread (as in step)
+#pragma omp parallel for
+    for (int w = 0; w < numWorlds_; w++)
+      for (int i = worldBegin(w); i < worldEnd(w); i++)
+        resetAgent(i);
   }
 
   // resets specific environments and returns observation
   void partial_reset(Eigen::Ref<EigenBoolVec> &needed_reset) {
-      for (int i = 0; i < num_envs_; i++)
-          if (needed_reset[i])
-              environments_[i]->reset();
+#pragma omp parallel for
+    for (int w = 0; w < numWorlds_; w++)
+      for (int i = worldBegin(w); i < worldEnd(w); i++)
+        if (needed_reset[i])
+          resetAgent(i);
   }
 
   void observe(Eigen::Ref<EigenRowMajorMat> &ob) {
@@ -128,18 +209,102 @@ class VectorizedEnvironment {
   void step(Eigen::Ref<EigenRowMajorMat> &action,
             Eigen::Ref<EigenVec> &reward,
             Eigen::Ref<EigenBoolVec> &done) {
-#pragma omp parallel for
-    for (int i = 0; i < num_envs_; i++)
-      perAgentStep(i, action, reward, done);
+    if (robotsPerWorld_ > 1) {
+#pragma omp parallel
+      {
+        fitThreadBusyToTeam();
+#pragma omp for
+        for (int w = 0; w < numWorlds_; w++)
+          perWorldStep(w, action, reward, done, false);
+      }
+    } else {
+#pragma omp parallel
+      {
+        fitThreadBusyToTeam();
+#pragma omp for
+        for (int i = 0; i < num_envs_; i++)
+          perAgentStep(i, action, reward, done);
+      }
+    }
+
+    if (timingProbes_)
+      accumulateLoadImbalance();
+  }
+
+  ////// split stepping //////
+  /// steps the envs [begin, end) and observes them into their rows of ob, the other rows of the buffers are left untouched.
+  /// Bound with the GIL released, so python computes the actions of another group meanwhile (RaisimGymVecEnv.step_group_async).
+  /// Groups must not be stepped concurrently with each other or with any other call.
+  /// With robots_per_world > 1 a group holds whole worlds (see getRobotsPerWorld).
+  void stepGroup(int begin, int end,
+                 Eigen::Ref<EigenRowMajorMat> &action,
+                 Eigen::Ref<EigenVec> &reward,
+                 Eigen::Ref<EigenBoolVec> &done,
+                 Eigen::Ref<EigenRowMajorMat> &ob) {
+    RSFATAL_IF(begin < 0 || end > num_envs_ || begin >= end, "invalid env group ["<<begin<<", "<<end<<")")
+    if (robotsPerWorld_ > 1) {
+      RSFATAL_IF(begin % robotsPerWorld_ != 0 || (end % robotsPerWorld_ != 0 && end != num_envs_),
+                 "env group ["<<begin<<", "<<end<<") splits a world of "<<robotsPerWorld_<<" robots")
+#pragma omp parallel num_threads(numThreads_)
+      {
+        fitThreadBusyToTeam();
+#pragma omp for
+        for (int w = begin / robotsPerWorld_; w < (end + robotsPerWorld_ - 1) / robotsPerWorld_; w++) {
+          perWorldStep(w, action, reward, done, false);
+          for (int i = worldBegin(w); i < worldEnd(w); i++)
+            environments_[i]->observe(ob.row(i));
+        }
+      }
+    } else {
+#pragma omp parallel num_threads(numThreads_)
+      {
+        fitThreadBusyToTeam();
+#pragma omp for
+        for (int i = begin; i < end; i++) {
+          perAgentStep(i, action, reward, done);
+          environments_[i]->observe(ob.row(i));
+        }
+      }
+    }
+  }
+
+  void observeGroup(int begin, int end, Eigen::Ref<EigenRowMajorMat> &ob) {
+    RSFATAL_IF(begin < 0 || end > num_envs_ || begin >= end, "invalid env group ["<<begin<<", "<<end<<")")
+#pragma omp parallel for num_threads(numThreads_)
+    for (int i = begin; i < end; i++)
+      environments_[i]->observe(ob.row(i));
   }
 
   void partial_step(Eigen::Ref<EigenRowMajorMat> &action,
                     Eigen::Ref<EigenVec> &reward,
                     Eigen::Ref<EigenBoolVec> &done) {
-#pragma omp parallel for
+    /// envs skipped by this step are left out of the load imbalance (see accumulateLoadImbalance)
+    if (timingProbes_)
       for (int i = 0; i < num_envs_; i++)
+        if (done[i])
+          environments_[i]->getStepTimer().setLastStepSeconds(-1.);
+
+    if (robotsPerWorld_ > 1) {
+#pragma omp parallel
+      {
+        fitThreadBusyToTeam();
+#pragma omp for
+        for (int w = 0; w < numWorlds_; w++)
+          perWorldStep(w, action, reward, done, true);
+      }
+    } else {
+#pragma omp parallel
+      {
+        fitThreadBusyToTeam();
+#pragma omp for
+        for (int i = 0; i < num_envs_; i++)
           if (done[i] == false)
-              perAgentStep(i, action, reward, done);
+            perAgentStep(i, action, reward, done);
+      }
+    }
+
+    if (timingProbes_)
+      accumulateLoadImbalance();
   }
 
   void set_goal(Eigen::Ref<EigenVec> &goal) { environments_[0]->set_goal(goal); }
@@ -168,10 +333,10 @@ class VectorizedEnvironment {
   void startRecordingVideo(const std::string& videoName) { if(render_) environments_[0]->startRecordingVideo(videoName); }
   void stopRecordingVideo() { if(render_) environments_[0]->stopRecordingVideo(); }
 
+  /// every env gets its own generator, seeded with (seed, env id) like the rows of the randomization table
   void setSeed(int seed) {
-    int seed_inc = seed;
-    for (auto *env: environments_)
-      env->setSeed(seed_inc++);
+    for (int i = 0; i < num_envs_; i++)
+      environments_[i]->setEnvSeed(seed, i);
   }
 
   void close() {
@@ -215,6 +380,10 @@ class VectorizedEnvironment {
   int getObDim() { return obDim_; }
   int getActionDim() { return actionDim_; }
   int getNumOfEnvs() { return num_envs_; }
+  int getRobotsPerWorld() const { return robotsPerWorld_; }
+
+  /// observation channel name -> (offset, dim), from the observation spec of cfg.yaml
+  std::map<std::string, std::pair<int, int>> getObservationLayout() const { return environments_[0]->getObservationLayout(); }
 
   ////// optional methods //////
   void visualize_desired_command_traj(Eigen::Ref<EigenRowMajorMat> &coordinate_desired_command,
@@ -240,6 +409,17 @@ class VectorizedEnvironment {
       environments_[i]->reward_logging(rewards.row(i), rewards_w_coeff.row(i), n_rewards);
   }
 
+  /// bulk export of every env's reward terms in slot order (see getRewardNames) plus their sum: (num_envs, n_terms + 1)
+  void getRewardTerms(Eigen::Ref<EigenRowMajorMat> &rewardTerms) {
+    RSFATAL_IF(rewardTerms.rows() != num_envs_ || size_t(rewardTerms.cols()) != rewardNames_.size() + 1,
+               "reward term buffer must be of shape (num_envs, n_terms + 1)")
+#pragma omp parallel for
+    for (int i = 0; i < num_envs_; i++)
+      environments_[i]->getRewards().exportTo(rewardTerms.row(i));
+  }
+
+  const std::vector<std::string>& getRewardNames() const { return rewardNames_; }
+
   void contact_logging(Eigen::Ref<EigenRowMajorMat> &contacts) {
 #pragma omp parallel for
     for (int i = 0; i < num_envs_; i++)
@@ -265,29 +445,520 @@ class VectorizedEnvironment {
 
   const std::vector<std::map<std::string, float>>& getRewardInfo() { return rewardInformation_; }
 
+  ////// timing probes //////
+  void enableTimingProbes(bool enable) {
+    timingProbes_ = enable;
+    for (auto *env: environments_)
+      env->getStepTimer().setEnabled(enable);
+  }
+
+  void resetTimingProbes() {
+    for (auto *env: environments_)
+      env->getStepTimer().clear();
+    std::fill(threadBusy_.begin(), threadBusy_.end(), ThreadBusyTime());
+    imbalanceSteps_ = 0;
+    slowestEnvSecondsSum_ = meanEnvSecondsSum_ = slowestToMeanRatioSum_ = 0.;
+  }
+
+  /// accumulated exclusive time [s] of each step phase (see getStepPhaseNames): (num_envs, n_phases)
+  void getStepTimings(Eigen::Ref<EigenRowMajorMat> &timings) {
+    RSFATAL_IF(timings.rows() != num_envs_ || timings.cols() != N_STEP_PHASES,
+               "timing buffer must be of shape (num_envs, "<<N_STEP_PHASES<<")")
+    for (int i = 0; i < num_envs_; i++)
+      for (int phase = 0; phase < N_STEP_PHASES; phase++)
+        timings(i, phase) = float(environments_[i]->getStepTimer().getSeconds(phase));
+  }
+
+  std::vector<std::string> getStepPhaseNames() const {
+    return {stepPhaseNames().begin(), stepPhaseNames().end()};
+  }
+
+  /// OpenMP load imbalance of the timed steps: slowest env vs. mean env per step, busy time per thread
+  std::map<std::string, double> getLoadImbalanceStats() const {
+    std::map<std::string, double> stats;
+    const double steps = std::max<double>(imbalanceSteps_, 1.);
+    stats["steps"] = imbalanceSteps_;
+    stats["mean_env_step_time"] = meanEnvSecondsSum_ / steps;
+    stats["mean_slowest_env_step_time"] = slowestEnvSecondsSum_ / steps;
+    stats["mean_slowest_to_mean_ratio"] = slowestToMeanRatioSum_ / steps;
+
+    /// threads that never picked up an environment (e.g. fewer threads than the pool size) are ignored
+    double busyMax = 0., busySum = 0.;
+    int busyThreads = 0;
+    for (auto &busy: threadBusy_) {
+      if (busy.seconds <= 0.) continue;
+      busyMax = std::max(busyMax, busy.seconds);
+      busySum += busy.seconds;
+      busyThreads++;
+    }
+    stats["threads"] = busyThreads;
+    stats["thread_busy_time_max"] = busyMax;
+    stats["thread_busy_time_mean"] = busySum / std::max(busyThreads, 1);
+    return stats;
+  }
+
+  /// wall time [s] of the startup phases of init() (cfg, construction, init, randomization_table, reset, total)
+  const std::map<std::string, double>& getStartupTimings() const { return startupTimings_; }
+
+  ////// pre-sampled randomization //////
+  /// Samples the randomization of every env for its next `depth` resets, (num_envs * depth, randomization dim), rows of env i
+  /// at i * depth. Every row has its own generator seeded with (seed, row), so the table only depends on the seed and is
+  /// sampled in parallel. Resets then look up the next row of the env (cycling after depth resets) for the initial yaw and
+  /// the external force. The dynamics (joint offsets, masses, COM) are those of the first row of the env, fixed over
+  /// training as without the table, unless randomization_table/per_reset_dynamics re-randomizes them on every reset.
+  void sampleRandomizationTable(int seed, int depth) {
+    RSFATAL_IF(depth < 1, "the randomization table needs at least one row per env")
+    randomizationTable_.resize(num_envs_ * depth, environments_[0]->getRandomizationDim());
+#pragma omp parallel for
+    for (int row = 0; row < num_envs_ * depth; row++) {
+      std::seed_seq seedSequence{seed, row};
+      std::mt19937 generator(seedSequence);
+      environments_[row / depth]->sampleRandomization(generator, randomizationTable_.row(row));
+    }
+    useRandomizationTable(depth);
+  }
+
+  /// table sampled elsewhere (e.g. in python), same layout as sampleRandomizationTable
+  void setRandomizationTable(Eigen::Ref<EigenRowMajorMat> &table) {
+    RSFATAL_IF(table.rows() == 0 || table.rows() % num_envs_ != 0 || table.cols() != environments_[0]->getRandomizationDim(),
+               "the randomization table must be of shape (num_envs * depth, "<<environments_[0]->getRandomizationDim()<<")")
+    randomizationTable_ = table;
+    useRandomizationTable(int(table.rows() / num_envs_));
+  }
+
+  void getRandomizationTable(Eigen::Ref<EigenRowMajorMat> &table) {
+    RSFATAL_IF(table.rows() != randomizationTable_.rows() || table.cols() != randomizationTable_.cols(),
+               "the buffer must be of shape ("<<randomizationTable_.rows()<<", "<<randomizationTable_.cols()<<")")
+    table = randomizationTable_;
+  }
+
+  void disableRandomizationTable() {
+    useRandomizationTable_ = false;
+    for (auto *env: environments_)
+      env->disableRandomizationTable();
+  }
+
+  int getRandomizationTableRows() const { return int(randomizationTable_.rows()); }
+  int getRandomizationDim() { return environments_[0]->getRandomizationDim(); }
+  std::vector<std::string> getRandomizationNames() { return environments_[0]->getRandomizationNames(); }
+
+  ////// training snapshots //////
+  /// curriculum state of every env, (num_envs, curriculum dim)
+  std::vector<std::vector<double>> getCurriculumState() const {
+    std::vector<std::vector<double>> state(num_envs_);
+    for (int i = 0; i < num_envs_; i++)
+      state[i] = environments_[i]->getCurriculumState();
+    return state;
+  }
+
+  void setCurriculumState(const std::vector<std::vector<double>> &state) {
+    RSFATAL_IF(int(state.size()) != num_envs_, "the curriculum state must hold one row per env ("<<num_envs_<<")")
+    for (int i = 0; i < num_envs_; i++)
+      environments_[i]->setCurriculumState(state[i]);
+  }
+
+  /// reset generator state of every env (see setSeed)
+  std::vector<std::string> getGeneratorStates() const {
+    std::vector<std::string> states(num_envs_);
+    for (int i = 0; i < num_envs_; i++)
+      states[i] = environments_[i]->getGeneratorState();
+    return states;
+  }
+
+  void setGeneratorStates(const std::vector<std::string> &states) {
+    RSFATAL_IF(int(states.size()) != num_envs_, "one generator state per env ("<<num_envs_<<") is needed")
+    for (int i = 0; i < num_envs_; i++)
+      environments_[i]->setGeneratorState(states[i]);
+  }
+
+  bool isRandomizationTableEnabled() const { return useRandomizationTable_; }
+
+  /// resets drawn from the randomization table by every env, its position in the table (restore after setRandomizationTable)
+  const std::vector<long long>& getRandomizationResets() const { return randomizationResets_; }
+
+  void setRandomizationResets(const std::vector<long long> &resets) {
+    RSFATAL_IF(!useRandomizationTable_, "no randomization table is in use")
+    RSFATAL_IF(int(resets.size()) != num_envs_, "one reset count per env ("<<num_envs_<<") is needed")
+    randomizationResets_ = resets;
+  }
+
+  ////// native observation normalization //////
+  /// observeNormalized / normalizeGroup normalize and clip the observations in the OpenMP loops, with the statistics
+  /// (mean, var, count, as RunningMeanStd) kept here and updated from per-thread Welford partials merged after the loop
+  void setObservationNormalization(bool enable, double clip) {
+    normalizeObservation_ = enable;
+    observationClip_ = float(clip);
+    if (obsMean_.size() != obDim_) {
+      obsMean_.setZero(obDim_);
+      obsVar_.setOnes(obDim_);
+      obsCount_ = 1e-4;
+    }
+  }
+
+  bool isObservationNormalizationEnabled() const { return normalizeObservation_; }
+
+  /// observes every env into rawOb and writes its normalized observation to ob, the statistics are updated with this
+  /// batch first when updateStatistics is set (as RaisimGymVecEnv.observe(update_mean))
+  void observeNormalized(Eigen::Ref<EigenRowMajorMat> &ob, Eigen::Ref<EigenRowMajorMat> &rawOb, bool updateStatistics) {
+    normalizeRows(0, num_envs_, rawOb, ob, updateStatistics, true);
+  }
+
+  /// normalizes the rows [begin, end) of rawOb already observed by stepGroup / observeGroup (split stepping)
+  void normalizeGroup(int begin, int end, Eigen::Ref<EigenRowMajorMat> &rawOb, Eigen::Ref<EigenRowMajorMat> &ob, bool updateStatistics) {
+    RSFATAL_IF(begin < 0 || end > num_envs_ || begin >= end, "invalid env group ["<<begin<<", "<<end<<")")
+    normalizeRows(begin, end, rawOb, ob, updateStatistics, false);
+  }
+
+  /// mean and var of the observation statistics, returns the sample count
+  double getObservationStatistics(Eigen::Ref<EigenVec> mean, Eigen::Ref<EigenVec> var) const {
+    RSFATAL_IF(mean.size() != obDim_ || var.size() != obDim_, "mean and var must be of size "<<obDim_)
+    mean = obsMean_.cast<float>();
+    var = obsVar_.cast<float>();
+    return obsCount_;
+  }
+
+  void setObservationStatistics(Eigen::Ref<EigenVec> mean, Eigen::Ref<EigenVec> var, double count) {
+    RSFATAL_IF(mean.size() != obDim_ || var.size() != obDim_, "mean and var must be of size "<<obDim_)
+    obsMean_ = mean.cast<double>();
+    obsVar_ = var.cast<double>();
+    obsCount_ = count;
+  }
+
+#ifdef RSG_WITH_TORCH
+  ////// native rollout collection (-DRSG_WITH_TORCH) //////
+  /// loads the TorchScript policy of algo/ppo/native_rollout.py, seed: action noise
+  void loadRolloutPolicy(const std::string &path, int seed) { rolloutPolicy_.load(path, uint64_t(seed)); }
+
+  int getRolloutPolicyParameterCount() const { return int(rolloutPolicy_.getNumParameters()); }
+
+  void setRolloutPolicyParameters(Eigen::Ref<EigenVec> flat) { rolloutPolicy_.setParameters(flat); }
+
+  /// runs nSteps steps of all envs without returning to python: every step sets the commands at period starts,
+  /// observes and normalizes (native observation normalization, statistics updated), samples the actions with the
+  /// rollout policy and steps the envs. The buffers are (nSteps * num_envs, ...) in step-major order (rawObs: the
+  /// observations before normalization), commands is (n_periods * num_envs, 3) and lastObs / lastRawObs receive the
+  /// observation after the last step.
+  void collectRollout(int nSteps, int commandPeriodSteps,
+                      Eigen::Ref<EigenRowMajorMat> &commands,
+                      Eigen::Ref<EigenRowMajorMat> &obs,
+                      Eigen::Ref<EigenRowMajorMat> &rawObs,
+                      Eigen::Ref<EigenRowMajorMat> &actions,
+                      Eigen::Ref<EigenVec> &logProb,
+                      Eigen::Ref<EigenVec> &value,
+                      Eigen::Ref<EigenVec> &reward,
+                      Eigen::Ref<EigenBoolVec> &done,
+                      Eigen::Ref<EigenRowMajorMat> &rewardTerms,
+                      Eigen::Ref<EigenRowMajorMat> &lastObs,
+                      Eigen::Ref<EigenRowMajorMat> &lastRawObs) {
+    RSFATAL_IF(!rolloutPolicy_.isLoaded(), "no rollout policy, call loadRolloutPolicy first")
+    RSFATAL_IF(!normalizeObservation_, "native rollout collection needs native observation normalization")
+    const int nRows = nSteps * num_envs_;
+    RSFATAL_IF(obs.rows() != nRows || rawObs.rows() != nRows || actions.rows() != nRows || logProb.size() != nRows || value.size() != nRows ||
+               reward.size() != nRows || done.size() != nRows || rewardTerms.rows() != nRows,
+               "rollout buffers must have nSteps * num_envs = "<<nRows<<" rows")
+    RSFATAL_IF(obs.outerStride() != obDim_ || actions.outerStride() != actionDim_, "rollout buffers must be contiguous")
+    RSFATAL_IF(commands.rows() < ((nSteps + commandPeriodSteps - 1) / commandPeriodSteps) * num_envs_,
+               "commands must hold every command period of the rollout")
+
+    for (int t = 0; t < nSteps; t++) {
+      const int row = t * num_envs_;
+      if (t % commandPeriodSteps == 0) {
+        Eigen::Ref<EigenRowMajorMat> command = commands.middleRows((t / commandPeriodSteps) * num_envs_, num_envs_);
+        set_user_command(command);
+      }
+
+      Eigen::Ref<EigenRowMajorMat> ob = obs.middleRows(row, num_envs_);
+      Eigen::Ref<EigenRowMajorMat> rawOb = rawObs.middleRows(row, num_envs_);
+      observeNormalized(ob, rawOb, true);
+      rolloutPolicy_.act(ob.data(), num_envs_, obDim_, actions.row(row).data(), logProb.data() + row, value.data() + row,
+                         actionDim_);
+
+      Eigen::Ref<EigenRowMajorMat> action = actions.middleRows(row, num_envs_);
+      Eigen::Ref<EigenVec> stepReward = reward.segment(row, num_envs_);
+      Eigen::Ref<EigenBoolVec> stepDone = done.segment(row, num_envs_);
+      step(action, stepReward, stepDone);
+
+      Eigen::Ref<EigenRowMajorMat> terms = rewardTerms.middleRows(row, num_envs_);
+      getRewardTerms(terms);
+    }
+    observeNormalized(lastObs, lastRawObs, true);
+  }
+#endif
+
+  ////// terminal observations //////
+  /// when enabled, step() keeps the observation of every terminated env before its automatic reset
+  void enableTerminalObservation(bool enable) { storeTerminalObservation_ = enable; }
+
+  /// copies the terminal observation of the envs flagged in done (the done vector of the last step)
+  void getTerminalObservation(Eigen::Ref<EigenRowMajorMat> &ob, Eigen::Ref<EigenBoolVec> &done) {
+    RSFATAL_IF(!storeTerminalObservation_, "terminal observations are not stored, call enableTerminalObservation(True) first")
+    for (int i = 0; i < num_envs_; i++)
+      if (done[i])
+        ob.row(i) = terminalObservation_.row(i);
+  }
+
+  /// heap allocations made by each environment during its last step (always zero unless built with RSG_COUNT_ALLOCATIONS)
+  const std::vector<long long>& getStepAllocations() const { return stepAllocations_; }
+  bool isAllocationCounterEnabled() const { return allocation_counter::enabled(); }
+
+  /// native memory of the process for memory accounting in python (RaisimGymVecEnv.native_memory_stats):
+  /// heap bytes in use, allocations of the last step summed over the envs (RSG_COUNT_ALLOCATIONS builds only)
+  /// and the number of environments / worlds that own it
+  std::map<std::string, double> getNativeMemoryStats() const {
+    std::map<std::string, double> stats;
+    stats["heap_in_use_bytes"] = double(allocation_counter::heapInUseBytes());
+    long long stepAllocations = 0;
+    for (auto allocations: stepAllocations_)
+      stepAllocations += allocations;
+    stats["step_allocations"] = double(stepAllocations);
+    stats["allocation_counter"] = allocation_counter::enabled();
+    stats["environments"] = num_envs_;
+    stats["worlds"] = numWorlds_;
+    return stats;
+  }
+
  private:
 
   inline void perAgentStep(int agentId,
                            Eigen::Ref<EigenRowMajorMat> &action,
                            Eigen::Ref<EigenVec> &reward,
                            Eigen::Ref<EigenBoolVec> &done) {
+    const long long allocationsBefore = allocation_counter::threadAllocations();
+    auto &timer = environments_[agentId]->getStepTimer();
+    const auto stepStart = timingProbes_ ? std::chrono::steady_clock::now() : std::chrono::steady_clock::time_point();
+
     reward[agentId] = environments_[agentId]->step(action.row(agentId));
 
 //    rewardInformation_[agentId] = environments_[agentId]->getRewards().getStdMap();
 
+    finishAgentStep(agentId, reward, done, allocationsBefore);
+
+    if (timingProbes_) {
+      const double seconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - stepStart).count();
+      timer.setLastStepSeconds(seconds);
+      threadBusy_[omp_get_thread_num()].seconds += seconds;
+    }
+  }
+
+  /// robots_per_world > 1: the actions of all robots of world w are applied, the world is integrated once and every robot
+  /// is evaluated as its own env. With skipDone (partial_step) the robots flagged in done keep their last targets and are
+  /// not evaluated. The integration time is recorded by the first robot of the world, the allocations of applying the
+  /// actions and of the integration are counted for the first evaluated robot.
+  inline void perWorldStep(int w,
+                           Eigen::Ref<EigenRowMajorMat> &action,
+                           Eigen::Ref<EigenVec> &reward,
+                           Eigen::Ref<EigenBoolVec> &done,
+                           bool skipDone) {
+    long long allocationsBefore = allocation_counter::threadAllocations();
+    const auto stepStart = timingProbes_ ? std::chrono::steady_clock::now() : std::chrono::steady_clock::time_point();
+
+    int running = 0;
+    for (int i = worldBegin(w); i < worldEnd(w); i++)
+      if (!(skipDone && done[i])) {
+        environments_[i]->applyAction(action.row(i));
+        running++;
+      }
+    if (running == 0)
+      return;
+
+    environments_[worldBegin(w)]->integrate();
+
+    for (int i = worldBegin(w); i < worldEnd(w); i++) {
+      if (skipDone && done[i])
+        continue;
+      reward[i] = environments_[i]->evaluateStep();
+      finishAgentStep(i, reward, done, allocationsBefore);
+      allocationsBefore = allocation_counter::threadAllocations();
+    }
+
+    if (timingProbes_) {
+      const double seconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - stepStart).count();
+      for (int i = worldBegin(w); i < worldEnd(w); i++)
+        environments_[i]->getStepTimer().setLastStepSeconds(seconds / running);
+      threadBusy_[omp_get_thread_num()].seconds += seconds;
+    }
+  }
+
+  /// terminal check and automatic reset after the step of an env
+  inline void finishAgentStep(int agentId,
+                              Eigen::Ref<EigenVec> &reward,
+                              Eigen::Ref<EigenBoolVec> &done,
+                              long long allocationsBefore) {
+    auto &timer = environments_[agentId]->getStepTimer();
     float terminalReward = 0.0;
-    done[agentId] = environments_[agentId]->isTerminalState(terminalReward);
+    {
+      ScopedStepPhase terminalPhase(timer, PHASE_TERMINAL_CHECK);
+      done[agentId] = environments_[agentId]->isTerminalState(terminalReward);
+    }
+
+    /// the automatic reset below is not part of the step path and is not counted
+    stepAllocations_[agentId] = allocation_counter::threadAllocations() - allocationsBefore;
 
     if (done[agentId]) {
-      environments_[agentId]->reset();  // automatic reset after termination
+      ScopedStepPhase resetPhase(timer, PHASE_RESET);
+      if (storeTerminalObservation_)
+        environments_[agentId]->observe(terminalObservation_.row(agentId));
+      resetAgent(agentId);  // automatic reset after termination
       reward[agentId] += terminalReward;
     }
   }
 
+  void normalizeRows(int begin, int end, Eigen::Ref<EigenRowMajorMat> &rawOb, Eigen::Ref<EigenRowMajorMat> &ob,
+                     bool updateStatistics, bool observeFirst) {
+    RSFATAL_IF(!normalizeObservation_, "native observation normalization is off, call setObservationNormalization first")
+    welfordPartials_.resize(omp_get_max_threads());
+    for (auto &partial: welfordPartials_)
+      partial.reset(obDim_);
+
+#pragma omp parallel
+    {
+      auto &partial = welfordPartials_[omp_get_thread_num()];
+#pragma omp for
+      for (int i = begin; i < end; i++) {
+        if (observeFirst)
+          environments_[i]->observe(rawOb.row(i));
+        if (updateStatistics)
+          partial.add(rawOb.row(i).transpose());
+      }
+    }
+
+    if (updateStatistics) {
+      /// batch moments from the partials, then merged into the running statistics (RunningMeanStd.update_from_moments)
+      WelfordPartial &batch = welfordPartials_[0];
+      for (size_t t = 1; t < welfordPartials_.size(); t++)
+        batch.merge(welfordPartials_[t]);
+      if (batch.count > 0.) {
+        const double total = obsCount_ + batch.count;
+        batch.delta = batch.mean - obsMean_;
+        obsMean_ += batch.delta * (batch.count / total);
+        obsVar_ = (obsVar_ * obsCount_ + batch.m2 + batch.delta.cwiseAbs2() * (obsCount_ * batch.count / total)) / total;
+        obsCount_ = total;
+      }
+    }
+
+    normalizationMean_ = obsMean_.cast<float>();
+    normalizationScale_ = (obsVar_.array() + 1e-8).rsqrt().matrix().cast<float>();
+    const float clip = observationClip_;
+#pragma omp parallel for
+    for (int i = begin; i < end; i++)
+      ob.row(i) = ((rawOb.row(i) - normalizationMean_.transpose()).cwiseProduct(normalizationScale_.transpose()))
+          .cwiseMax(-clip).cwiseMin(clip);
+  }
+
+  /// running count / mean / sum of squared deviations of the rows seen by one thread (Welford), merged with Chan's formula
+  struct alignas(64) WelfordPartial {
+    double count = 0.;
+    Eigen::VectorXd mean, m2, delta;
+
+    void reset(int dim) {
+      count = 0.;
+      mean.setZero(dim);
+      m2.setZero(dim);
+      delta.setZero(dim);
+    }
+
+    void add(const Eigen::Ref<const EigenVec> &x) {
+      count += 1.;
+      delta = x.cast<double>() - mean;
+      mean += delta / count;
+      m2 += delta.cwiseProduct(x.cast<double>() - mean);
+    }
+
+    void merge(const WelfordPartial &other) {
+      if (other.count == 0.) return;
+      const double total = count + other.count;
+      delta = other.mean - mean;
+      mean += delta * (other.count / total);
+      m2 += other.m2 + delta.cwiseAbs2() * (count * other.count / total);
+      count = total;
+    }
+  };
+
+  int worldBegin(int w) const { return w * robotsPerWorld_; }
+  int worldEnd(int w) const { return std::min((w + 1) * robotsPerWorld_, num_envs_); }
+
+  inline void resetAgent(int agentId) {
+    if (useRandomizationTable_) {
+      const long long first = (long long)agentId * randomizationDepth_;
+      const long long row = first + randomizationResets_[agentId]++ % randomizationDepth_;
+      environments_[agentId]->setRandomization(randomizationTable_.row(row),
+                                               randomizationTable_.row(perResetDynamics_ ? row : first));
+    }
+    environments_[agentId]->reset();
+  }
+
+  void useRandomizationTable(int depth) {
+    randomizationDepth_ = depth;
+    randomizationResets_.assign(num_envs_, 0);
+    useRandomizationTable_ = true;
+  }
+
+  /// called by every thread of a timed parallel region before its loop: threadBusy_ gets a slot per thread of the
+  /// actual team, which can differ from num_threads (nested regions, OMP_DYNAMIC, calls from another python thread)
+  inline void fitThreadBusyToTeam() {
+    if (!timingProbes_)
+      return;
+#pragma omp single
+    if (threadBusy_.size() < size_t(omp_get_num_threads()))
+      threadBusy_.resize(omp_get_num_threads());
+  }
+
+  /// envs with a negative last step time (skipped by partial_step) are not counted
+  void accumulateLoadImbalance() {
+    double slowest = 0., sum = 0.;
+    int stepped = 0;
+    for (auto *env: environments_) {
+      const double seconds = env->getStepTimer().getLastStepSeconds();
+      if (seconds < 0.) continue;
+      slowest = std::max(slowest, seconds);
+      sum += seconds;
+      stepped++;
+    }
+    if (stepped == 0)
+      return;
+    const double mean = sum / stepped;
+    imbalanceSteps_++;
+    slowestEnvSecondsSum_ += slowest;
+    meanEnvSecondsSum_ += mean;
+    if (mean > 0.)
+      slowestToMeanRatioSum_ += slowest / mean;
+  }
+
+  /// padded so that threads accumulating their busy time do not share a cache line
+  struct alignas(64) ThreadBusyTime {
+    double seconds = 0.;
+  };
+
   std::vector<ChildEnvironment *> environments_;
   std::vector<std::map<std::string, float>> rewardInformation_;
-
-  int num_envs_ = 1;
+  std::map<std::string, double> startupTimings_;
+  std::vector<long long> stepAllocations_;
+  std::vector<std::string> rewardNames_;
+  EigenRowMajorMat terminalObservation_;
+  EigenRowMajorMat randomizationTable_;
+  std::vector<long long> randomizationResets_;
+  int randomizationDepth_ = 1;
+  bool useRandomizationTable_ = false;
+  bool perResetDynamics_ = false;
+  bool storeTerminalObservation_ = false;
+
+  bool normalizeObservation_ = false;
+  float observationClip_ = 10.f;
+  double obsCount_ = 1e-4;
+  Eigen::VectorXd obsMean_, obsVar_;
+  EigenVec normalizationMean_, normalizationScale_;
+  std::vector<WelfordPartial> welfordPartials_;
+#ifdef RSG_WITH_TORCH
+  RolloutPolicy rolloutPolicy_;
+#endif
+
+  bool timingProbes_ = false;
+  std::vector<ThreadBusyTime> threadBusy_;
+  long long imbalanceSteps_ = 0;
+  double slowestEnvSecondsSum_ = 0., meanEnvSecondsSum_ = 0., slowestToMeanRatioSum_ = 0.;
+
+  int num_envs_ = 1, numThreads_ = 1;
+  int robotsPerWorld_ = 1, numWorlds_ = 1;
   int obDim_ = 0, actionDim_ = 0;
   bool recordVideo_=false, render_=false;
   std::string resourceDir_;
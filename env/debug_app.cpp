@@ -5,13 +5,110 @@
 
 #include "Environment.hpp"
 #include "VectorizedEnvironment.hpp"
+#include <chrono>
+#include <sstream>
+#include <numeric>
 
 using namespace raisim;
 
+/// Native benchmark of the vectorized environment (no python in the loop).
+///
+/// usage: <env>_debug_app RESOURCE_DIR CFG_FILE [options]
+///   --steps N             control steps per measurement (default 1000)
+///   --envs N              overrides num_envs of the configuration file
+///   --robots-per-world K  overrides robots_per_world of the configuration file (K envs share one world)
+///   --threads A,B,...     thread counts to measure; the first one is the scaling baseline (default: num_threads)
+///   --actions SOURCE      zero | random | path of a replay file with one action (actionDim values) per line (default random)
+///   --workload TYPE       step | reset | mixed (default step)
+///   --reset-fraction F    fraction of envs reset before every step in the mixed workload (default 0.1)
+///   --seed S              seed of the random actions, commands and resets (default 0)
+///   --output FILE         writes the JSON report to FILE instead of stdout
+///
+/// Per-phase times come from the timing probes of VectorizedEnvironment, allocations_per_step is only reported
+/// when built with RSG_COUNT_ALLOCATIONS.
+
+namespace {
+
+struct BenchmarkOptions {
+  int steps = 1000;
+  int envs = -1;
+  int robotsPerWorld = -1;
+  std::vector<int> threads;
+  std::string actions = "random";
+  std::string workload = "step";
+  double resetFraction = 0.1;
+  int seed = 0;
+  std::string output;
+};
+
+std::vector<int> parseIntList(const std::string &list) {
+  std::vector<int> values;
+  std::stringstream stream(list);
+  std::string item;
+  while (std::getline(stream, item, ','))
+    values.push_back(std::stoi(item));
+  return values;
+}
+
+BenchmarkOptions parseOptions(int argc, char *argv[]) {
+  BenchmarkOptions options;
+  for (int i = 3; i < argc; i += 2) {
+    std::string key(argv[i]);
+    RSFATAL_IF(i + 1 >= argc, key<<" needs a value")
+    std::string value(argv[i + 1]);
+
+    if (key == "--steps") options.steps = std::stoi(value);
+    else if (key == "--envs") options.envs = std::stoi(value);
+    else if (key == "--robots-per-world") options.robotsPerWorld = std::stoi(value);
+    else if (key == "--threads") options.threads = parseIntList(value);
+    else if (key == "--actions") options.actions = value;
+    else if (key == "--workload") options.workload = value;
+    else if (key == "--reset-fraction") options.resetFraction = std::stod(value);
+    else if (key == "--seed") options.seed = std::stoi(value);
+    else if (key == "--output") options.output = value;
+    else RSFATAL("unknown option "<<key)
+  }
+  RSFATAL_IF(options.workload != "step" && options.workload != "reset" && options.workload != "mixed",
+             "workload should be one of step, reset, mixed")
+  return options;
+}
+
+/// replayed actions are applied to every env, cycling through the file
+EigenRowMajorMat loadActionReplay(const std::string &fileName, int actionDim) {
+  std::ifstream file(fileName);
+  RSFATAL_IF(!file.is_open(), "cannot open the action replay "<<fileName)
+  std::vector<float> values;
+  std::string line;
+  while (std::getline(file, line)) {
+    std::stringstream stream(line);
+    float value;
+    while (stream >> value) {
+      values.push_back(value);
+      if (stream.peek() == ',') stream.ignore();
+    }
+  }
+  RSFATAL_IF(values.empty() || values.size() % actionDim != 0,
+             "the action replay should contain rows of "<<actionDim<<" values")
+  EigenRowMajorMat replay(values.size() / actionDim, actionDim);
+  std::copy(values.begin(), values.end(), replay.data());
+  return replay;
+}
+
+struct BenchmarkResult {
+  int threads;
+  double seconds, stepsPerSecond, resetsPerSecond, allocationsPerStep;
+  long long resets;
+  std::vector<double> phaseSeconds;
+  std::map<std::string, double> imbalance;
+};
+
+}
+
 int main(int argc, char *argv[]) {
-  RSFATAL_IF(argc != 3, "got "<<argc<<" arguments. "<<"This executable takes three arguments: 1. resource directory, 2. configuration file")
+  RSFATAL_IF(argc < 3, "got "<<argc<<" arguments. "<<"This executable takes at least three arguments: 1. resource directory, 2. configuration file (see debug_app.cpp for the options)")
 
   std::string resourceDir(argv[1]), cfgFile(argv[2]);
+  BenchmarkOptions options = parseOptions(argc, argv);
   std::ifstream myfile (cfgFile);
   std::string config_str, line;
   bool escape = false;
@@ -32,23 +129,168 @@ int main(int argc, char *argv[]) {
       break;
   }
   config_str.pop_back();
-  VectorizedEnvironment<ENVIRONMENT> vecEnv(resourceDir, config_str);
 
+  /// benchmark overrides: no visualization, requested env count and the largest requested thread count
   Yaml::Node config;
   Yaml::Parse(config, config_str);
+  config["render"] = "False";
+  if (options.envs > 0)
+    config["num_envs"] = std::to_string(options.envs);
+  if (options.robotsPerWorld > 0)
+    config["robots_per_world"] = std::to_string(options.robotsPerWorld);
+  if (options.threads.empty())
+    options.threads.push_back(config["num_threads"].template As<int>());
+  config["num_threads"] = std::to_string(*std::max_element(options.threads.begin(), options.threads.end()));
+  Yaml::Serialize(config, config_str);
 
-  EigenRowMajorMat observation(config["num_envs"].template As<int>(), vecEnv.getObDim());
-  EigenRowMajorMat action(config["num_envs"].template As<int>(), vecEnv.getActionDim());
-  EigenVec reward(config["num_envs"].template As<int>(), 1);
-  EigenBoolVec dones(config["num_envs"].template As<int>(), 1);
+  const auto constructionStart = std::chrono::steady_clock::now();
+  VectorizedEnvironment<ENVIRONMENT> vecEnv(resourceDir, config_str);
+  const double constructionSeconds = std::chrono::duration<double>(std::chrono::steady_clock::now() - constructionStart).count();
+
+  const int numEnvs = vecEnv.getNumOfEnvs();
+  const int actionDim = vecEnv.getActionDim();
+  const int commandPeriod = int(config["command_period"].template As<double>() / config["control_dt"].template As<double>());
+
+  EigenRowMajorMat observation(numEnvs, vecEnv.getObDim());
+  EigenRowMajorMat action(numEnvs, actionDim);
+  EigenRowMajorMat command(numEnvs, 3);
+  EigenVec reward(numEnvs, 1);
+  EigenBoolVec dones(numEnvs, 1), neededReset(numEnvs, 1);
   action.setZero();
 
-  Eigen::Ref<EigenRowMajorMat> ob_ref(observation), action_ref(action);
+  Eigen::Ref<EigenRowMajorMat> ob_ref(observation), action_ref(action), command_ref(command);
   Eigen::Ref<EigenVec> reward_ref(reward);
-  Eigen::Ref<EigenBoolVec> dones_ref(dones);
+  Eigen::Ref<EigenBoolVec> dones_ref(dones), reset_ref(neededReset);
+
+  EigenRowMajorMat replay;
+  if (options.actions != "zero" && options.actions != "random")
+    replay = loadActionReplay(options.actions, actionDim);
+
+  std::mt19937 generator(options.seed);
+  std::normal_distribution<float> normal(0.f, 1.f);
+  std::uniform_real_distribution<float> uniform01(0.f, 1.f);
+  const std::array<std::string, 3> commandNames = {"forward_vel", "lateral_vel", "yaw_rate"};
 
-  vecEnv.reset();
-  vecEnv.step(action_ref, reward_ref, dones_ref);
+  auto sampleCommand = [&]() {
+    for (int j = 0; j < 3; j++) {
+      const float low = config["command"][commandNames[j]]["min"].template As<float>();
+      const float high = config["command"][commandNames[j]]["max"].template As<float>();
+      for (int i = 0; i < numEnvs; i++)
+        command(i, j) = low + (high - low) * uniform01(generator);
+    }
+    vecEnv.set_user_command(command_ref);
+  };
+
+  auto sampleAction = [&](int step) {
+    if (options.actions == "random") {
+      for (int i = 0; i < action.size(); i++)
+        action.data()[i] = normal(generator);
+    } else if (replay.rows() > 0) {
+      action.rowwise() = replay.row(step % replay.rows());
+    }
+  };
+
+  std::vector<BenchmarkResult> results;
+  for (int threads: options.threads) {
+    omp_set_num_threads(threads);
+    vecEnv.initialize_n_step();
+    vecEnv.reset();
+    vecEnv.enableTimingProbes(true);
+    vecEnv.resetTimingProbes();
+
+    long long resets = 0;
+    double loopSeconds = 0.;
+
+    for (int step = 0; step < options.steps; step++) {
+      if (step % commandPeriod == 0)
+        sampleCommand();
+      sampleAction(step);
+
+      /// only the environment calls are timed, not the action sampling above
+      const auto start = std::chrono::steady_clock::now();
+      if (options.workload == "reset") {
+        vecEnv.initialize_n_step();
+        vecEnv.reset();
+        resets += numEnvs;
+      } else {
+        if (options.workload == "mixed") {
+          for (int i = 0; i < numEnvs; i++) {
+            neededReset[i] = uniform01(generator) < options.resetFraction;
+            resets += neededReset[i];
+          }
+          vecEnv.partial_reset(reset_ref);
+        }
+        vecEnv.step(action_ref, reward_ref, dones_ref);
+        vecEnv.observe(ob_ref);
+        resets += dones.count();
+      }
+      loopSeconds += std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+    }
+
+    EigenRowMajorMat timings(numEnvs, N_STEP_PHASES);
+    Eigen::Ref<EigenRowMajorMat> timings_ref(timings);
+    vecEnv.getStepTimings(timings_ref);
+
+    BenchmarkResult result;
+    result.threads = threads;
+    result.seconds = loopSeconds;
+    result.stepsPerSecond = options.workload == "reset" ? 0. : double(options.steps) * numEnvs / loopSeconds;
+    result.resets = resets;
+    result.resetsPerSecond = resets / loopSeconds;
+    for (int phase = 0; phase < N_STEP_PHASES; phase++)
+      result.phaseSeconds.push_back(timings.col(phase).cast<double>().sum());
+    result.imbalance = vecEnv.getLoadImbalanceStats();
+    const auto &allocations = vecEnv.getStepAllocations();
+    result.allocationsPerStep = double(std::accumulate(allocations.begin(), allocations.end(), 0LL)) / numEnvs;
+    results.push_back(result);
+  }
+
+  /// scaling efficiency relative to the first thread count: (throughput ratio) / (thread ratio)
+  auto throughput = [&](const BenchmarkResult &result) {
+    return options.workload == "reset" ? result.resetsPerSecond : result.stepsPerSecond;
+  };
+
+  std::ostringstream json;
+  json << "{\n"
+       << "  \"num_envs\": " << numEnvs << ",\n"
+       << "  \"robots_per_world\": " << vecEnv.getRobotsPerWorld() << ",\n"
+       << "  \"steps\": " << options.steps << ",\n"
+       << "  \"workload\": \"" << options.workload << "\",\n"
+       << "  \"actions\": \"" << options.actions << "\",\n"
+       << "  \"construction_time\": " << constructionSeconds << ",\n"
+       << "  \"runs\": [\n";
+  for (size_t r = 0; r < results.size(); r++) {
+    const auto &result = results[r];
+    const double efficiency = throughput(result) / throughput(results[0]) * results[0].threads / result.threads;
+    json << "    {\n"
+         << "      \"threads\": " << result.threads << ",\n"
+         << "      \"time\": " << result.seconds << ",\n"
+         << "      \"steps_per_second\": " << result.stepsPerSecond << ",\n"
+         << "      \"resets\": " << result.resets << ",\n"
+         << "      \"resets_per_second\": " << result.resetsPerSecond << ",\n"
+         << "      \"scaling_efficiency\": " << efficiency << ",\n"
+         << "      \"allocations_per_step\": " << (vecEnv.isAllocationCounterEnabled() ? std::to_string(result.allocationsPerStep) : "null") << ",\n"
+         << "      \"phase_time\": {";
+    for (int phase = 0; phase < N_STEP_PHASES; phase++)
+      json << (phase ? ", " : "") << "\"" << stepPhaseNames()[phase] << "\": " << result.phaseSeconds[phase];
+    json << "},\n"
+         << "      \"load_imbalance\": {";
+    bool first = true;
+    for (auto &stat: result.imbalance) {
+      json << (first ? "" : ", ") << "\"" << stat.first << "\": " << stat.second;
+      first = false;
+    }
+    json << "}\n"
+         << "    }" << (r + 1 < results.size() ? "," : "") << "\n";
+  }
+  json << "  ]\n}\n";
+
+  if (options.output.empty()) {
+    std::cout << json.str();
+  } else {
+    std::ofstream outputFile(options.output);
+    outputFile << json.str();
+  }
 
   return 0;
-}
\ No newline at end of file
+}
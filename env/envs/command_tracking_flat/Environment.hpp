@@ -8,6 +8,9 @@
 #include <stdlib.h>
 #include <time.h>
 #include <set>
+#include <map>
+#include <random>
+#include <sstream>
 #include "../../RaisimGymEnv.hpp"
 
 // [Tip]
@@ -30,18 +33,31 @@ namespace raisim
     {
 
     public:
-        explicit ENVIRONMENT(const std::string &resourceDir, const Yaml::Node &cfg, bool visualizable, int sample_env_type, int seed)
-        : RaisimGymEnv(resourceDir, cfg), visualizable_(visualizable)
+        explicit ENVIRONMENT(const std::string &resourceDir, const Yaml::Node &cfg, bool visualizable, int sample_env_type, int seed,
+                             const WorldSlot &slot = WorldSlot())
+        : RaisimGymEnv(resourceDir, cfg), visualizable_(visualizable), originX_(slot.x), originY_(slot.y)
         {
 
-            /// create world
-            world_ = std::make_unique<raisim::World>();
-
-            world_->addGround();
+            /// create world (or join the world of the previous robots)
+            if (slot.world) {
+                world_ = slot.world;
+            } else {
+                world_ = std::make_shared<raisim::World>();
+                world_->addGround();
+            }
             random_seed = seed;
+            generator_.seed(uint32_t(seed));
 
             /// add objects
-            anymal_ = world_->addArticulatedSystem(resourceDir_ + "/anymal_c/urdf/anymal.urdf");
+            const std::string urdfPath = resourceDir_ + "/anymal_c/urdf/anymal.urdf";
+            if (slot.robotsInWorld > 1) {
+                /// every robot of a shared world has its own collision group and only collides with itself and static objects
+                const raisim::CollisionGroup group = raisim::CollisionGroup(1) << slot.robot;  /// slot.robot < 63
+                anymal_ = world_->addArticulatedSystem(model_cache::urdf(urdfPath), model_cache::directory(urdfPath), {},
+                                                       group, group | RAISIM_STATIC_COLLISION_GROUP);
+            } else {
+                anymal_ = world_->addArticulatedSystem(model_cache::urdf(urdfPath), model_cache::directory(urdfPath));
+            }
             anymal_->setName("anymal");
             anymal_->setControlMode(raisim::ControlMode::PD_PLUS_FEEDFORWARD_TORQUE);
 
@@ -60,9 +76,15 @@ namespace raisim
             pTarget_.setZero(gcDim_);
             vTarget_.setZero(gvDim_);
             pTarget12_.setZero(nJoints_);
-            joint_position_error_history.setZero(nJoints_ * n_history_steps);
-            joint_velocity_history.setZero(nJoints_ * n_history_steps);
+            /// observation spec (channels, history depths and their offsets in the observation)
+            configureObservation(cfg["observation"]);
+            joint_position_error_history.setZero(nJoints_ * std::max(positionErrorHistorySteps_, 1));
+            joint_velocity_history.setZero(nJoints_ * std::max(velocityHistorySteps_, 1));
+            joint_position_error.setZero(nJoints_);
             GRF_impulse.setZero(4);
+            torque.setZero(gvDim_);
+            reward_log.setZero(9+1);
+            randomizationRow_.setZero(randomizationDim_);
 
             /// Add intialization for extra cost terms
             previous_action.setZero(nJoints_);
@@ -70,6 +92,7 @@ namespace raisim
             footPos_W.resize(4);
             footVel_W.resize(4);
             footContactVel_.resize(4);
+            shankPos_W.resize(4);
 
             /// Initialize user command values
             user_command.setZero(3);
@@ -103,13 +126,8 @@ namespace raisim
             total_traj_len = int(max_time / control_dt);
             command_len = int(command_period / control_dt);
 
-            /// Randomization
+            /// Randomization (applied in init)
             randomization = cfg["randomization"].template As<bool>();
-            if (randomization) {
-                /// Randomize mass and Dynamics (joint position)
-                noisify_Dynamics();
-                noisify_Mass_and_COM();
-            }
             random_initialize = cfg["random_initialize"].template As<bool>();
             random_external_force = cfg["random_external_force"].template As<bool>();
 
@@ -125,8 +143,14 @@ namespace raisim
             shank_idx[2] = anymal_->getFrameIdxByName("LH_KFE");
             shank_idx[3] = anymal_->getFrameIdxByName("RH_KFE");
 
+            /// indices used for the external force, resolved once instead of by name on every step
+            base_body_idx = anymal_->getBodyIdx("base");
+            base_frame_idx = anymal_->getFrameIdxByName("base_to_base_inertia");
+
             /// nominal configuration of anymal_c
             gc_init_ << 0, 0, 0.7, 1.0, 0.0, 0.0, 0.0, 0.03, 0.5, -0.9, -0.03, 0.5, -0.9, 0.03, -0.5, 0.9, -0.03, -0.5, 0.9;  //0.5
+            gc_init_[0] = originX_;
+            gc_init_[1] = originY_;
             random_gc_init = gc_init_; random_gv_init = gv_init_;
 
             /// set pd gains
@@ -139,11 +163,10 @@ namespace raisim
             anymal_->setGeneralizedForce(Eigen::VectorXd::Zero(gvDim_));
 
             /// MUST BE DONE FOR ALL ENVIRONMENTS
-            obDim_ = 81 + 3;
+            obDim_ = observationDim_;
             actionDim_ = nJoints_;
             actionMean_.setZero(actionDim_);
             actionStd_.setZero(actionDim_);
-            obDouble_.setZero(obDim_);
             coordinateDouble.setZero(3);
 
             /// action scaling
@@ -153,6 +176,17 @@ namespace raisim
             /// Reward coefficients
             rewards_.initializeFromConfigurationFile(cfg["reward"]);
 
+            /// Reward slots (resolved once, step() records by slot)
+            reward_joint_torque_slot = rewards_.getSlot("joint_torque");
+            reward_linear_vel_slot = rewards_.getSlot("linear_vel_error");
+            reward_angular_vel_slot = rewards_.getSlot("angular_vel_error");
+            reward_joint_vel_slot = rewards_.getSlot("joint_vel");
+            reward_foot_clearance_slot = rewards_.getSlot("foot_clearance");
+            reward_foot_slip_slot = rewards_.getSlot("foot_slip");
+            reward_previous_action_smooth_slot = rewards_.getSlot("previous_action_smooth");
+            reward_foot_z_vel_slot = rewards_.getSlot("foot_z_vel");
+            reward_orientation_slot = rewards_.getSlot("orientation");
+
             /// indices of links that should not make contact with ground
             footIndices_.insert(anymal_->getBodyIdx("LF_SHANK"));
             footIndices_.insert(anymal_->getBodyIdx("RF_SHANK"));
@@ -169,11 +203,20 @@ namespace raisim
             }
         }
 
-    void init() final {}
+    /// called once all envs are constructed (in parallel) and seeded (setEnvSeed), the randomization draws from the
+    /// generator of this env
+    void init() final {
+        if (randomization) {
+            /// Randomize mass and Dynamics (joint position)
+            noisify_Dynamics();
+            noisify_Mass_and_COM();
+        }
+    }
 
     void reset() final
     {
-        static std::default_random_engine generator(random_seed);
+        if (useRandomizationTable_ && randomization)
+            applyDynamicsRandomization();
 
         if (random_initialize) {
             if (current_n_step == 0) {
@@ -185,7 +228,7 @@ namespace raisim
                 random_axis[1] = 0;
                 random_axis[2] = 1;
                 std::uniform_real_distribution<> uniform_angle(-1, 1);
-                double random_angle = uniform_angle(generator) * M_PI;
+                double random_angle = useRandomizationTable_ ? randomizationRow_[52] : uniform_angle(generator_) * M_PI;
                 raisim::angleAxisToQuaternion(random_axis, random_angle, random_quaternion);
                 random_gc_init.segment(3, 4) = random_quaternion.e();
 
@@ -207,78 +250,110 @@ namespace raisim
 
         if (random_external_force) {
             random_force_period = int(1.0 / control_dt_);
-            std::uniform_int_distribution<> uniform_force(1, total_traj_len - random_force_period);
-            std::uniform_int_distribution<> uniform_binary(0, 1);
-            random_force_n_step = uniform_force(generator);
-            random_external_force_final = uniform_binary(generator);  /// 0: x, 1: o
-            random_external_force_direction = uniform_binary(generator);  /// 0: -1, 1: +1
+            if (useRandomizationTable_) {
+                random_force_n_step = int(randomizationRow_[53]);
+                random_external_force_final = int(randomizationRow_[54]);
+                random_external_force_direction = int(randomizationRow_[55]);
+            } else {
+                std::uniform_int_distribution<> uniform_force(1, total_traj_len - random_force_period);
+                std::uniform_int_distribution<> uniform_binary(0, 1);
+                random_force_n_step = uniform_force(generator_);
+                random_external_force_final = uniform_binary(generator_);  /// 0: x, 1: o
+                random_external_force_direction = uniform_binary(generator_);  /// 0: -1, 1: +1
+            }
         }
 
         updateObservation();
     }
 
     float step(const Eigen::Ref<EigenVec> &action) final
+    {
+        applyAction(action);
+        integrate();
+        return evaluateStep();
+    }
+
+    /// step() in three parts: with robots_per_world > 1 VectorizedEnvironment applies the actions of all robots of a world,
+    /// integrates the world once (through its first robot) and evaluates every robot
+    void applyAction(const Eigen::Ref<EigenVec> &action)
     {
         current_n_step += 1;
 
-        /// action scaling
-        pTarget12_ = action.cast<double>();
-        pTarget12_ = pTarget12_.cwiseProduct(actionStd_);
-        pTarget12_ += actionMean_;
-        target_postion = pTarget12_.cast<double>();
-        pTarget_.tail(nJoints_) = pTarget12_;
-
-        Eigen::VectorXd current_joint_position_error = pTarget12_ - gc_.tail(nJoints_);
-        updateHistory(current_joint_position_error, gv_.tail(nJoints_));
-
-        anymal_->setPdTarget(pTarget_, vTarget_);
-
-        /// Set external force to the base of the robot
-        if (random_external_force)
-            if (bool (random_external_force_final))
-                if (random_force_n_step <= current_n_step && current_n_step < random_force_n_step + random_force_period) {
-                    raisim::Mat<3, 3> baseOri;
-                    Eigen::Vector3d force_direction;
-                    anymal_->getFrameOrientation("base_to_base_inertia", baseOri);
-                    if (random_external_force_direction == 0)
-                        force_direction = {0, -1, 0};
-                    else
-                        force_direction = {0, 1, 0};
-                    force_direction = baseOri.e() * force_direction;
-                    anymal_->setExternalForce(anymal_->getBodyIdx("base"), force_direction * 50);
-                }
+        {
+            ScopedStepPhase actionPhase(stepTimer_, PHASE_ACTION);
+
+            /// action scaling (all containers are preallocated, the step path must not touch the heap)
+            pTarget12_ = action.cast<double>().cwiseProduct(actionStd_) + actionMean_;
+            target_postion = pTarget12_;
+            pTarget_.tail(nJoints_) = pTarget12_;
+
+            joint_position_error = pTarget12_ - gc_.tail(nJoints_);
+            updateHistory(joint_position_error, gv_.tail(nJoints_));
+
+            anymal_->setPdTarget(pTarget_, vTarget_);
+
+            /// Set external force to the base of the robot
+            if (random_external_force)
+                if (bool (random_external_force_final))
+                    if (random_force_n_step <= current_n_step && current_n_step < random_force_n_step + random_force_period) {
+                        raisim::Mat<3, 3> baseOri;
+                        Eigen::Vector3d force_direction;
+                        anymal_->getFrameOrientation(base_frame_idx, baseOri);
+                        if (random_external_force_direction == 0)
+                            force_direction = {0, -1, 0};
+                        else
+                            force_direction = {0, 1, 0};
+                        force_direction = baseOri.e() * force_direction;
+                        anymal_->setExternalForce(base_body_idx, force_direction * 50);
+                    }
+        }
+    }
 
+    void integrate()
+    {
         for (int i = 0; i < int(control_dt_ / simulation_dt_ + 1e-10); i++)
         {
-            if (server_)
+            if (server_) {
+                ScopedStepPhase lockPhase(stepTimer_, PHASE_VISUALIZATION_LOCK);
                 server_->lockVisualizationServerMutex();
-            world_->integrate();
+            }
+            {
+                ScopedStepPhase integratePhase(stepTimer_, PHASE_INTEGRATE);
+                world_->integrate();
+            }
             if (server_)
                 server_->unlockVisualizationServerMutex();
         }
+    }
 
+    float evaluateStep()
+    {
         updateObservation();
 
-        torque = anymal_->getGeneralizedForce().e(); // squaredNorm
+        ScopedStepPhase costPhase(stepTimer_, PHASE_COST);
+
+        torque = anymal_->getGeneralizedForce().e(); // squaredNorm (same size every step, no reallocation)
 
         calculate_cost();
 
-        rewards_.record("joint_torque", -torqueCost);
-        rewards_.record("linear_vel_error", -linvelCost);
-        rewards_.record("angular_vel_error", -angVelCost);
-        rewards_.record("joint_vel", -velLimitCost);
-        rewards_.record("foot_clearance", -footClearanceCost);
-        rewards_.record("foot_slip", -slipCost);
-        rewards_.record("previous_action_smooth", -previousActionCost);
-        rewards_.record("foot_z_vel", -footVelCost);
-        rewards_.record("orientation", -orientationCost);
+        rewards_.record(reward_joint_torque_slot, -torqueCost);
+        rewards_.record(reward_linear_vel_slot, -linvelCost);
+        rewards_.record(reward_angular_vel_slot, -angVelCost);
+        rewards_.record(reward_joint_vel_slot, -velLimitCost);
+        rewards_.record(reward_foot_clearance_slot, -footClearanceCost);
+        rewards_.record(reward_foot_slip_slot, -slipCost);
+        rewards_.record(reward_previous_action_smooth_slot, -previousActionCost);
+        rewards_.record(reward_foot_z_vel_slot, -footVelCost);
+        rewards_.record(reward_orientation_slot, -orientationCost);
 
-        previous_action = target_postion.cast<double>();
+        previous_action = target_postion;
 
         return rewards_.sum();
     }
 
     void updateObservation() {
+        ScopedStepPhase observationPhase(stepTimer_, PHASE_OBSERVATION);
+
         anymal_->getState(gc_, gv_);
         raisim::Vec<4> quat;
         raisim::Mat<3, 3> rot;
@@ -287,21 +362,16 @@ namespace raisim
         quat[2] = gc_[5];
         quat[3] = gc_[6];
         raisim::quatToRotMat(quat, rot);
-        bodyLinearVel_ = rot.e().transpose() * gv_.segment(0, 3);
-        bodyAngularVel_ = rot.e().transpose() * gv_.segment(3, 3);
+        bodyLinearVel_ = rot.e().transpose() * gv_.segment<3>(0);
+        bodyAngularVel_ = rot.e().transpose() * gv_.segment<3>(3);
 
-        obDouble_ << user_command,                     /// user command (dim=3)
-                     rot.e().row(2).transpose(),    /// body orientation (dim=3)
-                     gc_.tail(12),                  /// joint angles (dim=12)
-                     bodyLinearVel_, bodyAngularVel_,  /// body linear&angular velocity (dim=3+3=6)
-                     gv_.tail(12),                  /// joint velocity (dim=12)
-                     joint_position_error_history,     /// joint position error history (dim=24)
-                     joint_velocity_history;           /// joint velocity history (dim=24)
+        /// command seen by the observation (set_user_command takes effect at the next update, as before)
+        observedCommand_ = user_command;
 
         /// Update coordinate
         double yaw = atan2(rot.e().col(0)[1], rot.e().col(0)[0]);
 
-        coordinateDouble << gc_[0], gc_[1], yaw;
+        coordinateDouble << gc_[0] - originX_, gc_[1] - originY_, yaw;  /// relative to the origin of the robot in its world
 
         roll_and_pitch = rot.e().row(2).transpose();
         GRF_impulse.setZero(4);
@@ -310,30 +380,72 @@ namespace raisim
 
     }
 
-    void updateHistory(Eigen::VectorXd current_joint_position_error,
-                       Eigen::VectorXd current_joint_velocity)
+    void updateHistory(const Eigen::Ref<const Eigen::VectorXd> &current_joint_position_error,
+                       const Eigen::Ref<const Eigen::VectorXd> &current_joint_velocity)
     {
-        /// 0 ~ 11 : t-2 step
-        /// 12 ~ 23 : t-1 step
-        for (int i; i<n_history_steps-1; i++) {
+        /// oldest step first, the last nJoints_ entries are the latest step
+        for (int i = 0; i < int(joint_position_error_history.size()) / nJoints_ - 1; i++)
             joint_position_error_history.segment(i * nJoints_, nJoints_) = joint_position_error_history.segment((i+1) * nJoints_, nJoints_);
+        for (int i = 0; i < int(joint_velocity_history.size()) / nJoints_ - 1; i++)
             joint_velocity_history.segment(i * nJoints_, nJoints_) = joint_velocity_history.segment((i+1) * nJoints_, nJoints_);
-        }
         joint_position_error_history.tail(nJoints_) = current_joint_position_error;
         joint_velocity_history.tail(nJoints_) = current_joint_velocity;
     }
 
     void initHistory()
     {
-        joint_position_error_history.setZero(nJoints_ * n_history_steps);
-        joint_velocity_history.setZero(nJoints_ * n_history_steps);
+        joint_position_error_history.setZero();
+        joint_velocity_history.setZero();
     }
 
     void observe(Eigen::Ref<EigenVec> ob) final
     {
-        /// convert it to float
-        /// 0 - 80 : proprioceptive sensor data
-        ob = obDouble_.cast<float>();
+        /// every channel of the observation spec is written to its offset in float
+        for (const auto &segment: observationSegments_) {
+            auto out = ob.segment(segment.offset, segment.dim);
+            switch (segment.channel) {
+                case OBS_COMMAND: out = observedCommand_.cast<float>(); break;
+                case OBS_GRAVITY_AXIS: out = roll_and_pitch.cast<float>(); break;
+                case OBS_JOINT_POSITION: out = gc_.tail(nJoints_).cast<float>(); break;
+                case OBS_BODY_LINEAR_VELOCITY: out = bodyLinearVel_.cast<float>(); break;
+                case OBS_BODY_ANGULAR_VELOCITY: out = bodyAngularVel_.cast<float>(); break;
+                case OBS_JOINT_VELOCITY: out = gv_.tail(nJoints_).cast<float>(); break;
+                case OBS_JOINT_POSITION_ERROR_HISTORY: out = joint_position_error_history.tail(segment.dim).cast<float>(); break;
+                case OBS_JOINT_VELOCITY_HISTORY: out = joint_velocity_history.tail(segment.dim).cast<float>(); break;
+                default: break;
+            }
+        }
+    }
+
+    /// channel name -> (offset, dim) in the observation
+    std::map<std::string, std::pair<int, int>> getObservationLayout() const {
+        std::map<std::string, std::pair<int, int>> layout;
+        for (const auto &segment: observationSegments_)
+            layout[observationChannelNames_[segment.channel]] = {segment.offset, segment.dim};
+        return layout;
+    }
+
+    /// cfg["observation"]: channels are written in the order of ObservationChannel, plain channels take 0 (dropped) or 1,
+    /// history channels the number of past control steps. Missing entries keep the default 84-dim observation.
+    void configureObservation(const Yaml::Node &cfg) {
+        observationSegments_.clear();
+        observationDim_ = 0;
+        for (int c = 0; c < OBS_N_CHANNELS; c++) {
+            const bool history = c == OBS_JOINT_POSITION_ERROR_HISTORY || c == OBS_JOINT_VELOCITY_HISTORY;
+            const int depth = cfg[observationChannelNames_[c]].As<int>(history ? 2 : 1);
+            RSFATAL_IF(depth < 0 || (!history && depth > 1),
+                       "observation: " << observationChannelNames_[c] << " must be " << (history ? ">= 0" : "0 or 1"))
+            if (c == OBS_JOINT_POSITION_ERROR_HISTORY) positionErrorHistorySteps_ = depth;
+            if (c == OBS_JOINT_VELOCITY_HISTORY) velocityHistorySteps_ = depth;
+            if (depth == 0) continue;
+
+            int dim = nJoints_;
+            if (c == OBS_COMMAND || c == OBS_GRAVITY_AXIS || c == OBS_BODY_LINEAR_VELOCITY || c == OBS_BODY_ANGULAR_VELOCITY)
+                dim = 3;
+            observationSegments_.push_back({ObservationChannel(c), observationDim_, dim * depth});
+            observationDim_ += dim * depth;
+        }
+        RSFATAL_IF(observationDim_ == 0, "observation: no channel selected")
     }
 
     void coordinate_observe(Eigen::Ref<EigenVec> coordinate)
@@ -402,6 +514,8 @@ namespace raisim
 
     void comprehend_contacts()
     {
+        ScopedStepPhase contactsPhase(stepTimer_, PHASE_CONTACTS);
+
         numContact_ = anymal_->getContacts().size();
 
         // numFootContact_ = 0;
@@ -417,8 +531,6 @@ namespace raisim
             foot_Pos_height_map[k] = 0.;   /// Should change if it is rough terrain!!!!
             foot_Pos_difference[k] = std::abs(footPos_W[k][2] - foot_Pos_height_map[k]);
 
-            std::vector<raisim::Vec<3>> shankPos_W;
-            shankPos_W.resize(4);
             anymal_->getFramePosition(shank_idx[k], shankPos_W[k]);
             shank_Pos_difference[k] = std::abs(shankPos_W[k][2] - shank_dr);
         }
@@ -497,7 +609,7 @@ namespace raisim
     }
 
     void reward_logging(Eigen::Ref<EigenVec> rewards, Eigen::Ref<EigenVec> rewards_w_coeff, int n_rewards) {
-        reward_log.setZero(9+1);  ///////// Need to change!! Don't forget!! /////////////
+        reward_log.setZero();  ///////// Size is set in the constructor (9+1). Need to change!! Don't forget!! /////////////
         reward_log[0] = -torqueCost * reward_joint_torque_coeff;
         reward_log[1] = -linvelCost * reward_linear_vel_coeff;
         reward_log[2] = -angVelCost * reward_angular_vel_coeff;
@@ -513,18 +625,17 @@ namespace raisim
     }
 
     void noisify_Dynamics() {
-        static std::default_random_engine generator(random_seed);
         std::uniform_real_distribution<> uniform01(0.0, 1.0);
         std::uniform_real_distribution<> uniform(-1.0, 1.0);
 
         /// joint position randomization
         for (int i = 0; i < 4; i++) {
             double x_, y_, z_;
-            if (i < 2) x_ = uniform01(generator) * 0.005;
-            else x_ = -uniform01(generator) * 0.005;
+            if (i < 2) x_ = uniform01(generator_) * 0.005;
+            else x_ = -uniform01(generator_) * 0.005;
 
-            y_ = uniform(generator) * 0.01;
-            z_ = uniform(generator) * 0.01;
+            y_ = uniform(generator_) * 0.01;
+            z_ = uniform(generator_) * 0.01;
 
             int hipIdx = 3 * i + 1;
             int thighIdx = 3 * i + 2;
@@ -537,16 +648,16 @@ namespace raisim
 
 
             /// thigh
-            x_ = - uniform01(generator) * 0.01;
-            y_ = uniform(generator) * 0.01;
-            z_ = uniform(generator) * 0.01;
+            x_ = - uniform01(generator_) * 0.01;
+            y_ = uniform(generator_) * 0.01;
+            z_ = uniform(generator_) * 0.01;
 
             anymal_->getJointPos_P()[thighIdx].e()[0] = defaultJointPositions_[thighIdx][0] + x_;
             anymal_->getJointPos_P()[thighIdx].e()[1] = defaultJointPositions_[thighIdx][1] + y_;
             anymal_->getJointPos_P()[thighIdx].e()[2] = defaultJointPositions_[thighIdx][2] + z_; ///1
 
             /// shank
-            double dy_ = uniform(generator) * 0.005;
+            double dy_ = uniform(generator_) * 0.005;
             //  dy>0 -> move outwards
             if (i % 2 == 1) {
                 y_ = -dy_;
@@ -554,8 +665,8 @@ namespace raisim
                 y_ = dy_;
             }
 
-            x_ = uniform(generator) * 0.01;
-            z_ = uniform(generator) * 0.01;
+            x_ = uniform(generator_) * 0.01;
+            z_ = uniform(generator_) * 0.01;
 
             anymal_->getJointPos_P()[shankIdx].e()[0] = defaultJointPositions_[shankIdx][0] + x_;
             anymal_->getJointPos_P()[shankIdx].e()[1] = defaultJointPositions_[shankIdx][1] + y_;
@@ -565,33 +676,125 @@ namespace raisim
     }
 
     void noisify_Mass_and_COM() {
-        static std::default_random_engine generator(random_seed);
         std::uniform_real_distribution<> uniform(-1.0, 1.0);
 
         /// base mass
-        anymal_->getMass()[0] = defaultBodyMasses_[0] * (1 + 0.15 * uniform(generator));
+        anymal_->getMass()[0] = defaultBodyMasses_[0] * (1 + 0.15 * uniform(generator_));
 
         /// hip mass
         for (int i = 1; i < 13; i += 3) {
-            anymal_->getMass()[i] = defaultBodyMasses_[i] * (1 + 0.15 * uniform(generator));
+            anymal_->getMass()[i] = defaultBodyMasses_[i] * (1 + 0.15 * uniform(generator_));
         }
 
         /// thigh mass
         for (int i = 2; i < 13; i += 3) {
-            anymal_->getMass()[i] = defaultBodyMasses_[i] * (1 + 0.15 * uniform(generator));
+            anymal_->getMass()[i] = defaultBodyMasses_[i] * (1 + 0.15 * uniform(generator_));
         }
 
         /// shank mass
         for (int i = 3; i < 13; i += 3) {
-            anymal_->getMass()[i] = defaultBodyMasses_[i] * (1 + 0.04 * uniform(generator));
+            anymal_->getMass()[i] = defaultBodyMasses_[i] * (1 + 0.04 * uniform(generator_));
         }
 
         anymal_->updateMassInfo();
 
         /// COM position
         for (int i = 0; i < 3; i++) {
-            anymal_->getBodyCOM_B()[0].e()[i] = COMPosition_[i] + uniform(generator) * 0.01;
+            anymal_->getBodyCOM_B()[0].e()[i] = COMPosition_[i] + uniform(generator_) * 0.01;
+        }
+    }
+
+    /// Pre-sampled randomization (VectorizedEnvironment::sampleRandomizationTable), one table row per reset:
+    /// 0-35: joint position offsets (hip, thigh, shank of LF, RF, LH, RH, xyz), 36-48: link mass scales,
+    /// 49-51: base COM offset, 52: initial yaw angle, 53-55: external force start step, on/off, direction.
+    /// The distributions are those of noisify_Dynamics, noisify_Mass_and_COM and reset.
+    int getRandomizationDim() const { return randomizationDim_; }
+
+    static std::vector<std::string> getRandomizationNames() {
+        std::vector<std::string> names;
+        const std::array<std::string, 4> legs = {"LF", "RF", "LH", "RH"};
+        const std::array<std::string, 3> joints = {"hip", "thigh", "shank"}, axes = {"x", "y", "z"};
+        for (auto &leg: legs)
+            for (auto &joint: joints)
+                for (auto &axis: axes)
+                    names.push_back(leg + "_" + joint + "_offset_" + axis);
+        for (int i = 0; i < 13; i++)
+            names.push_back("mass_scale_" + std::to_string(i));
+        for (auto &axis: axes)
+            names.push_back("base_com_offset_" + axis);
+        names.insert(names.end(), {"init_yaw", "external_force_step", "external_force_on", "external_force_direction"});
+        return names;
+    }
+
+    /// const and independent of the env state, so that rows can be sampled in parallel
+    void sampleRandomization(std::mt19937 &generator, Eigen::Ref<EigenVec> row) const {
+        std::uniform_real_distribution<> uniform01(0.0, 1.0);
+        std::uniform_real_distribution<> uniform(-1.0, 1.0);
+
+        for (int i = 0; i < 4; i++) {
+            /// hip
+            row[9 * i] = float((i < 2 ? 1. : -1.) * uniform01(generator) * 0.005);
+            row[9 * i + 1] = float(uniform(generator) * 0.01);
+            row[9 * i + 2] = float(uniform(generator) * 0.01);
+            /// thigh
+            row[9 * i + 3] = float(-uniform01(generator) * 0.01);
+            row[9 * i + 4] = float(uniform(generator) * 0.01);
+            row[9 * i + 5] = float(uniform(generator) * 0.01);
+            /// shank (dy>0 -> move outwards)
+            const double dy_ = uniform(generator) * 0.005;
+            row[9 * i + 7] = float(i % 2 == 1 ? -dy_ : dy_);
+            row[9 * i + 6] = float(uniform(generator) * 0.01);
+            row[9 * i + 8] = float(uniform(generator) * 0.01);
         }
+
+        /// base, hip and thigh masses +-15%, shank masses +-4%
+        for (int i = 0; i < 13; i++)
+            row[36 + i] = float(1. + (i > 0 && i % 3 == 0 ? 0.04 : 0.15) * uniform(generator));
+
+        for (int i = 0; i < 3; i++)
+            row[49 + i] = float(uniform(generator) * 0.01);
+
+        row[52] = float(uniform(generator) * M_PI);
+
+        const int force_period = int(1.0 / control_dt_);
+        std::uniform_int_distribution<> uniform_force(1, total_traj_len - force_period);
+        std::uniform_int_distribution<> uniform_binary(0, 1);
+        row[53] = float(uniform_force(generator));
+        row[54] = float(uniform_binary(generator));
+        row[55] = float(uniform_binary(generator));
+    }
+
+    /// applied by the next reset: the dynamics (joint offsets, masses, COM, columns 0-51) of dynamicsRow, the initial yaw
+    /// and external force (columns 52-55) of row
+    void setRandomization(const Eigen::Ref<const EigenVec> &row, const Eigen::Ref<const EigenVec> &dynamicsRow) {
+        randomizationRow_ = row.cast<double>();
+        randomizationRow_.head(randomizationDynamicsDim_) = dynamicsRow.head(randomizationDynamicsDim_).cast<double>();
+        useRandomizationTable_ = true;
+    }
+
+    void setEnvSeed(int seed, int envId) final {
+        /// seeded like the rows of the randomization table, so that the envs draw independent streams
+        std::seed_seq seedSequence{seed, envId};
+        generator_.seed(seedSequence);
+    }
+
+    void disableRandomizationTable() { useRandomizationTable_ = false; }
+
+    void applyDynamicsRandomization() {
+        for (int i = 0; i < 4; i++)
+            for (int j = 0; j < 3; j++) {
+                const int jointIdx = 3 * i + j + 1;
+                for (int k = 0; k < 3; k++)
+                    anymal_->getJointPos_P()[jointIdx].e()[k] = defaultJointPositions_[jointIdx][k] + randomizationRow_[9 * i + 3 * j + k];
+            }
+
+        for (int i = 0; i < 13; i++)
+            anymal_->getMass()[i] = defaultBodyMasses_[i] * randomizationRow_[36 + i];
+
+        for (int i = 0; i < 3; i++)
+            anymal_->getBodyCOM_B()[0].e()[i] = COMPosition_[i] + randomizationRow_[49 + i];
+
+        anymal_->updateMassInfo();
     }
 
     void contact_logging(Eigen::Ref<EigenVec> contacts)
@@ -651,13 +854,36 @@ namespace raisim
         costScale2_ = std::pow(costScale2_, 0.9997);
     }
 
+    /// cost scales of the curriculum, saved and restored with training snapshots
+    std::vector<double> getCurriculumState() const { return {costScale_, costScale2_}; }
+
+    void setCurriculumState(const std::vector<double> &state) {
+        RSFATAL_IF(state.size() != 2, "the curriculum state holds costScale and costScale2")
+        costScale_ = state[0];
+        costScale2_ = state[1];
+    }
+
+    /// state of the reset generator (std::mt19937 text form), to continue training with the same reset sequence
+    std::string getGeneratorState() const {
+        std::ostringstream state;
+        state << generator_;
+        return state.str();
+    }
+
+    void setGeneratorState(const std::string &state) {
+        std::istringstream stream(state);
+        stream >> generator_;
+        RSFATAL_IF(stream.fail(), "invalid reset generator state")
+    }
+
     private:
         int gcDim_, gvDim_, nJoints_;
         bool visualizable_ = false;
+        double originX_ = 0., originY_ = 0.;
         raisim::ArticulatedSystem *anymal_;
         Eigen::VectorXd gc_init_, gv_init_, gc_, gv_, pTarget_, pTarget12_, vTarget_;
         double terminalRewardCoeff_ = -10.;
-        Eigen::VectorXd actionMean_, actionStd_, obDouble_;
+        Eigen::VectorXd actionMean_, actionStd_;
         Eigen::Vector3d bodyLinearVel_, bodyAngularVel_;
         std::set<size_t> footIndices_;
 
@@ -669,6 +895,7 @@ namespace raisim
         std::vector<raisim::Vec<3>> footPos_;
         std::vector<raisim::Vec<3>> footPos_W;
         std::vector<raisim::Vec<3>> footVel_W;
+        std::vector<raisim::Vec<3>> shankPos_W;
         std::vector<Eigen::Vector3d> footContactVel_;
         std::array<bool, 4> footContactState_;
         double costScale_ = 0.3, costScale2_ = 0.3;
@@ -676,11 +903,27 @@ namespace raisim
         double previousActionCost = 0, footVelCost = 0, orientationCost = 0, cost;
         double reward_joint_torque_coeff, reward_linear_vel_coeff, reward_angular_vel_coeff, reward_joint_vel_coeff, reward_foot_clearance_coeff;
         double reward_foot_slip_coeff, reward_previous_action_smooth_coeff, reward_foot_z_vel_coeff, reward_orientation_coeff;
+        size_t reward_joint_torque_slot, reward_linear_vel_slot, reward_angular_vel_slot, reward_joint_vel_slot, reward_foot_clearance_slot;
+        size_t reward_foot_slip_slot, reward_previous_action_smooth_slot, reward_foot_z_vel_slot, reward_orientation_slot;
         int yaw_scanSize, pitch_scanSize;
         raisim::HeightMap* hm;
         Eigen::Vector4d foot_Pos_difference, shank_Pos_difference;
-        int n_history_steps = 2;
-        Eigen::VectorXd joint_position_error_history, joint_velocity_history, GRF_impulse;
+
+        /// Observation spec
+        enum ObservationChannel {
+            OBS_COMMAND = 0, OBS_GRAVITY_AXIS, OBS_JOINT_POSITION, OBS_BODY_LINEAR_VELOCITY, OBS_BODY_ANGULAR_VELOCITY,
+            OBS_JOINT_VELOCITY, OBS_JOINT_POSITION_ERROR_HISTORY, OBS_JOINT_VELOCITY_HISTORY, OBS_N_CHANNELS
+        };
+        static constexpr const char *observationChannelNames_[OBS_N_CHANNELS] = {
+            "command", "gravity_axis", "joint_position", "body_linear_velocity", "body_angular_velocity",
+            "joint_velocity", "joint_position_error_history", "joint_velocity_history"
+        };
+        struct ObservationSegment { ObservationChannel channel; int offset; int dim; };
+        std::vector<ObservationSegment> observationSegments_;
+        int observationDim_ = 0, positionErrorHistorySteps_ = 2, velocityHistorySteps_ = 2;
+        Eigen::Vector3d observedCommand_ = Eigen::Vector3d::Zero();
+        Eigen::VectorXd joint_position_error_history, joint_velocity_history, joint_position_error, GRF_impulse;
+        size_t base_body_idx, base_frame_idx;
 
         /// Randomization
         bool randomization = false, random_initialize = false, random_external_force = false;
@@ -689,6 +932,11 @@ namespace raisim
         std::vector<double> defaultBodyMasses_;
         raisim::Vec<3> COMPosition_;
 
+        /// Pre-sampled randomization
+        static constexpr int randomizationDim_ = 56, randomizationDynamicsDim_ = 52;
+        Eigen::VectorXd randomizationRow_;
+        bool useRandomizationTable_ = false;
+
         /// Randon intialization & Random external force
         Eigen::VectorXd random_gc_init, random_gv_init, current_random_gc_init, current_random_gv_init;
         int random_init_n_step = 0, random_force_n_step = 0, random_force_period = 100, current_n_step = 0;
@@ -697,8 +945,9 @@ namespace raisim
         double min_forward_vel, max_forward_vel, min_lateral_vel, max_lateral_vel, min_yaw_rate, max_yaw_rate;
         int total_traj_len, command_len;
 
-        /// Seed
+        /// Seed, generator of the randomization without the table (init) and of the resets
         int random_seed;
+        std::mt19937 generator_;
 
         /// Observation to be predicted
         Eigen::VectorXd coordinateDouble;
@@ -0,0 +1,293 @@
+"""
+Throughput autotuner: sweeps num_envs / num_threads (cfg.yaml environment), torch intra-op threads and the number of
+minibatches (cfg.yaml learner) with short timed runs and recommends the combination with the highest end-to-end
+throughput (transitions per second of wall time over rollout + update).
+
+Rollouts are timed for every (num_envs, num_threads, torch threads) over rollout_steps steps (after a warm-up) and
+extrapolated to the max_time / control_dt steps of an iteration. The PPO update is timed for every
+(num_envs, torch threads, minibatches) on a full-size rollout buffer filled with synthetic transitions
+(the update cost does not depend on the data). --learner_only skips the environment and only sweeps the learner.
+
+num_envs and the minibatch count also change the PPO batch and the number of gradient steps: only pass candidates
+that are acceptable for training.
+
+The learner is timed with the update path of cfg.yaml (learner: compile_update). --compare_update additionally runs the
+eager and the compiled update on the same minibatches and reports their parity and speedup.
+
+    python raisimGymTorch/env/envs/command_tracking_flat/autotune.py --num_envs 250 500 1000 --num_threads 6 12 24
+    python raisimGymTorch/env/envs/command_tracking_flat/autotune.py --learner_only
+    python raisimGymTorch/env/envs/command_tracking_flat/autotune.py --learner_only --compare_update
+"""
+from ruamel.yaml import YAML, dump, RoundTripDumper
+from raisimGymTorch.helper.raisim_gym_helper import UserCommand
+import raisimGymTorch.algo.ppo.module as ppo_module
+import raisimGymTorch.algo.ppo.ppo as PPO
+from raisimGymTorch.algo.ppo.update import benchmark_update
+import os
+import gc
+import sys
+import copy
+import math
+import time
+import socket
+import tempfile
+import argparse
+import itertools
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def thread_candidates(n_cores):
+    return sorted({max(1, n_cores // 4), max(1, n_cores // 2), n_cores})
+
+
+def make_env(cfg, home_path, num_envs, num_threads):
+    from raisimGymTorch.env.bin import command_tracking_flat
+    from raisimGymTorch.env.RaisimGymVecEnv import RaisimGymVecEnv as VecEnv
+
+    env_cfg = copy.deepcopy(cfg['environment'])
+    env_cfg['num_envs'] = num_envs
+    env_cfg['num_threads'] = num_threads
+    env_cfg['render'] = False
+    return VecEnv(command_tracking_flat.RaisimGymEnv(home_path + "/rsc", dump(env_cfg, Dumper=RoundTripDumper)), env_cfg)
+
+
+def make_ppo(cfg, num_envs, n_steps, ob_dim, act_dim, num_mini_batches):
+    actor = ppo_module.Actor(ppo_module.MLP(cfg['architecture']['policy_net'], nn.LeakyReLU, ob_dim, act_dim),
+                             ppo_module.MultivariateGaussianDiagonalCovariance(act_dim, 1.0))
+    critic = ppo_module.Critic(ppo_module.MLP(cfg['architecture']['value_net'], nn.LeakyReLU, ob_dim, 1))
+    return PPO.PPO(actor=actor, critic=critic, num_envs=num_envs, num_transitions_per_env=n_steps,
+                   num_learning_epochs=cfg['learner']['num_learning_epochs'], num_mini_batches=num_mini_batches,
+                   gamma=0.9988, lam=0.95, log_dir=tempfile.gettempdir(), shuffle_batch=False, shared_obs=True,
+                   compile_update=cfg['learner']['compile_update'])
+
+
+def time_rollout(env, ppo, user_command, n_steps, command_period_steps, warmup=10):
+    """
+    :return: wall time per step of the rollout loop (observe, inference, step, storage) and of env.step alone [s]
+    """
+    env.initialize_n_step()
+    env.reset()
+    step_time = 0.
+    for step in range(warmup + n_steps):
+        if step == warmup:
+            start = time.time()
+            step_time = 0.
+        if step % command_period_steps == 0:
+            env.set_user_command(user_command.uniform_sample_train())
+        obs, _ = env.observe()
+        action = ppo.observe(obs)
+        step_start = time.time()
+        reward, dones = env.step(action)
+        step_time += time.time() - step_start
+        if step >= warmup:
+            ppo.step(value_obs=obs, rews=reward, dones=dones)
+    rollout_time = time.time() - start
+    ppo.storage.clear()
+    return rollout_time / n_steps, step_time / n_steps
+
+
+def time_update(ppo, ob_dim):
+    """
+    :return: wall time of one PPO update over the full rollout buffer, filled with synthetic transitions [s]
+    """
+    storage = ppo.storage
+    obs = np.random.randn(storage.num_envs, ob_dim).astype(np.float32)
+
+    def fill():
+        storage.actor_obs.normal_()
+        storage.actions.normal_()
+        storage.rewards.normal_()
+        storage.dones.zero_()
+        storage.values.normal_()
+        storage.actions_log_prob.fill_(-12.)
+        storage.step = storage.num_transitions_per_env
+
+    # the first update allocates the minibatch buffers
+    fill()
+    ppo.update(actor_obs=obs, value_obs=obs, log_this_iteration=False, update=0)
+    fill()
+    start = time.time()
+    ppo.update(actor_obs=obs, value_obs=obs, log_this_iteration=False, update=0)
+    return time.time() - start
+
+
+def compare_update(cfg, num_envs, n_steps, ob_dim, act_dim, mini_batches, n_batches=4, n_repeats=5):
+    """
+    Eager vs compiled minibatch update (algo/ppo/update.py) at the minibatch size of num_envs * n_steps / mini_batches.
+
+    :return: result of benchmark_update
+    """
+    actor = ppo_module.Actor(ppo_module.MLP(cfg['architecture']['policy_net'], nn.LeakyReLU, ob_dim, act_dim),
+                             ppo_module.MultivariateGaussianDiagonalCovariance(act_dim, 1.0))
+    critic = ppo_module.Critic(ppo_module.MLP(cfg['architecture']['value_net'], nn.LeakyReLU, ob_dim, 1))
+    batch_size = num_envs * n_steps // mini_batches
+    batches = []
+    for _ in range(n_batches):
+        obs = torch.randn(batch_size, ob_dim)
+        batches.append((obs, obs, torch.randn(batch_size, act_dim), torch.randn(batch_size, 1), torch.randn(batch_size, 1),
+                        torch.randn(batch_size, 1), torch.randn(batch_size, 1) - 10.))
+    return benchmark_update(actor, critic, batches, n_repeats=n_repeats,
+                            clip_param=0.2, value_loss_coef=0.5, entropy_coef=0.0, use_clipped_value_loss=True)
+
+
+def scaling_rows(results, knob, key, fixed):
+    """
+    Speedup and parallel efficiency of `key` over the thread count `knob`, the other knobs fixed to `fixed`.
+    """
+    rows = sorted((result for result in results if all(result[name] == value for name, value in fixed.items())),
+                  key=lambda result: result[knob])
+    if not rows:
+        return []
+    base = rows[0]
+    return [(row[knob], row[key], row[key] / base[key], (row[key] / base[key]) / (row[knob] / base[knob])) for row in rows]
+
+
+def print_scaling(title, knob, rows):
+    if not rows:
+        return
+    print(title)
+    print('{:>14} {:>14} {:>10} {:>12}'.format(knob, 'per second', 'speedup', 'efficiency'))
+    for value, throughput, speedup, efficiency in rows:
+        print('{:>14} {:>14.0f} {:>10.2f} {:>12.2f}'.format(value, throughput, speedup, efficiency))
+    print()
+
+
+if __name__ == '__main__':
+    task_path = os.path.dirname(os.path.realpath(__file__))
+    home_path = task_path + "/../../../../.."
+    cfg = YAML().load(open(task_path + "/cfg.yaml", 'r'))
+    n_cores = os.cpu_count()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_envs', type=int, nargs='+', default=None, help="default: cfg num_envs / 2, * 1, * 2")
+    parser.add_argument('--num_threads', type=int, nargs='+', default=None, help="environment threads, default: cores / 4, / 2, * 1")
+    parser.add_argument('--torch_threads', type=int, nargs='+', default=None, help="default: cores / 4, / 2, * 1")
+    parser.add_argument('--mini_batches', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--rollout_steps', type=int, default=100, help="timed rollout steps per configuration")
+    parser.add_argument('--learner_only', action='store_true', help="only sweep torch threads and minibatches (no environment)")
+    parser.add_argument('--ob_dim', type=int, default=84, help="observation dim of --learner_only")
+    parser.add_argument('--act_dim', type=int, default=12, help="action dim of --learner_only")
+    parser.add_argument('--compare_update', action='store_true', help="eager vs compiled minibatch update at the best setting")
+    parser.add_argument('--output', type=str, default='', help="default: autotune_<hostname>.yaml next to cfg.yaml")
+    args = parser.parse_args()
+
+    num_envs_candidates = args.num_envs or sorted({max(1, cfg['environment']['num_envs'] // 2), cfg['environment']['num_envs'],
+                                                  cfg['environment']['num_envs'] * 2})
+    num_threads_candidates = args.num_threads or thread_candidates(n_cores)
+    torch_threads_candidates = args.torch_threads or thread_candidates(n_cores)
+    output = args.output or task_path + "/autotune_" + socket.gethostname() + ".yaml"
+
+    n_steps = math.floor(cfg['environment']['max_time'] / cfg['environment']['control_dt'])
+    command_period_steps = math.floor(cfg['environment']['command_period'] / cfg['environment']['control_dt'])
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    # rollouts: environment threads x torch threads (inference) for every num_envs
+    rollout_results = []
+    ob_dim, act_dim = args.ob_dim, args.act_dim
+    if not args.learner_only:
+        for num_envs, num_threads in itertools.product(num_envs_candidates, num_threads_candidates):
+            env = make_env(cfg, home_path, num_envs, num_threads)
+            ob_dim, act_dim = env.num_obs, env.num_acts
+            user_command = UserCommand(cfg, num_envs)
+            for torch_threads in torch_threads_candidates:
+                torch.set_num_threads(torch_threads)
+                ppo = make_ppo(cfg, num_envs, args.rollout_steps, ob_dim, act_dim, cfg['learner']['num_mini_batches'])
+                rollout_time, step_time = time_rollout(env, ppo, user_command, args.rollout_steps, command_period_steps)
+                rollout_results.append({'num_envs': num_envs, 'num_threads': num_threads, 'torch_threads': torch_threads,
+                                        'rollout_step_time': rollout_time,
+                                        'env_steps_per_second': num_envs / step_time,
+                                        'rollout_steps_per_second': num_envs / rollout_time})
+                print('rollout  num_envs {:>5}  num_threads {:>3}  torch_threads {:>3}  env steps/s {:>10.0f}  rollout steps/s {:>10.0f}'
+                      .format(num_envs, num_threads, torch_threads, num_envs / step_time, num_envs / rollout_time))
+            env.close()
+            del env
+            gc.collect()
+
+    # learner: torch threads x minibatches for every num_envs, full-size rollout buffer
+    learner_results = []
+    for num_envs, torch_threads, mini_batches in itertools.product(num_envs_candidates, torch_threads_candidates, args.mini_batches):
+        torch.set_num_threads(torch_threads)
+        ppo = make_ppo(cfg, num_envs, n_steps, ob_dim, act_dim, mini_batches)
+        update_time = time_update(ppo, ob_dim)
+        learner_results.append({'num_envs': num_envs, 'torch_threads': torch_threads, 'mini_batches': mini_batches,
+                                'update_time': update_time,
+                                'learner_samples_per_second': num_envs * n_steps / update_time})
+        print('learner  num_envs {:>5}  torch_threads {:>3}  mini_batches {:>3}  samples/s {:>10.0f}  update {:>8.3f} s'
+              .format(num_envs, torch_threads, mini_batches, num_envs * n_steps / update_time, update_time))
+        del ppo
+        gc.collect()
+
+    # end to end: rollout of n_steps + update
+    iteration_results = []
+    if rollout_results:
+        for rollout, learner in itertools.product(rollout_results, learner_results):
+            if rollout['num_envs'] != learner['num_envs'] or rollout['torch_threads'] != learner['torch_threads']:
+                continue
+            iteration_time = rollout['rollout_step_time'] * n_steps + learner['update_time']
+            iteration_results.append({'num_envs': rollout['num_envs'], 'num_threads': rollout['num_threads'],
+                                      'torch_threads': rollout['torch_threads'], 'mini_batches': learner['mini_batches'],
+                                      'iteration_time': iteration_time,
+                                      'samples_per_second': rollout['num_envs'] * n_steps / iteration_time})
+        best = max(iteration_results, key=lambda result: result['samples_per_second'])
+    else:
+        best = max(learner_results, key=lambda result: result['learner_samples_per_second'])
+
+    print('\n----------------------------------------------------')
+    if iteration_results:
+        print('end to end (top 10)')
+        print('{:>10} {:>12} {:>14} {:>13} {:>16} {:>14}'.format('num_envs', 'num_threads', 'torch_threads', 'mini_batches',
+                                                                 'iteration [s]', 'samples/s'))
+        for result in sorted(iteration_results, key=lambda result: -result['samples_per_second'])[:10]:
+            print('{:>10} {:>12} {:>14} {:>13} {:>16.2f} {:>14.0f}'.format(result['num_envs'], result['num_threads'], result['torch_threads'],
+                                                                          result['mini_batches'], result['iteration_time'],
+                                                                          result['samples_per_second']))
+        print()
+        print_scaling('environment threads (num_envs {}, torch_threads {})'.format(best['num_envs'], best['torch_threads']), 'num_threads',
+                      scaling_rows(rollout_results, 'num_threads', 'env_steps_per_second',
+                                   {'num_envs': best['num_envs'], 'torch_threads': best['torch_threads']}))
+        print_scaling('num_envs (num_threads {}, torch_threads {})'.format(best['num_threads'], best['torch_threads']), 'num_envs',
+                      scaling_rows(rollout_results, 'num_envs', 'env_steps_per_second',
+                                   {'num_threads': best['num_threads'], 'torch_threads': best['torch_threads']}))
+    print_scaling('learner torch threads (num_envs {}, mini_batches {})'.format(best['num_envs'], best['mini_batches']), 'torch_threads',
+                  scaling_rows(learner_results, 'torch_threads', 'learner_samples_per_second',
+                               {'num_envs': best['num_envs'], 'mini_batches': best['mini_batches']}))
+
+    recommended = {'environment': {'num_envs': best['num_envs']},
+                   'learner': {'num_learning_epochs': cfg['learner']['num_learning_epochs'],
+                               'num_mini_batches': best['mini_batches'],
+                               'torch_threads': best['torch_threads']}}
+    if 'num_threads' in best:
+        recommended['environment']['num_threads'] = best['num_threads']
+        recommended['estimated'] = {'iteration_time': float(best['iteration_time']), 'samples_per_second': float(best['samples_per_second'])}
+    update_comparison = None
+    if args.compare_update:
+        torch.set_num_threads(best['torch_threads'])
+        update_comparison = compare_update(cfg, best['num_envs'], n_steps, ob_dim, act_dim, best['mini_batches'])
+        print('eager vs compiled update (num_envs {}, mini_batches {}, torch_threads {})'
+              .format(best['num_envs'], best['mini_batches'], best['torch_threads']))
+        print('{:>14} {:>14} {:>10} {:>16} {:>16}'.format('eager [ms]', 'compiled [ms]', 'speedup', 'parameter error', 'loss error'))
+        print('{:>14.3f} {:>14.3f} {:>10.2f} {:>16.2e} {:>16.2e}'.format(update_comparison['eager_time'] * 1e3,
+                                                                       update_comparison['fused_time'] * 1e3,
+                                                                       update_comparison['speedup'],
+                                                                       update_comparison['max_parameter_error'],
+                                                                       update_comparison['max_loss_error']))
+        if not update_comparison['parity']:
+            print('the compiled update does not match the eager update, keep compile_update: False')
+        print()
+        recommended['learner']['compile_update'] = bool(update_comparison['parity'] and update_comparison['speedup'] > 1.)
+
+    print('recommended (cfg.yaml):')
+    YAML().dump(recommended, sys.stdout)
+    print('----------------------------------------------------\n')
+
+    with open(output, 'w') as file:
+        YAML().dump({'host': {'hostname': socket.gethostname(), 'cores': n_cores, 'torch': torch.__version__},
+                     'recommended': recommended,
+                     'rollout': rollout_results,
+                     'learner': learner_results,
+                     'iteration': iteration_results,
+                     'update_comparison': update_comparison}, file)
+    print("report written to " + output)
@@ -0,0 +1,126 @@
+from ruamel.yaml import YAML, dump, RoundTripDumper
+from raisimGymTorch.env.bin import command_tracking_flat
+from raisimGymTorch.env.RaisimGymVecEnv import RaisimGymVecEnv as VecEnv
+from raisimGymTorch.helper.raisim_gym_helper import UserCommand
+from raisimGymTorch.helper.rollout_dataset import RolloutDataset
+from raisimGymTorch.helper.distillation import DistillationData, StudentDistiller, collect_teacher_rollout, measure_inference_latency
+import raisimGymTorch.algo.ppo.module as ppo_module
+import os
+import math
+import torch
+import torch.nn as nn
+import argparse
+import numpy as np
+
+
+# Distills a trained actor into smaller MLPs (and optionally a TCN) and compares their onboard latency and tracking error:
+#   python raisimGymTorch/env/envs/command_tracking_flat/distill.py -w <run>/full_16200.pt --students 64,64 32,32 --tcn
+#   python raisimGymTorch/env/envs/command_tracking_flat/distill.py -w <run>/full_16200.pt --dataset <run>/rollouts
+# The students are written to <run>/distill/<student>/full_<iteration>.pt with the teacher's mean / var next to them.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-w', '--weight', help='teacher weight path', type=str, default='')
+parser.add_argument('--students', help='hidden layer sizes of the MLP students, e.g. 64,64 32', type=str, nargs='*', default=['64,64', '32,32'])
+parser.add_argument('--tcn', help='also distill a TCN student (architecture: tcn of cfg.yaml, policy_net head of the first student)',
+                    action='store_true')
+parser.add_argument('--dataset', help='exported rollouts (rollout_export of cfg.yaml) instead of collecting on the env', type=str, default='')
+parser.add_argument('--collect_periods', help='command periods collected with the teacher', type=int, default=20)
+parser.add_argument('--epochs', type=int, default=30)
+parser.add_argument('--batch_size', type=int, default=4096)
+parser.add_argument('--learning_rate', type=float, default=1e-3)
+parser.add_argument('--num_envs', help='overrides num_envs of cfg.yaml', type=int, default=0)
+parser.add_argument('--periods', help='command periods of the tracking evaluation', type=int, default=4)
+parser.add_argument('--latency_threads', help='torch threads of the latency measurement (onboard CPU budget)', type=int, default=1)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--output', help='student directory (default: <run>/distill)', type=str, default='')
+args = parser.parse_args()
+
+assert args.weight != '', "Provide the teacher with --weight"
+
+np.random.seed(args.seed)
+torch.manual_seed(args.seed)
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+task_path = os.path.dirname(os.path.realpath(__file__))
+home_path = task_path + "/../../../../.."
+
+cfg = YAML().load(open(task_path + "/cfg.yaml", 'r'))
+cfg['environment']['render'] = False
+if args.num_envs > 0:
+    cfg['environment']['num_envs'] = args.num_envs
+
+env = VecEnv(command_tracking_flat.RaisimGymEnv(home_path + "/rsc", dump(cfg['environment'], Dumper=RoundTripDumper)), cfg['environment'],
+             normalize_ob=False)
+ob_dim = env.num_obs
+act_dim = env.num_acts
+command_period_steps = math.floor(cfg['environment']['command_period'] / cfg['environment']['control_dt'])
+user_command = UserCommand(cfg, env.num_envs)
+output_dir = args.output if args.output != '' else os.path.join(os.path.dirname(args.weight), "distill")
+
+distiller = StudentDistiller(args.weight, device=device)
+
+# training data: normalized observations visited by the teacher
+students = [('mlp_' + sizes.replace(',', '_'), [int(size) for size in sizes.split(',')]) for sizes in args.students]
+window = 1
+if args.tcn:
+    tcn_student = ppo_module.TCN(cfg['architecture']['tcn']['channels'], cfg['architecture']['tcn']['kernel_size'], students[0][1],
+                                 nn.LeakyReLU, ob_dim, act_dim, window=cfg['architecture']['tcn']['window'])
+    window = tcn_student.window
+data = DistillationData(window)
+if args.dataset != '':
+    data.add_rollout_dataset(RolloutDataset(args.dataset), distiller.obs_mean.cpu().numpy(), distiller.obs_std.cpu().numpy(),
+                             clip_obs=distiller.clip_obs)
+else:
+    obs, dones = collect_teacher_rollout(env, distiller.teacher, distiller.obs_mean, distiller.obs_std,
+                                         args.collect_periods * command_period_steps, user_command, command_period_steps, device=device)
+    data.add_segment(obs, dones)
+print("{} distillation samples".format(len(data)))
+mlp_data = data
+if window > 1:
+    # the MLP students only see the current observation
+    mlp_data = DistillationData(1)
+    mlp_data.segments = [(padded_obs[window - 1:], episode_start) for padded_obs, episode_start in data.segments]
+
+# same commands for every policy
+state = np.random.get_state()
+np.random.seed(args.seed)
+command_schedule = np.stack([user_command.uniform_sample_train() for _ in range(args.periods)])
+np.random.set_state(state)
+
+teacher = ppo_module.MLP(cfg['architecture']['policy_net'], nn.LeakyReLU, ob_dim, act_dim)
+teacher.load_state_dict(torch.load(args.weight, map_location='cpu')['actor_architecture_state_dict'])
+
+
+def report(name, architecture, input_shape, n_window):
+    architecture.to(device).eval()
+    result = distiller.evaluate(env, architecture, command_schedule, command_period_steps, window=n_window)
+    result.update(measure_inference_latency(architecture, input_shape, n_threads=args.latency_threads))
+    architecture.to(device)
+    return name, result
+
+
+results = [report('teacher', teacher.architecture, [ob_dim], 1)]
+for name, shape in students:
+    print("distilling {}".format(name))
+    student = ppo_module.MLP(shape, nn.LeakyReLU, ob_dim, act_dim)
+    distiller.fit(student, mlp_data, epochs=args.epochs, batch_size=args.batch_size, learning_rate=args.learning_rate)
+    distiller.save(student, os.path.join(output_dir, name), {'encoder': 'mlp', 'policy_net': shape})
+    results.append(report(name, student.architecture, [ob_dim], 1))
+if args.tcn:
+    name = 'tcn_' + '_'.join(str(channel) for channel in cfg['architecture']['tcn']['channels'])
+    print("distilling {}".format(name))
+    distiller.fit(tcn_student, data, epochs=args.epochs, batch_size=args.batch_size, learning_rate=args.learning_rate)
+    distiller.save(tcn_student, os.path.join(output_dir, name),
+                   {'encoder': 'tcn', 'policy_net': students[0][1], 'tcn': {'channels': list(cfg['architecture']['tcn']['channels']),
+                                                                             'kernel_size': cfg['architecture']['tcn']['kernel_size'],
+                                                                             'window': window}})
+    results.append(report(name, tcn_student.architecture, [window, ob_dim], window))
+
+columns = ['parameters', 'latency_p50_us', 'latency_p99_us', 'forward_vel_error', 'lateral_vel_error', 'yaw_rate_error',
+           'rms_error', 'falls_per_env']
+print("{:<20}".format('policy') + " ".join("{:>18}".format(column) for column in columns))
+for name, result in results:
+    print("{:<20}".format(name) + " ".join("{:>18}".format(int(result[column]) if column == 'parameters' else '{:.4f}'.format(result[column]))
+                                           for column in columns))
+print("students saved in {}".format(output_dir))
+env.close()
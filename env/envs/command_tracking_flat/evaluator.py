@@ -0,0 +1,62 @@
+from ruamel.yaml import YAML, dump, RoundTripDumper
+from raisimGymTorch.env.bin import command_tracking_flat
+from raisimGymTorch.env.RaisimGymVecEnv import RaisimGymVecEnv as VecEnv
+from raisimGymTorch.helper.raisim_gym_helper import UserCommand
+from raisimGymTorch.helper.checkpoint_evaluator import MultiCheckpointEvaluator, checkpoint_iteration
+import os
+import glob
+import math
+import time
+import torch
+import argparse
+import numpy as np
+
+
+# Evaluates many checkpoints in a single rollout: the envs are split among the checkpoints, which track the same commands.
+#   python raisimGymTorch/env/envs/command_tracking_flat/evaluator.py -d raisimGymTorch/data/command_tracking_flat/<run> --every 500
+#   python raisimGymTorch/env/envs/command_tracking_flat/evaluator.py -w <run>/full_15000.pt <run>/full_16200.pt
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-w', '--weight', help='trained weight paths', type=str, nargs='*', default=[])
+parser.add_argument('-d', '--directory', help='evaluate every full_<iteration>.pt of a run directory', type=str, default='')
+parser.add_argument('--every', help='only iterations that are a multiple of this (with --directory)', type=int, default=1)
+parser.add_argument('--num_envs', help='overrides num_envs of cfg.yaml', type=int, default=0)
+parser.add_argument('--periods', help='command periods of the rollout', type=int, default=4)
+parser.add_argument('--seed', help='seed of the command schedule', type=int, default=0)
+parser.add_argument('--output', help='csv file of the tracking-error table', type=str, default='')
+args = parser.parse_args()
+
+task_path = os.path.dirname(os.path.realpath(__file__))
+home_path = task_path + "/../../../../.."
+
+cfg = YAML().load(open(task_path + "/cfg.yaml", 'r'))
+cfg['environment']['render'] = False
+if args.num_envs > 0:
+    cfg['environment']['num_envs'] = args.num_envs
+
+weight_paths = list(args.weight)
+if args.directory != '':
+    weight_paths += [path for path in glob.glob(os.path.join(args.directory, "full_*.pt")) if checkpoint_iteration(path) % args.every == 0]
+weight_paths = sorted(set(weight_paths), key=checkpoint_iteration)
+assert len(weight_paths) > 0, "No checkpoint given, use --weight or --directory"
+
+np.random.seed(args.seed)
+torch.manual_seed(args.seed)
+
+env = VecEnv(command_tracking_flat.RaisimGymEnv(home_path + "/rsc", dump(cfg['environment'], Dumper=RoundTripDumper)), cfg['environment'],
+             normalize_ob=False)
+evaluator = MultiCheckpointEvaluator(env, weight_paths)
+print("{} checkpoints, {} envs each".format(evaluator.n_checkpoints, evaluator.envs_per_checkpoint))
+
+command_period_steps = math.floor(cfg['environment']['command_period'] / cfg['environment']['control_dt'])
+user_command = UserCommand(cfg, cfg['environment']['num_envs'])
+command_schedule = evaluator.sample_command_schedule(args.periods, user_command, seed=args.seed)
+
+start = time.time()
+result = evaluator.evaluate(command_schedule, command_period_steps)
+print(MultiCheckpointEvaluator.format_table(result))
+print('{:<40} {:>6}'.format("evaluation time: ", '{:6.2f}'.format(time.time() - start)))
+
+if args.output != '':
+    MultiCheckpointEvaluator.save_table(result, args.output)
+env.close()
@@ -2,12 +2,17 @@ from ruamel.yaml import YAML, dump, RoundTripDumper
 from raisimGymTorch.env.bin import command_tracking_flat
 from raisimGymTorch.env.RaisimGymVecEnv import RaisimGymVecEnv as VecEnv
 from raisimGymTorch.helper.raisim_gym_helper import ConfigurationSaver, load_param, tensorboard_launcher, UserCommand
-from raisimGymTorch.helper.utils_plot import plot_command_tracking_result
+from raisimGymTorch.helper.raisim_gym_helper import save_training_snapshot, load_training_snapshot, StartupTimer, import_in_background
+from raisimGymTorch.helper.rollout_dataset import RolloutExporter
+from raisimGymTorch.helper.profiler import ProfileWindow
+from raisimGymTorch.helper.memory_monitor import MemoryMonitor
 import os
 import math
 import time
 import raisimGymTorch.algo.ppo.module as ppo_module
 import raisimGymTorch.algo.ppo.ppo as PPO
+from raisimGymTorch.algo.ppo.split_step import SplitStepRollout
+from raisimGymTorch.algo.ppo.native_rollout import NativeRollout
 import torch.nn as nn
 import numpy as np
 import torch
@@ -15,9 +20,11 @@ import datetime
 import argparse
 from collections import defaultdict
 import pdb
-import wandb
 import random
 
+startup_timer = StartupTimer()
+startup_timer.lap("imports")
+
 
 random.seed(0)
 np.random.seed(0)
@@ -28,8 +35,9 @@ task_name = "command_tracking_flat"
 
 # configuration
 parser = argparse.ArgumentParser()
-parser.add_argument('-m', '--mode', help='set mode either train or test', type=str, default='train')
-parser.add_argument('-w', '--weight', help='pre-trained weight path', type=str, default='')
+parser.add_argument('-m', '--mode', help='set mode either train, retrain or resume', type=str, default='train')
+parser.add_argument('-w', '--weight', help='pre-trained weight path (resume: snapshot.pt of the run)', type=str, default='')
+parser.add_argument('--profile', help='profile these updates, e.g. 200-202 (overrides profiler: window of cfg.yaml)', type=str, default=None)
 args = parser.parse_args()
 mode = args.mode
 weight_path = args.weight
@@ -45,13 +53,20 @@ home_path = task_path + "/../../../../.."
 cfg = YAML().load(open(task_path + "/cfg.yaml", 'r'))
 reward_names = list(map(str, cfg['environment']['reward'].keys()))
 reward_names.append('reward_sum')
+if cfg['learner']['torch_threads'] > 0:
+    torch.set_num_threads(cfg['learner']['torch_threads'])
 
 # user command sampling
 user_command = UserCommand(cfg, cfg['environment']['num_envs'])
 
+# wandb is imported while the environments are constructed (the plotting stack on the first evaluation)
+logging_import = import_in_background("wandb")
+
 # create environment from the configuration file
 env = VecEnv(command_tracking_flat.RaisimGymEnv(home_path + "/rsc", dump(cfg['environment'], Dumper=RoundTripDumper)), cfg['environment'])
 
+startup_timer.lap("environment")
+
 # shortcuts
 ob_dim = env.num_obs  # include command dimension
 act_dim = env.num_acts
@@ -63,39 +78,126 @@ total_steps = n_steps * env.num_envs
 
 avg_rewards = []
 
-actor = ppo_module.Actor(ppo_module.MLP(cfg['architecture']['policy_net'], nn.LeakyReLU, ob_dim, act_dim),
+assert cfg['architecture']['encoder'] in ['mlp', 'tcn'], "Unavailable encoder."
+use_tcn = cfg['architecture']['encoder'] == 'tcn'
+
+
+def build_network(shape, output_size):
+    if use_tcn:
+        return ppo_module.TCN(cfg['architecture']['tcn']['channels'], cfg['architecture']['tcn']['kernel_size'], shape, nn.LeakyReLU,
+                              ob_dim, output_size, window=cfg['architecture']['tcn']['window'])
+    return ppo_module.MLP(shape, nn.LeakyReLU, ob_dim, output_size)
+
+
+actor = ppo_module.Actor(build_network(cfg['architecture']['policy_net'], act_dim),
                          ppo_module.MultivariateGaussianDiagonalCovariance(act_dim, 1.0),
                          device)
-critic = ppo_module.Critic(ppo_module.MLP(cfg['architecture']['value_net'], nn.LeakyReLU, ob_dim, 1),
+critic = ppo_module.Critic(build_network(cfg['architecture']['value_net'], 1),
                            device)
 
+# resume continues the run directory of the snapshot
 saver = ConfigurationSaver(log_dir=home_path + "/raisimGymTorch/data/"+task_name,
-                           save_items=[task_path + "/cfg.yaml", task_path + "/Environment.hpp"])
+                           save_items=[task_path + "/cfg.yaml", task_path + "/Environment.hpp"],
+                           data_dir=os.path.dirname(os.path.abspath(weight_path)) if mode == 'resume' else None)
 
 # tensorboard_launcher(saver.data_dir+"/..")  # press refresh (F5) after the first ppo update
 
-# wandb initialize
-wandb.init(name=task_name, project="Quadruped_RL")
+# the pre-sampled randomization is stored next to the weights for analysis
+if cfg['environment']['randomization_table']['enable'] and mode != 'resume':
+    env.export_randomization_table(saver.data_dir + "/randomization_table.npz")
 
+# opt-in rollout export for offline analysis / behavior cloning
+rollout_exporter = None
+if cfg['rollout_export']['enable']:
+    rollout_exporter = RolloutExporter(saver.data_dir + "/rollouts", compress=cfg['rollout_export']['compress'])
+    command_rollout = np.zeros((n_steps, cfg['environment']['num_envs'], 3), dtype=np.float32)
+    # observations before normalization: obs is normalized with the running statistics of its update
+    raw_obs_rollout = np.zeros((n_steps, cfg['environment']['num_envs'], ob_dim), dtype=np.float32)
+
+assert cfg['learner']['obs_dtype'] in ['float32', 'float16', 'bfloat16'], "Unavailable observation dtype."
 ppo = PPO.PPO(actor=actor,
               critic=critic,
               num_envs=cfg['environment']['num_envs'],
               num_transitions_per_env=n_steps,
-              num_learning_epochs=4,
+              num_learning_epochs=cfg['learner']['num_learning_epochs'],
               gamma=0.9988,  # discount factor
               lam=0.95,
-              num_mini_batches=4,
+              num_mini_batches=cfg['learner']['num_mini_batches'],
               device=device,
               log_dir=saver.data_dir,
               shuffle_batch=False,
+              shared_obs=True,  # the same obs is passed as actor and value observation below
+              obs_dtype=getattr(torch, cfg['learner']['obs_dtype']),
+              strict_obs_dtype=cfg['learner']['strict_obs_dtype'],
+              compile_update=cfg['learner']['compile_update'],
+              desired_kl=None,  # e.g. 0.01 stops the epochs early once the policy moved that far (adaptive_lr=True also scales the lr)
               )
 
+start_update = 0
+snapshot_extra = {}
 if mode == 'retrain':
     load_param(weight_path, env, actor, critic, ppo.optimizer, saver.data_dir)
+elif mode == 'resume':
+    start_update, snapshot_extra = load_training_snapshot(weight_path, env, actor, critic, ppo, device)
+    avg_rewards = snapshot_extra['avg_rewards']
+
+startup_timer.lap("learner")
+
+# wandb initialize (a resumed run continues its wandb run)
+logging_import.join()
+import wandb
+wandb.init(name=task_name, project="Quadruped_RL", id=snapshot_extra.get('wandb_id'), resume='allow' if mode == 'resume' else None)
+startup_timer.lap("wandb")
+startup_timer.report(env)
+
+# on-demand profiling of a few updates (configured window or kill -USR1 <pid>), traces go to the run directory
+profile_window = ProfileWindow(saver.data_dir, cfg['profiler']['window'] if args.profile is None else args.profile,
+                               use_signal=cfg['profiler']['signal'], tag='update')
+
+# memory accounting per update, leak warnings when a quantity keeps growing
+memory_monitor = MemoryMonitor({'storage': ppo.storage, 'optimizer': ppo.optimizer, 'actor': actor, 'critic': critic}, env,
+                               window=cfg['memory_monitor']['window'], warn_mb_per_100=cfg['memory_monitor']['warn_mb_per_100'])
+
+# split stepping: half of the envs integrate while the policy runs on the other half
+split_rollout = None
+if cfg['split_step']['enable']:
+    assert not use_tcn, "Split stepping is not available for temporal policies"
+    split_rollout = SplitStepRollout(env, ppo, n_groups=cfg['split_step']['n_groups'])
+
+# native rollout: all steps of a rollout run in the environment with the scripted policy, python only syncs the weights
+native_rollout = None
+if cfg['native_rollout']['enable']:
+    assert split_rollout is None, "Native rollout collection and split stepping are exclusive"
+    native_rollout = NativeRollout(env, ppo, actor, critic, saver.data_dir + "/rollout_policy.pt", seed=cfg['seed'])
+
+
+def set_training_command(step):
+    global sample_user_command
+    if step % command_period_steps == 0:
+        sample_user_command = user_command.uniform_sample_train()
+        # sample_user_command[:, 2] = 0  # set yaw rate command to zero
+        env.set_user_command(sample_user_command)
+
+    if rollout_exporter is not None:
+        command_rollout[step] = sample_user_command
+
+
+def log_training_step(step, reward, dones):
+    global done_sum, reward_ll_sum
+    done_sum = done_sum + sum(dones)
+    reward_ll_sum = reward_ll_sum + sum(reward)
+
+    env.reward_logging(cfg['environment']['n_rewards'] + 1)
+    reward_trajectory[:, step, :] = env.reward_log
+
+
+# reused by every update
+reward_trajectory = np.zeros((cfg['environment']['num_envs'], n_steps, cfg['environment']['n_rewards'] + 1))
 
 pdb.set_trace()
 
-for update in range(20000):
+for update in range(start_update, 20000):
+    profile_window.step(update)
     start = time.time()
     reward_ll_sum = 0
     done_sum = 0
@@ -110,8 +212,10 @@ for update in range(20000):
             'optimizer_state_dict': ppo.optimizer.state_dict(),
         }, saver.data_dir+"/full_"+str(update)+'.pt')
         # we create another graph just to demonstrate the save/load method
-        loaded_graph = ppo_module.MLP(cfg['architecture']['policy_net'], nn.LeakyReLU, ob_dim, act_dim)
+        loaded_graph = build_network(cfg['architecture']['policy_net'], act_dim)
         loaded_graph.load_state_dict(torch.load(saver.data_dir+"/full_"+str(update)+'.pt')['actor_architecture_state_dict'])
+        if use_tcn:
+            obs_window = ppo_module.ObservationWindow(env.num_envs, loaded_graph.window, ob_dim)
 
         env.initialize_n_step()
         env.reset()
@@ -120,6 +224,7 @@ for update in range(20000):
 
         command_trajectory = []
         real_trajectory = []
+        tracking_indices = list(env.tracking_indices)
 
         for step in range(n_steps*2):
             frame_start = time.time()
@@ -129,20 +234,26 @@ for update in range(20000):
                 env.set_user_command(sample_user_command)   # Hash this when n_env=1 for logging
 
             obs, non_obs = env.observe(False)
-            action_ll = loaded_graph.architecture(torch.from_numpy(obs).cpu())
+            if use_tcn:
+                action_ll = loaded_graph.architecture(obs_window.update(obs))
+            else:
+                action_ll = loaded_graph.architecture(torch.from_numpy(obs).cpu())
             reward_ll, dones = env.step(action_ll.cpu().detach().numpy())
+            if use_tcn:
+                obs_window.reset(dones)
             frame_end = time.time()
             wait_time = cfg['environment']['control_dt'] - (frame_end-frame_start)
 
             # command tracking logging
             command_trajectory.append(sample_user_command[0])
-            real_trajectory.append([non_obs[0, 18], non_obs[0, 19], non_obs[0, 23]])
+            real_trajectory.append(non_obs[0, tracking_indices])
 
             if wait_time > 0.:
                 time.sleep(wait_time)
 
         command_trajectory = np.array(command_trajectory)
         real_trajectory = np.array(real_trajectory)
+        from raisimGymTorch.helper.utils_plot import plot_command_tracking_result
         plot_command_tracking_result(command_trajectory, real_trajectory, saver.data_dir.split('/')[-2], saver.data_dir.split('/')[-1], update, control_dt=cfg['environment']['control_dt'])
 
         # env.stop_video_recording()
@@ -152,27 +263,45 @@ for update in range(20000):
 
     env.initialize_n_step()
     env.reset()
-    reward_trajectory = np.zeros((cfg['environment']['num_envs'], n_steps, cfg['environment']['n_rewards'] + 1))
+    reward_trajectory.fill(0.)
 
     # actual training
-    for step in range(n_steps):
-        if step % command_period_steps == 0:
-            sample_user_command = user_command.uniform_sample_train()
-            # sample_user_command[:, 2] = 0  # set yaw rate command to zero
-            env.set_user_command(sample_user_command)
-
-        obs, _ = env.observe()
-        action = ppo.observe(obs)
-        reward, dones = env.step(action)
-        ppo.step(value_obs=obs, rews=reward, dones=dones)
-        done_sum = done_sum + sum(dones)
-        reward_ll_sum = reward_ll_sum + sum(reward)
-
-        env.reward_logging(cfg['environment']['n_rewards'] + 1)
-        reward_trajectory[:, step, :] = env.reward_log
+    if native_rollout is not None:
+        # same command sampling as set_training_command, one schedule per rollout
+        command_schedule = np.stack([user_command.uniform_sample_train() for _ in range(-(-n_steps // command_period_steps))])
+        last_obs = native_rollout.run(command_schedule, command_period_steps)
+        done_sum = native_rollout.dones.sum()
+        reward_ll_sum = native_rollout.rewards.sum()
+        reward_trajectory[:] = native_rollout.reward_breakdown(reward_names)
+        if rollout_exporter is not None:
+            command_rollout[:] = np.repeat(command_schedule, command_period_steps, axis=0)[:n_steps]
+            raw_obs_rollout[:] = native_rollout.raw_obs.reshape(n_steps, env.num_envs, -1)
+    elif split_rollout is not None:
+        last_obs = split_rollout.run(n_steps, before_step=set_training_command, after_step=log_training_step,
+                                     raw_obs=raw_obs_rollout if rollout_exporter is not None else None)
+    else:
+        for step in range(n_steps):
+            set_training_command(step)
+            obs, raw_obs = env.observe()
+            if rollout_exporter is not None:
+                raw_obs_rollout[step] = raw_obs
+            action = ppo.observe(obs)
+            reward, dones = env.step(action)
+            ppo.step(value_obs=obs, rews=reward, dones=dones)
+            log_training_step(step, reward, dones)
+
+    # export before the update, which normalizes the rewards in place and clears the storage
+    if rollout_exporter is not None:
+        rollout_exporter.export(ppo.storage, update,
+                                reward_breakdown=np.swapaxes(reward_trajectory, 0, 1),
+                                commands=command_rollout,
+                                raw_obs=raw_obs_rollout)
 
     # take st step to get value obs
-    obs, _ = env.observe()
+    if split_rollout is not None or native_rollout is not None:
+        obs = last_obs
+    else:
+        obs, _ = env.observe()
     ppo.update(actor_obs=obs, value_obs=obs, log_this_iteration=update % 10 == 0, update=update)
     average_ll_performance = reward_ll_sum / total_steps
     average_dones = done_sum / total_steps
@@ -193,6 +322,14 @@ for update in range(20000):
     # curriculum learning
     env.curriculum_callback()
 
+    if cfg['snapshot']['every_n'] > 0 and (update + 1) % cfg['snapshot']['every_n'] == 0:
+        save_training_snapshot(saver.data_dir + "/snapshot.pt", update, env, actor, critic, ppo,
+                               extra={'avg_rewards': avg_rewards, 'wandb_id': wandb.run.id})
+
+    memory_stats = memory_monitor.sample(update)
+    if update % 10 == 0:
+        wandb.log(memory_stats)
+
     end = time.time()
 
     print('----------------------------------------------------')
@@ -201,8 +338,15 @@ for update in range(20000):
     print('{:<40} {:>6}'.format("dones: ", '{:0.6f}'.format(average_dones)))
     print('{:<40} {:>6}'.format("time elapsed in this iteration: ", '{:6.4f}'.format(end - start)))
     print('{:<40} {:>6}'.format("fps: ", '{:6.0f}'.format(total_steps / (end - start))))
+    print('{:<40} {:>6}'.format("rss [MB]: ", '{:6.0f}'.format(memory_stats['Memory/rss'])))
+    if update % cfg['environment']['eval_every_n'] == 0:
+        print(memory_monitor.format_report())
     print('{:<40} {:>6}'.format("real time factor: ", '{:6.0f}'.format(total_steps / (end - start)
                                                                        * cfg['environment']['control_dt'])))
     print('std: ')
     print(np.exp(actor.distribution.std.cpu().detach().numpy()))
     print('----------------------------------------------------\n')
+
+profile_window.close()
+if rollout_exporter is not None:
+    rollout_exporter.close()
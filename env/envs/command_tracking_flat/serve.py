@@ -0,0 +1,68 @@
+from raisimGymTorch.helper.policy_server import PolicyServer, PolicyClient
+import multiprocessing
+import time
+import torch
+import argparse
+import numpy as np
+
+
+# Hosts trained actors for the robots / simulations of this machine, which send raw observations and receive actions:
+#   python raisimGymTorch/env/envs/command_tracking_flat/serve.py -w <run>/full_16200.pt --socket /tmp/raisim_policy.sock
+#   client = PolicyClient('/tmp/raisim_policy.sock'); action = client.act(obs)
+# --bench_clients N starts N stand-in client processes (batch-size-1 requests of random observations) instead of waiting
+# for real ones and prints the latency percentiles and the served requests per second.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-w', '--weight', help='trained weight paths (policy k of the requests is the k-th)', type=str, nargs='+')
+parser.add_argument('--socket', help='unix socket path', type=str, default='/tmp/raisim_policy.sock')
+parser.add_argument('--max_batch', help='rows after which a batch is evaluated without waiting', type=int, default=256)
+parser.add_argument('--max_wait_ms', help='latency budget a request may wait for others to join its batch', type=float, default=1.)
+parser.add_argument('--torch_threads', help='torch intra-op threads (0: torch default)', type=int, default=0)
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--report_every', help='seconds between latency reports', type=float, default=10.)
+parser.add_argument('--bench_clients', help='number of stand-in client processes', type=int, default=0)
+parser.add_argument('--bench_seconds', type=float, default=10.)
+args = parser.parse_args()
+
+
+def stand_in_client(socket_path, policy, seconds, seed, n_done):
+    rng = np.random.RandomState(seed)
+    with PolicyClient(socket_path) as client:
+        obs = rng.randn(client.ob_dim).astype(np.float32)
+        n = 0
+        end = time.time() + seconds
+        while time.time() < end:
+            client.act(obs, policy)
+            n += 1
+    n_done.put(n)
+
+
+if __name__ == '__main__':
+    if args.torch_threads > 0:
+        torch.set_num_threads(args.torch_threads)
+
+    server = PolicyServer(args.weight, args.socket, max_batch=args.max_batch, max_wait=args.max_wait_ms * 1e-3,
+                          device=args.device)
+    with server:
+        print("serving {} on {} (observation {}, action {})".format(', '.join(server.policy_names()), args.socket,
+                                                                    server.ob_dim, server.act_dim))
+        if args.bench_clients > 0:
+            n_done = multiprocessing.Queue()
+            clients = [multiprocessing.Process(target=stand_in_client,
+                                               args=(args.socket, i % len(args.weight), args.bench_seconds, i, n_done))
+                       for i in range(args.bench_clients)]
+            for client in clients:
+                client.start()
+            total = sum(n_done.get() for _ in clients)
+            for client in clients:
+                client.join()
+            print(server.format_report())
+            print('{:<40} {:>10}'.format("requests per second: ", '{:10.1f}'.format(total / args.bench_seconds)))
+        else:
+            try:
+                while True:
+                    time.sleep(args.report_every)
+                    print(server.format_report())
+                    server.reset_stats()
+            except KeyboardInterrupt:
+                pass
@@ -3,6 +3,7 @@ from raisimGymTorch.env.bin import command_tracking_flat
 from raisimGymTorch.env.RaisimGymVecEnv import RaisimGymVecEnv as VecEnv
 from raisimGymTorch.helper.raisim_gym_helper import UserCommand
 from raisimGymTorch.helper.utils_plot import plot_command_tracking_result
+from raisimGymTorch.helper.profiler import ProfileWindow
 import raisimGymTorch.algo.ppo.module as ppo_module
 import os
 import math
@@ -22,6 +23,7 @@ torch.manual_seed(1)
 # configuration
 parser = argparse.ArgumentParser()
 parser.add_argument('-w', '--weight', help='trained weight path', type=str, default='')
+parser.add_argument('--profile', help='profile these control steps, e.g. 500-600 (overrides profiler: window of cfg.yaml)', type=str, default=None)
 args = parser.parse_args()
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -78,10 +80,16 @@ else:
     max_steps = 3000 ## 30 secs
     command_trajectory = []
     real_trajectory = []
+    tracking_indices = list(env.tracking_indices)
+
+    # on-demand profiling of a few control steps (configured window or kill -USR1 <pid>), traces go next to the weights
+    profile_window = ProfileWindow(weight_dir, cfg['profiler']['window'] if args.profile is None else args.profile,
+                                   use_signal=cfg['profiler']['signal'], tag='step', signal_length=100)
 
     pdb.set_trace()
 
     for step in range(max_steps):
+        profile_window.step(step)
         frame_start = time.time()
         if step % command_period_steps == 0:
             sample_user_command = user_command.uniform_sample_evaluate()
@@ -99,11 +107,12 @@ else:
 
         # command tracking logging
         command_trajectory.append(sample_user_command[0])
-        real_trajectory.append([non_obs[0, 18], non_obs[0, 19], non_obs[0, 23]])
+        real_trajectory.append(non_obs[0, tracking_indices])
 
         if wait_time > 0.:
             time.sleep(wait_time)
 
+    profile_window.close()
     env.turn_off_visualization()
     env.stop_video_recording()
 
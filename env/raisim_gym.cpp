@@ -18,7 +18,7 @@ using namespace raisim;
 
 PYBIND11_MODULE(RAISIMGYM_TORCH_ENV_NAME, m) {
   py::class_<VectorizedEnvironment<ENVIRONMENT>>(m, RSG_MAKE_STR(ENVIRONMENT_NAME))
-    .def(py::init<std::string, std::string>(), py::arg("resourceDir"), py::arg("cfg"))
+    .def(py::init<std::string, std::string>(), py::arg("resourceDir"), py::arg("cfg"), py::call_guard<py::gil_scoped_release>())
     .def("init", &VectorizedEnvironment<ENVIRONMENT>::init)
     .def("reset", &VectorizedEnvironment<ENVIRONMENT>::reset)
     .def("observe", &VectorizedEnvironment<ENVIRONMENT>::observe)
@@ -32,18 +32,24 @@ PYBIND11_MODULE(RAISIMGYM_TORCH_ENV_NAME, m) {
     .def("getObDim", &VectorizedEnvironment<ENVIRONMENT>::getObDim)
     .def("getActionDim", &VectorizedEnvironment<ENVIRONMENT>::getActionDim)
     .def("getNumOfEnvs", &VectorizedEnvironment<ENVIRONMENT>::getNumOfEnvs)
+    .def("getRobotsPerWorld", &VectorizedEnvironment<ENVIRONMENT>::getRobotsPerWorld)
+    .def("getObservationLayout", &VectorizedEnvironment<ENVIRONMENT>::getObservationLayout)
     .def("turnOnVisualization", &VectorizedEnvironment<ENVIRONMENT>::turnOnVisualization)
     .def("turnOffVisualization", &VectorizedEnvironment<ENVIRONMENT>::turnOffVisualization)
     .def("stopRecordingVideo", &VectorizedEnvironment<ENVIRONMENT>::stopRecordingVideo)
     .def("startRecordingVideo", &VectorizedEnvironment<ENVIRONMENT>::startRecordingVideo)
     .def("curriculumUpdate", &VectorizedEnvironment<ENVIRONMENT>::curriculumUpdate)
     .def("reward_logging", &VectorizedEnvironment<ENVIRONMENT>::reward_logging)
+    .def("getRewardTerms", &VectorizedEnvironment<ENVIRONMENT>::getRewardTerms)
+    .def("getRewardNames", &VectorizedEnvironment<ENVIRONMENT>::getRewardNames)
     .def("contact_logging", &VectorizedEnvironment<ENVIRONMENT>::contact_logging)
     .def("torque_and_velocity_logging", &VectorizedEnvironment<ENVIRONMENT>::torque_and_velocity_logging)
     .def("set_user_command", &VectorizedEnvironment<ENVIRONMENT>::set_user_command)
     .def("initialize_n_step", &VectorizedEnvironment<ENVIRONMENT>::initialize_n_step)
     .def("coordinate_observe", &VectorizedEnvironment<ENVIRONMENT>::coordinate_observe)
     .def("partial_step", &VectorizedEnvironment<ENVIRONMENT>::partial_step)
+    .def("stepGroup", &VectorizedEnvironment<ENVIRONMENT>::stepGroup, py::call_guard<py::gil_scoped_release>())
+    .def("observeGroup", &VectorizedEnvironment<ENVIRONMENT>::observeGroup, py::call_guard<py::gil_scoped_release>())
     .def("partial_reset", &VectorizedEnvironment<ENVIRONMENT>::partial_reset)
     .def("visualize_desired_command_traj", &VectorizedEnvironment<ENVIRONMENT>::visualize_desired_command_traj)
     .def("visualize_modified_command_traj", &VectorizedEnvironment<ENVIRONMENT>::visualize_modified_command_traj)
@@ -55,6 +61,43 @@ PYBIND11_MODULE(RAISIMGYM_TORCH_ENV_NAME, m) {
     .def("parallel_env_collision_check", &VectorizedEnvironment<ENVIRONMENT>::parallel_env_collision_check)
     .def("analytic_planner_collision_check", &VectorizedEnvironment<ENVIRONMENT>::analytic_planner_collision_check)
     .def("visualize_analytic_planner", &VectorizedEnvironment<ENVIRONMENT>::visualize_analytic_planner)
+    .def("getStepAllocations", &VectorizedEnvironment<ENVIRONMENT>::getStepAllocations)
+    .def("isAllocationCounterEnabled", &VectorizedEnvironment<ENVIRONMENT>::isAllocationCounterEnabled)
+    .def("getNativeMemoryStats", &VectorizedEnvironment<ENVIRONMENT>::getNativeMemoryStats)
+    .def("setObservationNormalization", &VectorizedEnvironment<ENVIRONMENT>::setObservationNormalization)
+    .def("isObservationNormalizationEnabled", &VectorizedEnvironment<ENVIRONMENT>::isObservationNormalizationEnabled)
+    .def("observeNormalized", &VectorizedEnvironment<ENVIRONMENT>::observeNormalized, py::call_guard<py::gil_scoped_release>())
+    .def("normalizeGroup", &VectorizedEnvironment<ENVIRONMENT>::normalizeGroup, py::call_guard<py::gil_scoped_release>())
+    .def("getObservationStatistics", &VectorizedEnvironment<ENVIRONMENT>::getObservationStatistics)
+    .def("setObservationStatistics", &VectorizedEnvironment<ENVIRONMENT>::setObservationStatistics)
+#ifdef RSG_WITH_TORCH
+    .def("loadRolloutPolicy", &VectorizedEnvironment<ENVIRONMENT>::loadRolloutPolicy)
+    .def("getRolloutPolicyParameterCount", &VectorizedEnvironment<ENVIRONMENT>::getRolloutPolicyParameterCount)
+    .def("setRolloutPolicyParameters", &VectorizedEnvironment<ENVIRONMENT>::setRolloutPolicyParameters)
+    .def("collectRollout", &VectorizedEnvironment<ENVIRONMENT>::collectRollout, py::call_guard<py::gil_scoped_release>())
+#endif
+    .def("enableTimingProbes", &VectorizedEnvironment<ENVIRONMENT>::enableTimingProbes)
+    .def("resetTimingProbes", &VectorizedEnvironment<ENVIRONMENT>::resetTimingProbes)
+    .def("getStepTimings", &VectorizedEnvironment<ENVIRONMENT>::getStepTimings)
+    .def("getStepPhaseNames", &VectorizedEnvironment<ENVIRONMENT>::getStepPhaseNames)
+    .def("getLoadImbalanceStats", &VectorizedEnvironment<ENVIRONMENT>::getLoadImbalanceStats)
+    .def("getStartupTimings", &VectorizedEnvironment<ENVIRONMENT>::getStartupTimings)
+    .def("enableTerminalObservation", &VectorizedEnvironment<ENVIRONMENT>::enableTerminalObservation)
+    .def("getTerminalObservation", &VectorizedEnvironment<ENVIRONMENT>::getTerminalObservation)
+    .def("sampleRandomizationTable", &VectorizedEnvironment<ENVIRONMENT>::sampleRandomizationTable)
+    .def("setRandomizationTable", &VectorizedEnvironment<ENVIRONMENT>::setRandomizationTable)
+    .def("getRandomizationTable", &VectorizedEnvironment<ENVIRONMENT>::getRandomizationTable)
+    .def("disableRandomizationTable", &VectorizedEnvironment<ENVIRONMENT>::disableRandomizationTable)
+    .def("getRandomizationTableRows", &VectorizedEnvironment<ENVIRONMENT>::getRandomizationTableRows)
+    .def("getRandomizationDim", &VectorizedEnvironment<ENVIRONMENT>::getRandomizationDim)
+    .def("getRandomizationNames", &VectorizedEnvironment<ENVIRONMENT>::getRandomizationNames)
+    .def("getCurriculumState", &VectorizedEnvironment<ENVIRONMENT>::getCurriculumState)
+    .def("setCurriculumState", &VectorizedEnvironment<ENVIRONMENT>::setCurriculumState)
+    .def("getGeneratorStates", &VectorizedEnvironment<ENVIRONMENT>::getGeneratorStates)
+    .def("setGeneratorStates", &VectorizedEnvironment<ENVIRONMENT>::setGeneratorStates)
+    .def("isRandomizationTableEnabled", &VectorizedEnvironment<ENVIRONMENT>::isRandomizationTableEnabled)
+    .def("getRandomizationResets", &VectorizedEnvironment<ENVIRONMENT>::getRandomizationResets)
+    .def("setRandomizationResets", &VectorizedEnvironment<ENVIRONMENT>::setRandomizationResets)
 
     .def(py::pickle(
         [](const VectorizedEnvironment<ENVIRONMENT> &p) { // __getstate__ --> Pickling to Python
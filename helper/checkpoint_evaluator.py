@@ -0,0 +1,157 @@
+import os
+import re
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def checkpoint_iteration(weight_path):
+    """
+    :return: iteration of a runner.py checkpoint (".../full_<iteration>.pt")
+    """
+    return int(weight_path.rsplit('/', 1)[-1].split('_', 1)[1].rsplit('.', 1)[0])
+
+
+def load_checkpoint_scaling(weight_path):
+    """
+    Observation mean / var saved by env.save_scaling next to the checkpoint. The files may hold one identical row per env.
+
+    :return: mean, var, each (ob_dim,)
+    """
+    weight_dir = os.path.dirname(weight_path)
+    iteration = checkpoint_iteration(weight_path)
+    mean = np.loadtxt(os.path.join(weight_dir, "mean{}.csv".format(iteration)), dtype=np.float32)
+    var = np.loadtxt(os.path.join(weight_dir, "var{}.csv".format(iteration)), dtype=np.float32)
+    return np.atleast_2d(mean)[0], np.atleast_2d(var)[0]
+
+
+class BatchedMLP(nn.Module):
+    def __init__(self, state_dicts, activation_fn=nn.LeakyReLU):
+        """
+        K MLPs of identical shape (ppo_module.MLP) evaluated with one batched matmul per layer.
+
+        :param state_dicts: K state dicts of ppo_module.MLP (e.g. checkpoint['actor_architecture_state_dict'])
+        """
+        super(BatchedMLP, self).__init__()
+        self.activation_fn = activation_fn()
+        layer_ids = sorted({int(re.match(r"architecture\.(\d+)\.weight", key).group(1)) for key in state_dicts[0]
+                            if key.endswith(".weight")})
+        weights, biases = [], []
+        for layer_id in layer_ids:
+            weight_key, bias_key = "architecture.{}.weight".format(layer_id), "architecture.{}.bias".format(layer_id)
+            assert all(state_dict[weight_key].shape == state_dicts[0][weight_key].shape for state_dict in state_dicts), \
+                "Checkpoints of different architectures cannot be batched"
+            # (K, in, out) and (K, 1, out)
+            weights.append(torch.stack([state_dict[weight_key].t() for state_dict in state_dicts]).contiguous())
+            biases.append(torch.stack([state_dict[bias_key] for state_dict in state_dicts]).unsqueeze(1))
+        self.weights = nn.ParameterList([nn.Parameter(weight, requires_grad=False) for weight in weights])
+        self.biases = nn.ParameterList([nn.Parameter(bias, requires_grad=False) for bias in biases])
+
+    def forward(self, x):
+        """
+        :param x: (K, n_batch, input_size)
+        :return: (K, n_batch, output_size)
+        """
+        for layer_id, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            x = torch.baddbmm(bias, x, weight)
+            if layer_id < len(self.weights) - 1:
+                x = self.activation_fn(x)
+        return x
+
+
+class MultiCheckpointEvaluator:
+    def __init__(self, env, weight_paths, clip_obs=10., device='cpu'):
+        """
+        Evaluates K checkpoints at once on one vectorized environment: the envs are split into K groups of num_envs // K,
+        group k is driven by checkpoint k with its own observation normalization, all policies run as one BatchedMLP.
+        Envs left over by the split receive zero actions and are not evaluated.
+
+        :param env: RaisimGymVecEnv created with normalize_ob=False (the raw observation is normalized per checkpoint)
+        :param weight_paths: runner.py checkpoints (full_<iteration>.pt), mean<iteration>.csv / var<iteration>.csv next to them
+        """
+        assert not env.normalize_ob, "The evaluator normalizes per checkpoint, create the environment with normalize_ob=False"
+        self.env = env
+        self.weight_paths = list(weight_paths)
+        self.n_checkpoints = len(self.weight_paths)
+        self.envs_per_checkpoint = env.num_envs // self.n_checkpoints
+        assert self.envs_per_checkpoint > 0, "More checkpoints ({}) than envs ({})".format(self.n_checkpoints, env.num_envs)
+        self.n_evaluated = self.envs_per_checkpoint * self.n_checkpoints
+        self.clip_obs = clip_obs
+        self.device = device
+
+        state_dicts = [torch.load(path, map_location='cpu')['actor_architecture_state_dict'] for path in self.weight_paths]
+        self.policy = BatchedMLP(state_dicts).to(device)
+        scaling = [load_checkpoint_scaling(path) for path in self.weight_paths]
+        self.obs_mean = torch.from_numpy(np.stack([mean for mean, _ in scaling])).unsqueeze(1).to(device)
+        self.obs_std = torch.from_numpy(np.sqrt(np.stack([var for _, var in scaling]) + 1e-8)).unsqueeze(1).to(device)
+        self.action = np.zeros([env.num_envs, env.num_acts], dtype=np.float32)
+
+    def sample_command_schedule(self, n_periods, user_command, seed=0):
+        """
+        One command sequence per env of a group, shared by all groups: (n_periods, envs_per_checkpoint, 3)
+        """
+        state = np.random.get_state()
+        np.random.seed(seed)
+        schedule = np.stack([user_command.uniform_sample_train()[:self.envs_per_checkpoint] for _ in range(n_periods)])
+        np.random.set_state(state)
+        return schedule
+
+    @torch.no_grad()
+    def evaluate(self, command_schedule, command_period_steps, tracking_indices=None):
+        """
+        :param command_schedule: (n_periods, envs_per_checkpoint, 3), see sample_command_schedule
+        :param tracking_indices: observation entries of the body forward / lateral velocity and yaw rate
+                                 (default: env.tracking_indices)
+        :return: dict of (K,) arrays: forward/lateral/yaw_rate mean absolute error, rms_error, falls per env
+        """
+        if tracking_indices is None:
+            tracking_indices = self.env.tracking_indices
+        n_periods = command_schedule.shape[0]
+        command = np.zeros([self.env.num_envs, 3], dtype=np.float32)
+        squared_error = np.zeros([self.n_checkpoints, 3])
+        absolute_error = np.zeros([self.n_checkpoints, 3])
+        falls = np.zeros(self.n_checkpoints)
+        n_steps = n_periods * command_period_steps
+
+        self.env.initialize_n_step()
+        self.env.reset()
+        raw_obs, _ = self.env.observe(False)
+        for step in range(n_steps):
+            if step % command_period_steps == 0:
+                command[:self.n_evaluated] = np.tile(command_schedule[step // command_period_steps], (self.n_checkpoints, 1))
+                self.env.set_user_command(command)
+
+            obs = torch.from_numpy(raw_obs[:self.n_evaluated]).to(self.device).view(self.n_checkpoints, self.envs_per_checkpoint, -1)
+            obs = torch.clamp((obs - self.obs_mean) / self.obs_std, -self.clip_obs, self.clip_obs)
+            self.action[:self.n_evaluated] = self.policy(obs).reshape(self.n_evaluated, -1).cpu().numpy()
+            _, dones = self.env.step(self.action)
+
+            # tracking error of the state reached by this step
+            raw_obs, _ = self.env.observe(False)
+            error = (raw_obs[:self.n_evaluated, list(tracking_indices)] - command[:self.n_evaluated])
+            error = error.reshape(self.n_checkpoints, self.envs_per_checkpoint, 3)
+            squared_error += np.square(error).mean(axis=1)
+            absolute_error += np.abs(error).mean(axis=1)
+            falls += dones[:self.n_evaluated].reshape(self.n_checkpoints, self.envs_per_checkpoint).mean(axis=1)
+
+        return {'iteration': np.array([checkpoint_iteration(path) for path in self.weight_paths]),
+                'forward_vel_error': absolute_error[:, 0] / n_steps,
+                'lateral_vel_error': absolute_error[:, 1] / n_steps,
+                'yaw_rate_error': absolute_error[:, 2] / n_steps,
+                'rms_error': np.sqrt(squared_error.sum(axis=1) / n_steps),
+                'falls_per_env': falls}
+
+    @staticmethod
+    def format_table(result):
+        columns = list(result.keys())
+        lines = [" ".join("{:>18}".format(column) for column in columns)]
+        for row in range(len(result['iteration'])):
+            lines.append(" ".join("{:>18}".format(int(result[column][row]) if column == 'iteration' else '{:.4f}'.format(result[column][row]))
+                                  for column in columns))
+        return "\n".join(lines)
+
+    @staticmethod
+    def save_table(result, file_name):
+        columns = list(result.keys())
+        np.savetxt(file_name, np.stack([result[column] for column in columns], axis=1), delimiter=',',
+                   header=','.join(columns), comments='')
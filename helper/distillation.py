@@ -0,0 +1,243 @@
+import os
+import time
+import shutil
+import numpy as np
+import torch
+
+from raisimGymTorch.helper.checkpoint_evaluator import BatchedMLP, checkpoint_iteration, load_checkpoint_scaling
+
+
+class DistillationData:
+    def __init__(self, window=1):
+        """
+        Time-major segments of normalized observations with their episode boundaries, the input of StudentDistiller.
+        Samples are (step, env) pairs; with window > 1 a sample is the observation history of the env ending at that step,
+        steps before the start of its episode are zero (as in TemporalRolloutStorage / ObservationWindow).
+        """
+        self.window = window
+        self.segments = []  # (obs (T + window - 1, E, D) padded at the front, episode start step (T, E))
+
+    def add_segment(self, obs, dones):
+        """
+        :param obs: normalized observations, (n_steps, num_envs, ob_dim)
+        :param dones: (n_steps, num_envs), dones[t] ends the episode after step t
+        """
+        obs = torch.as_tensor(np.asarray(obs, dtype=np.float32))
+        dones = np.asarray(dones, dtype=bool)
+        n_steps, num_envs = dones.shape
+        episode_start = np.zeros((n_steps, num_envs), dtype=np.int64)
+        for step in range(1, n_steps):
+            episode_start[step] = np.where(dones[step - 1], step, episode_start[step - 1])
+        padding = torch.zeros(self.window - 1, num_envs, obs.shape[2])
+        self.segments.append((torch.cat([padding, obs]), torch.from_numpy(episode_start)))
+
+    def add_rollout_dataset(self, dataset, obs_mean, obs_std, clip_obs=10.):
+        """
+        Chunks exported by RolloutExporter (helper/rollout_dataset.py). Their 'obs' column is normalized with the running
+        statistics of its update, so the 'raw_obs' column is normalized here with the teacher's scaling instead (the
+        scaling the students are evaluated and deployed with).
+
+        :param obs_mean: teacher observation mean (ob_dim,)
+        :param obs_std: teacher observation std, sqrt(var + 1e-8) (ob_dim,)
+        """
+        obs_mean = np.asarray(obs_mean, dtype=np.float32)
+        obs_std = np.asarray(obs_std, dtype=np.float32)
+        for chunk in dataset.chunks:
+            columns = dataset.meta[chunk]['columns']
+            if 'raw_obs' not in columns:
+                raise ValueError("Chunk {} has no raw_obs column, its obs are normalized with the statistics of their update "
+                                 "and do not match the teacher's scaling (export the rollouts again)".format(chunk))
+            shape = columns['raw_obs']['shape']
+            raw_obs = np.asarray(dataset.column(chunk, 'raw_obs')).reshape(shape)
+            dones = np.asarray(dataset.column(chunk, 'dones')).reshape(shape[0], shape[1])
+            self.add_segment(np.clip((raw_obs - obs_mean) / obs_std, -clip_obs, clip_obs), dones)
+
+    def __len__(self):
+        return sum(start.numel() for _, start in self.segments)
+
+    @property
+    def ob_dim(self):
+        return self.segments[0][0].shape[2]
+
+    def batches(self, batch_size, shuffle=True):
+        """
+        Yields (obs, last_obs): obs (n_batch, window, ob_dim) or (n_batch, ob_dim) with window 1, last_obs (n_batch, ob_dim)
+        """
+        sizes = [start.numel() for _, start in self.segments]
+        offsets = np.cumsum([0] + sizes)
+        order = np.random.permutation(offsets[-1]) if shuffle else np.arange(offsets[-1])
+        history = torch.arange(-self.window + 1, 1)
+        for begin in range(0, len(order), batch_size):
+            indices = order[begin:begin + batch_size]
+            windows = []
+            for segment_id, (padded_obs, episode_start) in enumerate(self.segments):
+                selected = indices[(indices >= offsets[segment_id]) & (indices < offsets[segment_id + 1])] - offsets[segment_id]
+                if len(selected) == 0:
+                    continue
+                selected = torch.from_numpy(selected)
+                num_envs = episode_start.shape[1]
+                step, env = selected // num_envs, selected % num_envs
+                steps = step.unsqueeze(1) + history  # (n, window), may be negative (front padding)
+                window = padded_obs[steps + self.window - 1, env.unsqueeze(1)]
+                window[steps < episode_start[step, env].unsqueeze(1)] = 0.
+                windows.append(window)
+            window = torch.cat(windows)
+            yield (window[:, -1] if self.window == 1 else window), window[:, -1]
+
+
+def collect_teacher_rollout(env, teacher, obs_mean, obs_std, n_steps, user_command, command_period_steps, clip_obs=10.,
+                            device='cpu'):
+    """
+    Drives the envs with the teacher's mean action and records the normalized observations.
+
+    :param env: RaisimGymVecEnv created with normalize_ob=False
+    :param teacher: callable on normalized observations (n, ob_dim) -> actions
+    :return: obs (n_steps, num_envs, ob_dim), dones (n_steps, num_envs)
+    """
+    obs_buffer = np.zeros([n_steps, env.num_envs, env.num_obs], dtype=np.float32)
+    done_buffer = np.zeros([n_steps, env.num_envs], dtype=bool)
+    env.initialize_n_step()
+    env.reset()
+    with torch.no_grad():
+        for step in range(n_steps):
+            if step % command_period_steps == 0:
+                env.set_user_command(user_command.uniform_sample_train())
+            raw_obs, _ = env.observe(False)
+            obs = torch.clamp((torch.from_numpy(raw_obs).to(device) - obs_mean) / obs_std, -clip_obs, clip_obs)
+            obs_buffer[step] = obs.cpu().numpy()
+            _, done_buffer[step] = env.step(teacher(obs).cpu().numpy())
+    return obs_buffer, done_buffer
+
+
+class StudentDistiller:
+    def __init__(self, teacher_path, device='cpu', clip_obs=10.):
+        """
+        Regresses student networks onto the mean action of a trained actor (runner.py checkpoint).
+        The students take the teacher's normalized observation, they are saved as runner.py checkpoints with the
+        teacher's mean / var next to them, so MLP students load in tester.py, evaluator.py and serve.py as they are.
+
+        :param teacher_path: full_<iteration>.pt, mean<iteration>.csv / var<iteration>.csv next to it
+        """
+        self.teacher_path = teacher_path
+        self.iteration = checkpoint_iteration(teacher_path)
+        self.device = device
+        self.clip_obs = clip_obs
+        state_dict = torch.load(teacher_path, map_location='cpu')['actor_architecture_state_dict']
+        self.batched_teacher = BatchedMLP([state_dict]).to(device)
+        mean, var = load_checkpoint_scaling(teacher_path)
+        self.obs_mean = torch.from_numpy(mean).to(device)
+        self.obs_std = torch.from_numpy(np.sqrt(var + 1e-8)).to(device)
+
+    @torch.no_grad()
+    def teacher(self, obs):
+        """
+        :param obs: normalized observations (n, ob_dim)
+        """
+        return self.batched_teacher(obs.unsqueeze(0))[0]
+
+    def fit(self, student, data, epochs=20, batch_size=4096, learning_rate=1e-3, log=print):
+        """
+        :param student: ppo_module.MLP (data.window 1) or ppo_module.TCN (data.window = student.window)
+        :return: mean squared action error of the last epoch
+        """
+        student.to(self.device)
+        optimizer = torch.optim.Adam(student.parameters(), lr=learning_rate)
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs)
+        loss_value = 0.
+        for epoch in range(epochs):
+            loss_sum, n_samples = 0., 0
+            for obs, last_obs in data.batches(batch_size):
+                obs, last_obs = obs.to(self.device), last_obs.to(self.device)
+                loss = (student.architecture(obs) - self.teacher(last_obs)).pow(2).mean()
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                loss_sum += loss.item() * obs.shape[0]
+                n_samples += obs.shape[0]
+            scheduler.step()
+            loss_value = loss_sum / max(n_samples, 1)
+            if log is not None:
+                log('epoch {:4d}  action mse {:.6f}'.format(epoch, loss_value))
+        return loss_value
+
+    def save(self, student, directory, architecture):
+        """
+        :param architecture: dict stored with the weights describing how to rebuild the student (e.g. policy_net, tcn)
+        :return: checkpoint path
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "full_{}.pt".format(self.iteration))
+        torch.save({'actor_architecture_state_dict': student.state_dict(), 'architecture': architecture,
+                    'teacher': self.teacher_path}, path)
+        teacher_dir = os.path.dirname(self.teacher_path)
+        for name in ["mean", "var"]:
+            shutil.copyfile(os.path.join(teacher_dir, "{}{}.csv".format(name, self.iteration)),
+                            os.path.join(directory, "{}{}.csv".format(name, self.iteration)))
+        return path
+
+    @torch.no_grad()
+    def evaluate(self, env, policy, command_schedule, command_period_steps, window=1, tracking_indices=None):
+        """
+        Command tracking error of a policy driving all envs, same measures as MultiCheckpointEvaluator.
+
+        :param env: RaisimGymVecEnv created with normalize_ob=False
+        :param policy: callable on normalized observations ((num_envs, ob_dim), or (num_envs, window, ob_dim) with window > 1)
+        :param command_schedule: (n_periods, num_envs, 3)
+        """
+        if tracking_indices is None:
+            tracking_indices = env.tracking_indices
+        n_steps = command_schedule.shape[0] * command_period_steps
+        absolute_error = np.zeros(3)
+        squared_error = 0.
+        falls = 0.
+        history = torch.zeros(env.num_envs, window, env.num_obs, device=self.device)
+        env.initialize_n_step()
+        env.reset()
+        raw_obs, _ = env.observe(False)
+        for step in range(n_steps):
+            if step % command_period_steps == 0:
+                command = command_schedule[step // command_period_steps]
+                env.set_user_command(command)
+            obs = torch.clamp((torch.from_numpy(raw_obs).to(self.device) - self.obs_mean) / self.obs_std, -self.clip_obs, self.clip_obs)
+            history = torch.roll(history, -1, dims=1)
+            history[:, -1] = obs
+            _, dones = env.step(policy(history if window > 1 else obs).cpu().numpy())
+            history[torch.from_numpy(dones.astype(bool)).to(self.device)] = 0.
+
+            raw_obs, _ = env.observe(False)
+            error = raw_obs[:, list(tracking_indices)] - command
+            absolute_error += np.abs(error).mean(axis=0)
+            squared_error += np.square(error).sum(axis=1).mean()
+            falls += dones.mean()
+
+        return {'forward_vel_error': absolute_error[0] / n_steps,
+                'lateral_vel_error': absolute_error[1] / n_steps,
+                'yaw_rate_error': absolute_error[2] / n_steps,
+                'rms_error': np.sqrt(squared_error / n_steps),
+                'falls_per_env': falls}
+
+
+@torch.no_grad()
+def measure_inference_latency(architecture, input_shape, n_threads=1, n_repeats=2000, n_warmup=200):
+    """
+    Batch-size-1 CPU latency of a policy network, as on the robot (one observation per control step).
+
+    :param architecture: nn.Module (e.g. MLP.architecture)
+    :param input_shape: shape of one observation, e.g. [ob_dim] or [window, ob_dim]
+    :return: dict of p50 / p99 latency in microseconds and the parameter count
+    """
+    previous_threads = torch.get_num_threads()
+    torch.set_num_threads(n_threads)
+    architecture = architecture.cpu().eval()
+    x = torch.zeros(1, *input_shape)
+    for _ in range(n_warmup):
+        architecture(x)
+    times = np.zeros(n_repeats)
+    for i in range(n_repeats):
+        start = time.perf_counter()
+        architecture(x)
+        times[i] = time.perf_counter() - start
+    torch.set_num_threads(previous_threads)
+    return {'latency_p50_us': float(np.percentile(times, 50)) * 1e6,
+            'latency_p99_us': float(np.percentile(times, 99)) * 1e6,
+            'parameters': sum(parameter.numel() for parameter in architecture.parameters())}
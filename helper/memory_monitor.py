@@ -0,0 +1,143 @@
+import os
+import resource
+from collections import deque
+import numpy as np
+import torch
+
+
+def process_rss_bytes():
+    """
+    Resident set size of this process. Falls back to the peak RSS where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def _tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, torch.nn.Module):
+        yield from obj.parameters()
+        yield from obj.buffers()
+        for parameter in obj.parameters():
+            if parameter.grad is not None:
+                yield parameter.grad
+    elif isinstance(obj, torch.optim.Optimizer):
+        for state in obj.state.values():
+            for value in state.values():
+                if isinstance(value, torch.Tensor):
+                    yield value
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            yield from _tensors(item)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            yield from _tensors(item)
+    elif hasattr(obj, '__dict__'):
+        # e.g. RolloutStorage, Actor: tensors and modules held as attributes
+        for item in vars(obj).values():
+            if isinstance(item, (torch.Tensor, torch.nn.Module, torch.optim.Optimizer)):
+                yield from _tensors(item)
+
+
+def tensor_bytes(obj):
+    """
+    Bytes of the tensors owned by obj (module parameters, buffers and gradients, optimizer state, tensor attributes),
+    counting every storage once.
+
+    :return: cpu bytes, cuda bytes
+    """
+    seen = set()
+    cpu, cuda = 0, 0
+    for tensor in _tensors(obj):
+        storage = tensor.untyped_storage() if hasattr(tensor, 'untyped_storage') else tensor.storage()
+        key = (tensor.device, storage.data_ptr())
+        if key in seen:
+            continue
+        seen.add(key)
+        n_bytes = storage.nbytes() if hasattr(storage, 'nbytes') else storage.size() * tensor.element_size()
+        if tensor.is_cuda:
+            cuda += n_bytes
+        else:
+            cpu += n_bytes
+    return cpu, cuda
+
+
+class MemoryMonitor:
+    def __init__(self, owners, env=None, window=50, warn_mb_per_100=50., log=print):
+        """
+        Memory accounting once per training iteration: process RSS, native heap of the environments, numpy buffers of
+        RaisimGymVecEnv and torch tensor bytes per owner. A least squares trend over the last `window` samples of each
+        quantity is compared with warn_mb_per_100 (growth in MB per 100 iterations) and a leak warning is logged (at most
+        once per window and quantity) while it is exceeded; a run that stays flat in memory never warns.
+
+        :param owners: {name: object owning tensors}, e.g. {'storage': ppo.storage, 'optimizer': ppo.optimizer,
+                       'actor': actor.architecture}
+        :param env: RaisimGymVecEnv
+        """
+        self.owners = owners
+        self.env = env
+        self.window = window
+        self.warn_bytes_per_iteration = warn_mb_per_100 * 2 ** 20 / 100.
+        self.log = log
+        self.history = dict()
+        self.iterations = deque(maxlen=window)
+        self.warnings = 0
+        self._last_warning = dict()
+
+    def sample(self, iteration):
+        """
+        :return: {name: MB}, e.g. for wandb (keys prefixed with Memory/)
+        """
+        sample = {'rss': process_rss_bytes()}
+        if self.env is not None:
+            native = self.env.native_memory_stats
+            if native['heap_in_use_bytes'] > 0:
+                sample['native_heap'] = native['heap_in_use_bytes']
+            sample['env_numpy'] = sum(self.env.numpy_buffer_bytes().values())
+        for name, owner in self.owners.items():
+            cpu, cuda = tensor_bytes(owner)
+            sample['torch_' + name] = cpu
+            if cuda > 0:
+                sample['cuda_' + name] = cuda
+        if torch.cuda.is_available():
+            sample['cuda_allocated'] = torch.cuda.memory_allocated()
+
+        self.iterations.append(iteration)
+        for name, value in sample.items():
+            self.history.setdefault(name, deque(maxlen=self.window)).append(value)
+        self._check_trend(iteration)
+        return {'Memory/' + name: value / 2 ** 20 for name, value in sample.items()}
+
+    def trend(self, name):
+        """
+        :return: least squares growth of the quantity in bytes per iteration over the window, None before the window is full
+        """
+        values = self.history.get(name)
+        if values is None or len(values) < self.window:
+            return None
+        iterations = np.array(self.iterations, dtype=np.float64)[-len(values):]
+        return float(np.polyfit(iterations - iterations[0], np.array(values, dtype=np.float64), 1)[0])
+
+    def _check_trend(self, iteration):
+        for name in self.history:
+            slope = self.trend(name)
+            if slope is not None and slope > self.warn_bytes_per_iteration:
+                if iteration - self._last_warning.get(name, -self.window) < self.window:
+                    continue
+                self._last_warning[name] = iteration
+                self.warnings += 1
+                self.log("[MemoryMonitor] possible leak at iteration {}: {} grows by {:.1f} MB per 100 iterations "
+                         "(now {:.1f} MB)".format(iteration, name, slope * 100 / 2 ** 20, self.history[name][-1] / 2 ** 20))
+
+    def format_report(self):
+        lines = []
+        for name, values in self.history.items():
+            slope = self.trend(name)
+            lines.append('{:<40} {:>10} {}'.format("memory " + name + ": ", '{:8.1f} MB'.format(values[-1] / 2 ** 20),
+                                                   '' if slope is None else '({:+.2f} MB / 100 it)'.format(slope * 100 / 2 ** 20)))
+        return '\n'.join(lines)
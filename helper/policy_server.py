@@ -0,0 +1,321 @@
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import deque
+import numpy as np
+import torch
+
+from raisimGymTorch.helper.checkpoint_evaluator import BatchedMLP, checkpoint_iteration, load_checkpoint_scaling
+
+
+# Wire format (little endian, native float32 payloads) on a SOCK_STREAM unix socket:
+#   server -> client on connect:  hello    (n_policies, ob_dim, act_dim)
+#   client -> server:             request  (policy, n_rows) + n_rows * ob_dim float32
+#   server -> client:             response (status, n_rows) + n_rows * act_dim float32
+# A client keeps at most one request in flight. status != 0 carries no payload (unknown policy / wrong size).
+_HELLO = struct.Struct('<III')
+_REQUEST = struct.Struct('<II')
+_RESPONSE = struct.Struct('<II')
+_STATUS_OK, _STATUS_UNKNOWN_POLICY, _STATUS_BAD_REQUEST = 0, 1, 2
+
+
+def _recv_exact(connection, n_bytes):
+    buffer = bytearray(n_bytes)
+    view = memoryview(buffer)
+    received = 0
+    while received < n_bytes:
+        n = connection.recv_into(view[received:])
+        if n == 0:
+            return None
+        received += n
+    return buffer
+
+
+class _Request:
+    # obs None: the client left, its connection is closed by the batch loop once the requests before it are answered
+    __slots__ = ['connection', 'policy', 'obs', 'arrival']
+
+    def __init__(self, connection, policy, obs):
+        self.connection = connection
+        self.policy = policy
+        self.obs = obs
+        self.arrival = time.perf_counter()
+
+
+class PolicyServer:
+    def __init__(self, weight_paths, socket_path, max_batch=256, max_wait=0.002, clip_obs=10., device='cpu',
+                 history=100000):
+        """
+        Serves trained actors (runner.py checkpoints with their observation normalization) to many robot / sim
+        processes on the same machine. Requests that arrive within max_wait of the first waiting one are evaluated
+        together, one forward pass per policy, so the per-request cost of the interpreter and of small matmuls is shared.
+
+        Latencies are kept for the last `history` requests:
+            queue:     arrival of the request -> start of the forward pass of its batch
+            inference: forward pass of the batch (normalization included)
+            total:     arrival -> response sent
+
+        :param weight_paths: full_<iteration>.pt, mean<iteration>.csv / var<iteration>.csv next to them. Policy k of the
+                             requests is weight_paths[k]; all policies take the same observation / action size
+        :param max_batch: rows after which a batch is closed without waiting for max_wait
+        :param max_wait: latency budget in seconds a request may wait for others to join its batch
+        """
+        self.weight_paths = list(weight_paths)
+        self.socket_path = socket_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.clip_obs = clip_obs
+        self.device = device
+
+        self.policies, self.obs_mean, self.obs_std = [], [], []
+        for path in self.weight_paths:
+            state_dict = torch.load(path, map_location='cpu')['actor_architecture_state_dict']
+            self.policies.append(BatchedMLP([state_dict]).to(device))
+            mean, var = load_checkpoint_scaling(path)
+            self.obs_mean.append(torch.from_numpy(mean).to(device))
+            self.obs_std.append(torch.from_numpy(np.sqrt(var + 1e-8)).to(device))
+        self.ob_dim = self.policies[0].weights[0].shape[1]
+        self.act_dim = self.policies[0].weights[-1].shape[2]
+        assert all(policy.weights[0].shape[1] == self.ob_dim and policy.weights[-1].shape[2] == self.act_dim
+                   for policy in self.policies), "All served policies need the same observation and action size"
+
+        self._requests = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._queue_time = deque(maxlen=history)
+        self._inference_time = deque(maxlen=history)
+        self._total_time = deque(maxlen=history)
+        self._batch_rows = deque(maxlen=history)
+        self.n_requests = 0
+        self.n_batches = 0
+
+        self._listener = None
+        self._threads = []
+        self._client_threads = []
+        self._connections = set()
+        self._running = False
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.socket_path)
+        self._listener.listen(128)
+        self._running = True
+        self._threads = [threading.Thread(target=self._accept_loop, daemon=True),
+                         threading.Thread(target=self._batch_loop, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._requests.put(None)
+        try:
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._listener.close()
+        accept_thread, batch_thread = self._threads
+        accept_thread.join()
+        # no connection is added anymore, the client loops stop once their connection is shut down
+        for connection in list(self._connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in self._client_threads + [batch_thread]:
+            thread.join()
+        # the batch loop has stopped, nothing sends anymore
+        for connection in list(self._connections):
+            connection.close()
+        self._connections.clear()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                connection, _ = self._listener.accept()
+            except OSError:
+                break
+            self._connections.add(connection)
+            thread = threading.Thread(target=self._client_loop, args=(connection,), daemon=True)
+            self._client_threads = [client for client in self._client_threads if client.is_alive()] + [thread]
+            thread.start()
+
+    def _client_loop(self, connection):
+        try:
+            connection.sendall(_HELLO.pack(len(self.policies), self.ob_dim, self.act_dim))
+            while self._running:
+                header = _recv_exact(connection, _REQUEST.size)
+                if header is None:
+                    break
+                policy, n_rows = _REQUEST.unpack(header)
+                payload = _recv_exact(connection, n_rows * self.ob_dim * 4)
+                if payload is None:
+                    break
+                if policy >= len(self.policies) or n_rows == 0:
+                    status = _STATUS_UNKNOWN_POLICY if policy >= len(self.policies) else _STATUS_BAD_REQUEST
+                    connection.sendall(_RESPONSE.pack(status, 0))
+                    continue
+                obs = np.frombuffer(payload, dtype=np.float32).reshape(n_rows, self.ob_dim)
+                self._requests.put(_Request(connection, policy, obs))
+        except OSError:
+            pass
+        finally:
+            # closed by the batch loop: it may still be answering a request of this connection, and a closed socket's
+            # file descriptor can be reused by the next client
+            self._requests.put(_Request(connection, None, None))
+
+    def _next_batch(self):
+        """
+        Blocks for the first request, then collects those arriving until its deadline (arrival + max_wait) or until
+        max_batch rows are waiting.
+
+        :return: requests of the batch, connections to close after answering them (None, None when stopped)
+        """
+        request = self._requests.get()
+        if request is None:
+            return None, None
+        batch, closed, n_rows = [], [], 0
+        deadline = request.arrival + self.max_wait
+        while True:
+            if request.obs is None:
+                closed.append(request.connection)
+            else:
+                batch.append(request)
+                n_rows += request.obs.shape[0]
+            if n_rows >= self.max_batch:
+                break
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self._requests.get(timeout=remaining) if remaining > 0 else self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._requests.put(None)
+                break
+        return batch, closed
+
+    def _close(self, connections):
+        for connection in connections:
+            self._connections.discard(connection)
+            connection.close()
+
+    @torch.no_grad()
+    def _batch_loop(self):
+        while self._running:
+            batch, closed = self._next_batch()
+            if batch is None:
+                break
+            if len(batch) == 0:
+                self._close(closed)
+                continue
+            start = time.perf_counter()
+            actions = [None] * len(batch)
+            for policy in set(request.policy for request in batch):
+                members = [i for i, request in enumerate(batch) if request.policy == policy]
+                obs = torch.from_numpy(np.concatenate([batch[i].obs for i in members])).to(self.device)
+                obs = torch.clamp((obs - self.obs_mean[policy]) / self.obs_std[policy], -self.clip_obs, self.clip_obs)
+                action = self.policies[policy](obs.unsqueeze(0))[0].cpu().numpy()
+                offset = 0
+                for i in members:
+                    n = batch[i].obs.shape[0]
+                    actions[i] = action[offset:offset + n]
+                    offset += n
+            inference_end = time.perf_counter()
+
+            for request, action in zip(batch, actions):
+                try:
+                    request.connection.sendall(_RESPONSE.pack(_STATUS_OK, action.shape[0]) + action.tobytes())
+                except OSError:
+                    pass
+            end = time.perf_counter()
+            self._close(closed)
+
+            with self._stats_lock:
+                self.n_requests += len(batch)
+                self.n_batches += 1
+                self._batch_rows.append(sum(request.obs.shape[0] for request in batch))
+                for request in batch:
+                    self._queue_time.append(start - request.arrival)
+                    self._inference_time.append(inference_end - start)
+                    self._total_time.append(end - request.arrival)
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """
+        :return: {'queue' / 'inference' / 'total': {percentile: milliseconds}, 'mean_batch_rows', 'requests', 'batches'}
+        """
+        with self._stats_lock:
+            samples = {'queue': np.array(self._queue_time), 'inference': np.array(self._inference_time),
+                       'total': np.array(self._total_time)}
+            report = {'mean_batch_rows': float(np.mean(self._batch_rows)) if len(self._batch_rows) > 0 else 0.,
+                      'requests': self.n_requests, 'batches': self.n_batches}
+        for name, times in samples.items():
+            report[name] = {p: (float(np.percentile(times, p)) * 1e3 if times.size > 0 else 0.) for p in percentiles}
+        return report
+
+    def reset_stats(self):
+        with self._stats_lock:
+            for samples in [self._queue_time, self._inference_time, self._total_time, self._batch_rows]:
+                samples.clear()
+            self.n_requests = 0
+            self.n_batches = 0
+
+    def format_report(self, percentiles=(50, 90, 99)):
+        report = self.latency_percentiles(percentiles)
+        lines = ['{:<12} '.format('latency[ms]') + ' '.join('{:>9}'.format('p{}'.format(p)) for p in percentiles)]
+        for name in ['queue', 'inference', 'total']:
+            lines.append('{:<12} '.format(name) + ' '.join('{:9.3f}'.format(report[name][p]) for p in percentiles))
+        lines.append('{} requests in {} batches, {:.1f} rows per batch'.format(report['requests'], report['batches'],
+                                                                           report['mean_batch_rows']))
+        return '\n'.join(lines)
+
+    def policy_names(self):
+        return ['{}:{}'.format(os.path.basename(os.path.dirname(path)), checkpoint_iteration(path)) for path in self.weight_paths]
+
+
+class PolicyClient:
+    def __init__(self, socket_path, timeout=None):
+        """
+        Blocking client of PolicyServer, one request in flight.
+        """
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.settimeout(timeout)
+        self.connection.connect(socket_path)
+        hello = _recv_exact(self.connection, _HELLO.size)
+        assert hello is not None, "Policy server closed the connection"
+        self.n_policies, self.ob_dim, self.act_dim = _HELLO.unpack(hello)
+
+    def act(self, obs, policy=0):
+        """
+        :param obs: raw (unnormalized) observation, (ob_dim,) or (n_rows, ob_dim)
+        :return: action, (act_dim,) or (n_rows, act_dim)
+        """
+        obs = np.ascontiguousarray(obs, dtype=np.float32)
+        rows = obs.reshape(-1, self.ob_dim)
+        self.connection.sendall(_REQUEST.pack(policy, rows.shape[0]) + rows.tobytes())
+        header = _recv_exact(self.connection, _RESPONSE.size)
+        assert header is not None, "Policy server closed the connection"
+        status, n_rows = _RESPONSE.unpack(header)
+        assert status == _STATUS_OK, "Request rejected by the policy server (policy {}, status {})".format(policy, status)
+        action = np.frombuffer(_recv_exact(self.connection, n_rows * self.act_dim * 4), dtype=np.float32)
+        return action.reshape(self.act_dim) if obs.ndim == 1 else action.reshape(n_rows, self.act_dim)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,43 @@
+import queue
+import threading
+
+
+def prefetch(iterable, depth=2, name="prefetch"):
+    """
+    Iterates `iterable` on a background thread, up to `depth` items ahead of the consumer. An exception of the producer is
+    raised on the consumer side. Closing the generator early (break, garbage collection) stops the producer.
+    """
+    items = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(end)
+        except Exception as error:
+            put(error)
+
+    producer = threading.Thread(target=produce, name=name, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,141 @@
+import os
+import sys
+import signal
+import threading
+from collections import defaultdict
+import torch
+
+
+def parse_window(window):
+    """
+    :param window: "200-202" (inclusive), "200" or "" (off)
+    :return: first, last index or None, None
+    """
+    window = str(window).strip()
+    if window == '':
+        return None, None
+    first, _, last = window.partition('-')
+    first = int(first)
+    last = int(last) if last != '' else first
+    assert last >= first, "Invalid profiling window {}".format(window)
+    return first, last
+
+
+class PythonSampler(threading.Thread):
+    def __init__(self, thread_id, interval=0.005):
+        """
+        Samples the python stack of one thread every `interval` seconds. The samples are kept as collapsed stacks
+        ("outer;...;inner count" lines, the input of flamegraph.pl / speedscope). Time spent in C++ with the GIL released
+        (e.g. env.step) is attributed to the python line that called it.
+        """
+        super(PythonSampler, self).__init__(name="python_sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = defaultdict(int)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+                f.write('{} {}\n'.format(stack, count))
+
+
+class ProfileWindow:
+    def __init__(self, out_dir, window='', use_signal=True, tag='update', signal_length=None, sample_interval=0.005):
+        """
+        Captures a few iterations of a running loop with torch.profiler (CPU, and CUDA when available) and a python
+        stack sampler, triggered by a configured window of iterations or by a signal sent to the process:
+
+            kill -USR1 <pid>   # profiles the next signal_length iterations
+
+        Call step(index) at the start of every iteration and close() after the loop. Outside of a capture step() only
+        compares the index and a flag. Files written to out_dir per capture, <name> = profile_<tag><first>-<last>:
+            <name>.json         chrome trace (chrome://tracing, perfetto)
+            <name>.stacks       torch operator stacks with their self cpu time (flamegraph.pl)
+            <name>.py.folded    sampled python stacks (flamegraph.pl, speedscope)
+            <name>.txt          operator table sorted by cpu time
+
+        :param window: "first-last" iterations (inclusive) or "" for signal-triggered captures only
+        :param signal_length: iterations of a signal-triggered capture, default: length of the window or 1
+        """
+        self.out_dir = out_dir
+        self.tag = tag
+        self.sample_interval = sample_interval
+        self.first, self.last = parse_window(window)
+        if signal_length is None:
+            signal_length = 1 if self.first is None else self.last - self.first + 1
+        self.signal_length = signal_length
+        self.files = []
+
+        self._requested = False
+        self._profiler = None
+        self._sampler = None
+        self._capture_first = None
+        self._capture_end = None
+        if use_signal and hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self._requested = True
+
+    @property
+    def active(self):
+        return self._profiler is not None
+
+    def step(self, index):
+        if self._profiler is not None:
+            if index < self._capture_end:
+                return
+            self._finish(index - 1)
+        if index == self.first:
+            self._begin(index, self.last + 1)
+        elif self._requested:
+            self._requested = False
+            self._begin(index, index + self.signal_length)
+
+    def close(self, last_index=None):
+        """
+        Ends a capture that is still open (the loop ended inside the window).
+        """
+        if self._profiler is not None:
+            self._finish(self._capture_end - 1 if last_index is None else last_index)
+
+    def _begin(self, index, end):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        print("[ProfileWindow] profiling {} {} to {}".format(self.tag, index, end - 1))
+        self._capture_first, self._capture_end = index, end
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=False, with_stack=True)
+        self._profiler.__enter__()
+        self._sampler = PythonSampler(threading.main_thread().ident, self.sample_interval)
+        self._sampler.start()
+
+    def _finish(self, last_index):
+        self._sampler.stop()
+        self._profiler.__exit__(None, None, None)
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = os.path.join(self.out_dir, "profile_{}{}-{}".format(self.tag, self._capture_first, last_index))
+        self._profiler.export_chrome_trace(name + ".json")
+        self._profiler.export_stacks(name + ".stacks", "self_cpu_time_total")
+        self._sampler.save(name + ".py.folded")
+        with open(name + ".txt", 'w') as f:
+            f.write(self._profiler.key_averages().table(sort_by="cpu_time_total", row_limit=50))
+        self.files.append(name)
+        print("[ProfileWindow] written {}.(json|stacks|py.folded|txt)".format(name))
+        self._profiler, self._sampler = None, None
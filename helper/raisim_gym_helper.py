@@ -2,12 +2,28 @@ from shutil import copyfile
 import datetime
 import os
 import ntpath
+import random
+import time
+import importlib
+import threading
 import torch
 import numpy as np
 
 
+# version of the save_training_snapshot format, bumped on incompatible changes
+SNAPSHOT_VERSION = 1
+
+_module_import_time = time.time()
+
+
 class ConfigurationSaver:
-    def __init__(self, log_dir, save_items):
+    def __init__(self, log_dir, save_items, data_dir=None):
+        """
+        :param data_dir: existing run directory to continue (e.g. when resuming from a snapshot), nothing is copied into it
+        """
+        if data_dir is not None:
+            self._data_dir = data_dir
+            return
         self._data_dir = log_dir + '/' + datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
         os.makedirs(self._data_dir)
 
@@ -21,6 +37,56 @@ class ConfigurationSaver:
         return self._data_dir
         
 
+class StartupTimer:
+    def __init__(self):
+        """
+        Wall time of the startup phases of a script (lap after each phase), printed by report().
+        Starts at the import of this module when the script imports it first.
+        """
+        self._start = _module_import_time
+        self._last = self._start
+        self.phases = []
+
+    def lap(self, name):
+        now = time.time()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def report(self, env=None):
+        """
+        :param env: RaisimGymVecEnv, adds the phases of the C++ environment construction
+        """
+        print('----------------------------------------------------')
+        print('startup')
+        for name, seconds in self.phases:
+            print('{:<40} {:>6}'.format(name + ": ", '{:6.2f}'.format(seconds)))
+        if env is not None:
+            timings = env.startup_timings
+            for name in ['construction', 'init', 'randomization_table', 'reset']:
+                print('{:<40} {:>6}'.format("  env " + name + ": ", '{:6.2f}'.format(timings[name])))
+            print('{:<40} {:>6}'.format("  env threads: ", '{:6.0f}'.format(timings['threads'])))
+            if timings.get('model_cache_reads', 0) > 0:
+                # disk reads of the robot description saved by the cache, estimated from the reads it did
+                saved = timings['model_cache_hits'] * timings['model_cache_read_seconds'] / timings['model_cache_reads']
+                print('{:<40} {:>6}'.format("  env model cache saved (est.): ", '{:6.2f}'.format(saved)))
+        print('{:<40} {:>6}'.format("total: ", '{:6.2f}'.format(self._last - self._start)))
+        print('----------------------------------------------------\n')
+
+
+def import_in_background(*module_names):
+    """
+    Imports slow modules (e.g. wandb) on a thread while the main thread constructs the environment,
+    which releases the GIL. Join the returned thread before using them.
+    """
+    def import_modules():
+        for module_name in module_names:
+            importlib.import_module(module_name)
+
+    thread = threading.Thread(target=import_modules, daemon=True)
+    thread.start()
+    return thread
+
+
 def tensorboard_launcher(directory_path):
     from tensorboard import program
     import webbrowser
@@ -60,6 +126,63 @@ def load_param(weight_path, env, actor, critic, optimizer, data_dir):
     critic.architecture.load_state_dict(checkpoint['critic_architecture_state_dict'])
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
+def save_training_snapshot(file_name, update, env, actor, critic, ppo, extra=None):
+    """
+    Everything needed to continue training after iteration `update`: network weights (same keys as the full_*.pt
+    checkpoints), PPO learner state (with the optimizer), environment state (RaisimGymVecEnv.get_state, with the reset
+    generator of every env) and the python / numpy / torch RNG states.
+    The file is written next to file_name and renamed, so an interrupted save never replaces the previous snapshot.
+
+    :param extra: picklable runner state (e.g. logging state), returned by load_training_snapshot
+    """
+    snapshot = {'version': SNAPSHOT_VERSION,
+                'update': update,
+                'actor_architecture_state_dict': actor.architecture.state_dict(),
+                'actor_distribution_state_dict': actor.distribution.state_dict(),
+                'critic_architecture_state_dict': critic.architecture.state_dict(),
+                'ppo': ppo.state_dict(),
+                'env': env.get_state(),
+                'rng': {'python': random.getstate(),
+                        'numpy': np.random.get_state(),
+                        'torch': torch.get_rng_state(),
+                        'torch_cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None},
+                'extra': extra}
+    tmp_file_name = file_name + '.tmp'
+    torch.save(snapshot, tmp_file_name)
+    os.replace(tmp_file_name, file_name)
+
+
+def load_training_snapshot(file_name, env, actor, critic, ppo, device='cpu'):
+    """
+    Restores a save_training_snapshot file into already constructed env / actor / critic / ppo.
+
+    :return: next iteration to run, extra runner state of the snapshot
+    """
+    if not os.path.isfile(file_name):
+        raise Exception("\nCan't find the training snapshot " + file_name + "\n")
+    try:
+        # the snapshot holds numpy arrays and RNG states besides tensors
+        snapshot = torch.load(file_name, map_location=device, weights_only=False)
+    except TypeError:  # torch < 1.13
+        snapshot = torch.load(file_name, map_location=device)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise Exception("\nUnsupported training snapshot version {} (expected {})\n".format(snapshot.get('version'), SNAPSHOT_VERSION))
+    print("\nResuming from the snapshot:", file_name, "(iteration {})\n".format(snapshot['update']))
+
+    actor.architecture.load_state_dict(snapshot['actor_architecture_state_dict'])
+    actor.distribution.load_state_dict(snapshot['actor_distribution_state_dict'])
+    critic.architecture.load_state_dict(snapshot['critic_architecture_state_dict'])
+    ppo.load_state_dict(snapshot['ppo'])
+    env.set_state(snapshot['env'])
+
+    random.setstate(snapshot['rng']['python'])
+    np.random.set_state(snapshot['rng']['numpy'])
+    torch.set_rng_state(snapshot['rng']['torch'].cpu())
+    if snapshot['rng']['torch_cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in snapshot['rng']['torch_cuda']])
+    return snapshot['update'] + 1, snapshot['extra']
+
+
 def load_enviroment_model_param(weight_path, model, optimizer, data_dir, device):
     if weight_path == "":
         raise Exception("\nCan't find the pre-trained weight, please provide a pre-trained weight with --weight switch\n")
@@ -0,0 +1,200 @@
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+
+import numpy as np
+import torch
+from raisimGymTorch.helper.prefetch import prefetch as prefetch_batches
+
+
+STORAGE_COLUMNS = {
+    'obs': 'actor_obs',
+    'critic_obs': 'critic_obs',
+    'actions': 'actions',
+    'actions_log_prob': 'actions_log_prob',
+    'rewards': 'rewards',
+    'dones': 'dones',
+    'values': 'values',
+}
+
+
+class RolloutExporter:
+    def __init__(self, log_dir, compress=True, compress_level=1, max_pending=2, export_critic_obs=False):
+        """
+        Streams every PPO rollout to disk as one chunk directory with one file per column (time-major, (n_steps, num_envs, dim)).
+        The rollout is copied out of the storage on the calling thread, compression and writing happen in a background thread.
+        If the writer falls behind by more than max_pending rollouts, new rollouts are dropped instead of blocking training.
+
+        :param log_dir: dataset directory (created if needed)
+        :param compress: gzip the column files (RolloutDataset decompresses them once into a cache before memory-mapping)
+        :param compress_level: gzip level, 1 is the fastest
+        :param max_pending: rollouts that may wait for the writer thread
+        :param export_critic_obs: also export critic observations (skipped by default since runner.py uses the same obs for both)
+        """
+        self.log_dir = log_dir
+        self.compress = compress
+        self.compress_level = compress_level
+        self.export_critic_obs = export_critic_obs
+        self.n_exported = 0
+        self.n_dropped = 0
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, name="rollout_exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, storage, update, **extra_columns):
+        """
+        Must be called before ppo.update (which normalizes the rewards in place and clears the storage).
+
+        :param storage: RolloutStorage holding a full rollout
+        :param update: update index, used as chunk name
+        :param extra_columns: additional time-major arrays (n_steps, num_envs, ...), e.g. reward_breakdown or commands
+        """
+        if self._error is not None:
+            raise RuntimeError("Rollout export failed") from self._error
+        if self._queue.full():
+            self.n_dropped += 1
+            print("[RolloutExporter] writer is busy, dropped rollout of update {} ({} dropped so far)".format(update, self.n_dropped))
+            return
+
+        columns = dict()
+        for name, attribute in STORAGE_COLUMNS.items():
+            if name == 'critic_obs' and not self.export_critic_obs:
+                continue
+            tensor = getattr(storage, attribute, None)
+            if tensor is None:
+                continue
+            columns[name] = tensor[:storage.step].detach().cpu().numpy().copy()
+        n_steps, num_envs = columns['obs'].shape[:2]
+        for name, value in extra_columns.items():
+            value = np.array(value, copy=True)
+            assert value.shape[:2] == (n_steps, num_envs), \
+                "Extra column {} should be time-major (n_steps, num_envs, ...), got {}".format(name, value.shape)
+            columns[name] = value
+        self._queue.put((update, columns))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError("Rollout export failed") from self._error
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write_chunk(*item)
+                self.n_exported += 1
+            except Exception as error:
+                self._error = error
+
+    def _write_chunk(self, update, columns):
+        chunk_name = "chunk_{:06d}".format(update)
+        tmp_dir = os.path.join(self.log_dir, "." + chunk_name)
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        meta = {'update': update, 'compressed': self.compress, 'columns': dict()}
+        for name, array in columns.items():
+            file_name = os.path.join(tmp_dir, name + ".npy")
+            if self.compress:
+                with gzip.open(file_name + ".gz", 'wb', compresslevel=self.compress_level) as f:
+                    np.save(f, array)
+            else:
+                np.save(file_name, array)
+            meta['columns'][name] = {'shape': list(array.shape), 'dtype': str(array.dtype)}
+        with open(os.path.join(tmp_dir, "meta.json"), 'w') as f:
+            json.dump(meta, f)
+
+        # chunks only become visible to RolloutDataset once they are complete
+        os.replace(tmp_dir, os.path.join(self.log_dir, chunk_name))
+
+
+class RolloutDataset:
+    def __init__(self, log_dir, cache_dir=None):
+        """
+        Memory-mapped view over the chunks written by RolloutExporter.
+        Transitions of a chunk are flattened in (step, env) order, i.e. a column is read as (n_steps * num_envs, dim).
+
+        :param log_dir: dataset directory
+        :param cache_dir: where compressed chunks are decompressed once (default: log_dir/.cache)
+        """
+        self.log_dir = log_dir
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(log_dir, ".cache")
+        self.chunks = sorted(name for name in os.listdir(log_dir)
+                             if name.startswith("chunk_") and os.path.isfile(os.path.join(log_dir, name, "meta.json")))
+        self.meta = dict()
+        for chunk in self.chunks:
+            with open(os.path.join(log_dir, chunk, "meta.json"), 'r') as f:
+                self.meta[chunk] = json.load(f)
+        self.chunk_sizes = [self._n_transitions(chunk) for chunk in self.chunks]
+
+    def __len__(self):
+        return sum(self.chunk_sizes)
+
+    @property
+    def columns(self):
+        if len(self.chunks) == 0:
+            return []
+        return list(self.meta[self.chunks[0]]['columns'].keys())
+
+    def column(self, chunk, name):
+        """
+        :return: read-only memory map of shape (n_steps * num_envs, *feature_shape)
+        """
+        column_meta = self.meta[chunk]['columns'][name]
+        shape = column_meta['shape']
+        file_name = os.path.join(self.log_dir, chunk, name + ".npy")
+
+        if self.meta[chunk]['compressed']:
+            cached_file_name = os.path.join(self.cache_dir, chunk, name + ".npy")
+            if not os.path.isfile(cached_file_name):
+                os.makedirs(os.path.dirname(cached_file_name), exist_ok=True)
+                with gzip.open(file_name + ".gz", 'rb') as src, open(cached_file_name + ".tmp", 'wb') as dst:
+                    shutil.copyfileobj(src, dst, length=1 << 24)
+                os.replace(cached_file_name + ".tmp", cached_file_name)
+            file_name = cached_file_name
+
+        array = np.load(file_name, mmap_mode='r')
+        return array.reshape(shape[0] * shape[1], *shape[2:])
+
+    def load(self, name):
+        """
+        :return: the whole column over all chunks, (len(self), *feature_shape)
+        """
+        return np.concatenate([np.asarray(self.column(chunk, name)) for chunk in self.chunks], axis=0)
+
+    def mini_batch_generator(self, batch_size, columns=None, shuffle=True, drop_last=True, device='cpu', prefetch=2, seed=None):
+        """
+        Yields dicts of torch tensors. Batches are drawn chunk by chunk, and the indices of a batch are sorted, so reads from the
+        memory maps stay mostly sequential. A background thread prepares up to `prefetch` batches ahead.
+        """
+        columns = self.columns if columns is None else columns
+        rng = np.random.default_rng(seed)
+
+        def batches():
+            chunk_order = rng.permutation(len(self.chunks)) if shuffle else range(len(self.chunks))
+            for chunk_id in chunk_order:
+                chunk = self.chunks[chunk_id]
+                arrays = {name: self.column(chunk, name) for name in columns}
+                n = self.chunk_sizes[chunk_id]
+                indices = rng.permutation(n) if shuffle else np.arange(n)
+                for start in range(0, n, batch_size):
+                    batch_indices = indices[start:start + batch_size]
+                    if drop_last and len(batch_indices) < batch_size:
+                        break
+                    batch_indices = np.sort(batch_indices)
+                    yield {name: torch.from_numpy(np.ascontiguousarray(array[batch_indices])) for name, array in arrays.items()}
+
+        for batch in prefetch_batches(batches(), prefetch, name="rollout_dataset_prefetch"):
+            yield {name: value.to(device) for name, value in batch.items()}
+
+    def _n_transitions(self, chunk):
+        shape = next(iter(self.meta[chunk]['columns'].values()))['shape']
+        return shape[0] * shape[1]
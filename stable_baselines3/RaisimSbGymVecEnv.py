@@ -14,7 +14,26 @@ from stable_baselines3.common.vec_env.base_vec_env import VecEnv, VecEnvIndices,
 class RaisimSbGymVecEnv(VecEnv):
     metadata = {}
 
-    def __init__(self, impl, cfg, normalize_ob=True, seed=0, normalize_rew=True, clip_obs=10.):
+    def __init__(self, impl, cfg, normalize_ob=True, seed=0, normalize_rew=True, clip_obs=10., max_episode_steps=None,
+                 user_command=None, n_obs_buffers=2):
+        """
+        Stable-baselines3 VecEnv over the vectorized raisim environment.
+
+        Observations are written by the environment and normalized in place into persistent buffers, step_wait / reset return
+        one of n_obs_buffers sets of buffers in turn (no per-step allocation). Returned observations, rewards, dones and
+        terminal observations therefore stay valid for n_obs_buffers - 1 further steps, which covers the on- and off-policy
+        algorithms of sb3 (they hold the last and the new observation); copy them to keep them longer. The infos list and its
+        dicts are reused as well, the entries of the previous step are cleared.
+
+        Terminated envs are reset automatically by the environment, their infos hold the normalized "terminal_observation".
+        The environment has no time limit of its own, with max_episode_steps episodes are truncated
+        (infos: "TimeLimit.truncated") like the fixed-length rollouts of runner.py.
+
+        :param cfg: the environment section of cfg.yaml
+        :param max_episode_steps: episode length, default: max_time / control_dt of cfg (None in cfg: no limit)
+        :param user_command: helper.raisim_gym_helper.UserCommand, resampled every command_period (envs keep their command otherwise)
+        :param n_obs_buffers: number of observation buffers returned in turn
+        """
         if platform.system() == "Darwin":
             os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
 
@@ -28,14 +47,34 @@ class RaisimSbGymVecEnv(VecEnv):
         self.action_space = gym.spaces.Box(-np.full(self.num_acts, np.inf), np.full(self.num_acts, np.inf), dtype=np.float32)
         super(RaisimSbGymVecEnv, self).__init__(self.wrapper.getNumOfEnvs(), self.observation_space, self.action_space)
 
+        if max_episode_steps is None and 'max_time' in cfg:
+            max_episode_steps = int(cfg['max_time'] / cfg['control_dt'])
+        self.max_episode_steps = max_episode_steps
+        self.user_command = user_command
+        self.command_period_steps = int(cfg['command_period'] / cfg['control_dt']) if user_command is not None else None
+
+        n_obs_buffers = max(n_obs_buffers, 1)
         self._observation = np.zeros([self.num_envs, self.num_obs], dtype=np.float32)
-        self.obs_rms = RunningMeanStd(shape=[self.num_envs, self.num_obs])
-        self._reward = np.zeros(self.num_envs, dtype=np.float32)
-        self._done = np.zeros(self.num_envs, dtype=np.bool)
+        self._obs_buffers = [np.zeros([self.num_envs, self.num_obs], dtype=np.float32) for _ in range(n_obs_buffers)]
+        self._reward_buffers = [np.zeros(self.num_envs, dtype=np.float32) for _ in range(n_obs_buffers)]
+        self._done_buffers = [np.zeros(self.num_envs, dtype=bool) for _ in range(n_obs_buffers)]
+        self._terminal_obs_buffers = [np.zeros([self.num_envs, self.num_obs], dtype=np.float32) for _ in range(n_obs_buffers)]
+        self._obs_buffer_id = 0
+        self._terminal_observation = np.zeros([self.num_envs, self.num_obs], dtype=np.float32)
+        self.obs_rms = RunningMeanStd(shape=[self.num_obs])
+        self._obs_scale = np.ones(self.num_obs, dtype=np.float32)
+        self._update_obs_scale()
+        self._terminated = np.zeros(self.num_envs, dtype=bool)
+        self._truncated = np.zeros(self.num_envs, dtype=bool)
+        self._infos = [{} for _ in range(self.num_envs)]
+        self._episode_steps = np.zeros(self.num_envs, dtype=np.int64)
+        self._total_steps = 0
         self.rewards = [[] for _ in range(self.num_envs)]
         self.seed(seed)
         self.actions = None
 
+        self.wrapper.enableTerminalObservation(True)
+
     def seed(self, seed=None):
         self.wrapper.setSeed(seed)
 
@@ -52,27 +91,81 @@ class RaisimSbGymVecEnv(VecEnv):
         self.wrapper.stopRecordingVideo()
 
     def step_async(self, actions: np.ndarray) -> None:
-        self.actions = actions
+        self.actions = np.ascontiguousarray(actions, dtype=np.float32)
 
     def step_wait(self):
-        self.wrapper.step(self.actions, self._reward, self._done)
-        return self.observe(True), self._reward.copy(), self._done.copy(), []
+        if self.user_command is not None and self._total_steps % self.command_period_steps == 0:
+            self.wrapper.set_user_command(self.user_command.uniform_sample_train())
+
+        # the buffers of this step, observe() below moves on to the next set
+        reward = self._reward_buffers[self._obs_buffer_id]
+        dones = self._done_buffers[self._obs_buffer_id]
+        terminal_observation = self._terminal_obs_buffers[self._obs_buffer_id]
+
+        self.wrapper.step(self.actions, reward, self._terminated)
+        self._total_steps += 1
+        self._episode_steps += 1
+
+        # envs that terminated were reset by the environment, the time limit is applied here
+        if self.max_episode_steps is not None:
+            np.greater_equal(self._episode_steps, self.max_episode_steps, out=self._truncated)
+            # truncated and not terminated
+            np.greater(self._truncated, self._terminated, out=self._truncated)
+        if self._terminated.any():
+            self.wrapper.getTerminalObservation(self._terminal_observation, self._terminated)
+        if self._truncated.any():
+            # the observation before the reset is the terminal observation of a truncated episode
+            self.wrapper.observe(self._observation)
+            np.copyto(self._terminal_observation, self._observation, where=self._truncated[:, None])
+            self.wrapper.partial_reset(self._truncated)
+        np.logical_or(self._terminated, self._truncated, out=dones)
+        np.copyto(self._episode_steps, 0, where=dones)
+
+        # normalized with the statistics the episode was observed with, before observe() adds the post-reset batch
+        any_done = dones.any()
+        if any_done:
+            self._normalize_observation(self._terminal_observation, out=terminal_observation)
+
+        obs = self.observe(True)
+        for info in self._infos:
+            if info:
+                info.clear()
+        if any_done:
+            for env_id in np.flatnonzero(dones):
+                self._infos[env_id]["terminal_observation"] = terminal_observation[env_id]
+                self._infos[env_id]["TimeLimit.truncated"] = bool(self._truncated[env_id])
+        return obs, reward, dones, self._infos
 
     def env_method(self, method_name: str, *method_args, indices: VecEnvIndices = None, **method_kwargs):
-        pass
+        """
+        The envs only exist in C++, methods of this VecEnv act on all of them at once:
+        the method is called once and its result is returned for every requested index.
+        """
+        indices = self._get_indices(indices)
+        result = getattr(self, method_name)(*method_args, **method_kwargs)
+        return [result for _ in indices]
 
     def get_attr(self, attr_name: str, indices: VecEnvIndices = None):
-        pass
+        indices = self._get_indices(indices)
+        value = getattr(self, attr_name)
+        return [value for _ in indices]
 
     def set_attr(self, attr_name: str, value: Any, indices: VecEnvIndices = None):
-        pass
+        indices = list(self._get_indices(indices))
+        if sorted(set(indices)) != list(range(self.num_envs)):
+            raise ValueError("The raisim envs are one C++ object behind this VecEnv, their attributes are shared and cannot "
+                             "differ between envs: set_attr needs all envs (indices=None), got {} of {}"
+                             .format(len(set(indices)), self.num_envs))
+        setattr(self, attr_name, value)
 
     def load_scaling(self, dir_name, iteration, count=1e5):
         mean_file_name = dir_name + "/mean" + str(iteration) + ".csv"
         var_file_name = dir_name + "/var" + str(iteration) + ".csv"
+        # runner.py saves one identical row per env (RaisimGymVecEnv.save_scaling), obs_rms holds a single row
         self.obs_rms.count = count
-        self.obs_rms.mean = np.loadtxt(mean_file_name, dtype=np.float32)
-        self.obs_rms.var = np.loadtxt(var_file_name, dtype=np.float32)
+        self.obs_rms.mean = np.atleast_2d(np.loadtxt(mean_file_name, dtype=np.float32))[0]
+        self.obs_rms.var = np.atleast_2d(np.loadtxt(var_file_name, dtype=np.float32))[0]
+        self._update_obs_scale()
 
     def save_scaling(self, dir_name, iteration):
         mean_file_name = dir_name + "/mean" + iteration + ".csv"
@@ -81,28 +174,40 @@ class RaisimSbGymVecEnv(VecEnv):
         np.savetxt(var_file_name, self.obs_rms.var)
 
     def observe(self, update_mean=True):
+        """
+        :return: the next observation buffer, normalized in place (see __init__ for its lifetime)
+        """
         self.wrapper.observe(self._observation)
+        if self.normalize_ob and update_mean:
+            self.obs_rms.update(self._observation)
+            self._update_obs_scale()
 
-        if self.normalize_ob:
-            if update_mean:
-                self.obs_rms.update(self._observation)
-
-            return self._normalize_observation(self._observation)
-        else:
-            return self._observation.copy()
+        obs = self._obs_buffers[self._obs_buffer_id]
+        self._obs_buffer_id = (self._obs_buffer_id + 1) % len(self._obs_buffers)
+        return self._normalize_observation(self._observation, out=obs)
 
     def reset(self):
-        self._reward = np.zeros(self.num_envs, dtype=np.float32)
+        for reward in self._reward_buffers:
+            reward.fill(0.)
+        self._episode_steps.fill(0)
+        self._total_steps = 0
+        self.wrapper.initialize_n_step()
         self.wrapper.reset()
         return self.observe(False)
 
-    def _normalize_observation(self, obs):
-        if self.normalize_ob:
+    def _update_obs_scale(self):
+        np.add(self.obs_rms.var, 1e-8, out=self._obs_scale, casting='unsafe')
+        np.sqrt(self._obs_scale, out=self._obs_scale)
+        np.divide(1., self._obs_scale, out=self._obs_scale)
 
-            return np.clip((obs - self.obs_rms.mean) / np.sqrt(self.obs_rms.var + 1e-8), -self.clip_obs,
-                           self.clip_obs)
+    def _normalize_observation(self, obs, out):
+        if self.normalize_ob:
+            np.subtract(obs, self.obs_rms.mean, out=out)
+            np.multiply(out, self._obs_scale, out=out)
+            np.clip(out, -self.clip_obs, self.clip_obs, out=out)
         else:
-            return obs
+            np.copyto(out, obs)
+        return out
 
     def close(self):
         self.wrapper.close()
@@ -114,43 +219,49 @@ class RaisimSbGymVecEnv(VecEnv):
         pass
 
     def env_is_wrapped(self, wrapper_class: Type[gym.Wrapper], indices: VecEnvIndices = None) -> List[bool]:
-        """Check if worker environments are wrapped with a given wrapper"""
-        target_envs = self._get_target_envs(indices)
-        # Import here to avoid a circular import
-        from stable_baselines3.common import env_util
-
-        return [env_util.is_wrapped(env_i, wrapper_class) for env_i in target_envs]
+        """The raisim envs are C++ objects, they are never wrapped by gym wrappers"""
+        return [False for _ in self._get_indices(indices)]
 
 
 class RunningMeanStd(object):
     def __init__(self, epsilon=1e-4, shape=()):
         """
+        Running mean / var of a batch stream, updated in place (mean and var are never reassigned by an update).
+
         :param epsilon: (float) helps with arithmetic issues
         :param shape: (tuple) the shape of the data stream's output
         """
         self.mean = np.zeros(shape, 'float32')
         self.var = np.ones(shape, 'float32')
         self.count = epsilon
+        self._batch_mean = np.zeros(shape, 'float32')
+        self._batch_var = np.zeros(shape, 'float32')
+        self._deviation = None
 
     def update(self, arr):
-        batch_mean = np.mean(arr, axis=0)
-        batch_var = np.var(arr, axis=0)
-        batch_count = arr.shape[0]
-        self.update_from_moments(batch_mean, batch_var, batch_count)
+        if self._deviation is None or self._deviation.shape != arr.shape:
+            self._deviation = np.empty(arr.shape, 'float32')
+        np.mean(arr, axis=0, out=self._batch_mean)
+        np.subtract(arr, self._batch_mean, out=self._deviation)
+        np.square(self._deviation, out=self._deviation)
+        np.mean(self._deviation, axis=0, out=self._batch_var)
+        self.update_from_moments(self._batch_mean, self._batch_var, arr.shape[0])
 
     def update_from_moments(self, batch_mean, batch_var, batch_count):
-        delta = batch_mean - self.mean
+        """
+        Merges the moments of a batch (Chan et al.), batch_mean and batch_var are overwritten.
+        """
         tot_count = self.count + batch_count
-
-        new_mean = self.mean + delta * batch_count / tot_count
-        m_a = self.var * self.count
-        m_b = batch_var * batch_count
-        m_2 = m_a + m_b + np.square(delta) * (self.count * batch_count / (self.count + batch_count))
-        new_var = m_2 / (self.count + batch_count)
-
-        new_count = batch_count + self.count
-
-        self.mean = new_mean
-        self.var = new_var
-        self.count = new_count
-
+        delta = np.subtract(batch_mean, self.mean, out=batch_mean)
+
+        # var = (var * count + batch_var * batch_count + delta^2 * count * batch_count / tot_count) / tot_count
+        self.var *= self.count / tot_count
+        np.multiply(batch_var, batch_count / tot_count, out=batch_var)
+        self.var += batch_var
+        np.multiply(delta, delta, out=batch_var)
+        batch_var *= self.count * batch_count / (tot_count * tot_count)
+        self.var += batch_var
+
+        delta *= batch_count / tot_count
+        self.mean += delta
+        self.count = tot_count
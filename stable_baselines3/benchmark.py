@@ -0,0 +1,120 @@
+"""
+Throughput of stable-baselines3 PPO on RaisimSbGymVecEnv against the in-repo PPO (runner.py loop) on the same environment.
+
+Both learners use the runner.py setup: [128, 128] LeakyReLU actor and critic, n_steps = max_time / control_dt,
+4 epochs of 4 minibatches, commands resampled every command_period. Reported per learner: env steps/s of the rollouts,
+wall time per iteration and overall env steps/s (rollout + update).
+
+    python raisimGymTorch/stable_baselines3/benchmark.py --iterations 5 --num_envs 500
+"""
+import argparse
+import math
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from ruamel.yaml import YAML, dump, RoundTripDumper
+
+from raisimGymTorch.env.bin import command_tracking_flat
+from raisimGymTorch.env.RaisimGymVecEnv import RaisimGymVecEnv
+from raisimGymTorch.helper.raisim_gym_helper import UserCommand
+from raisimGymTorch.stable_baselines3.RaisimSbGymVecEnv import RaisimSbGymVecEnv
+import raisimGymTorch.algo.ppo.module as ppo_module
+import raisimGymTorch.algo.ppo.ppo as PPO
+
+
+def benchmark_in_repo_ppo(cfg, rsc_path, n_steps, iterations):
+    env = RaisimGymVecEnv(command_tracking_flat.RaisimGymEnv(rsc_path, dump(cfg['environment'], Dumper=RoundTripDumper)), cfg['environment'])
+    user_command = UserCommand(cfg, env.num_envs)
+    command_period_steps = math.floor(cfg['environment']['command_period'] / cfg['environment']['control_dt'])
+
+    actor = ppo_module.Actor(ppo_module.MLP([128, 128], nn.LeakyReLU, env.num_obs, env.num_acts),
+                             ppo_module.MultivariateGaussianDiagonalCovariance(env.num_acts, 1.0))
+    critic = ppo_module.Critic(ppo_module.MLP([128, 128], nn.LeakyReLU, env.num_obs, 1))
+    ppo = PPO.PPO(actor=actor, critic=critic, num_envs=env.num_envs, num_transitions_per_env=n_steps,
+                  num_learning_epochs=4, num_mini_batches=4, gamma=0.9988, lam=0.95, shuffle_batch=False, shared_obs=True)
+
+    rollout_time, total_time = 0., 0.
+    for update in range(iterations):
+        start = time.time()
+        env.initialize_n_step()
+        env.reset()
+        for step in range(n_steps):
+            if step % command_period_steps == 0:
+                env.set_user_command(user_command.uniform_sample_train())
+            obs, _ = env.observe()
+            action = ppo.observe(obs)
+            reward, dones = env.step(action)
+            ppo.step(value_obs=obs, rews=reward, dones=dones)
+        rollout_end = time.time()
+        obs, _ = env.observe()
+        ppo.update(actor_obs=obs, value_obs=obs, log_this_iteration=False, update=update)
+        rollout_time += rollout_end - start
+        total_time += time.time() - start
+    env.close()
+    return rollout_time, total_time, env.num_envs
+
+
+def benchmark_sb3_ppo(cfg, rsc_path, n_steps, iterations):
+    from stable_baselines3 import PPO as SB3PPO
+    from stable_baselines3.common.callbacks import BaseCallback
+
+    env = RaisimSbGymVecEnv(command_tracking_flat.RaisimGymEnv(rsc_path, dump(cfg['environment'], Dumper=RoundTripDumper)), cfg['environment'],
+                            user_command=UserCommand(cfg, cfg['environment']['num_envs']))
+
+    class RolloutTimer(BaseCallback):
+        def __init__(self):
+            super(RolloutTimer, self).__init__()
+            self.rollout_time = 0.
+            self.start = None
+
+        def _on_rollout_start(self):
+            self.start = time.time()
+
+        def _on_rollout_end(self):
+            self.rollout_time += time.time() - self.start
+
+        def _on_step(self):
+            return True
+
+    model = SB3PPO('MlpPolicy', env, n_steps=n_steps, batch_size=n_steps * env.num_envs // 4, n_epochs=4, gamma=0.9988, gae_lambda=0.95,
+                   policy_kwargs=dict(net_arch=[dict(pi=[128, 128], vf=[128, 128])], activation_fn=nn.LeakyReLU), device='cpu', verbose=0)
+    timer = RolloutTimer()
+    start = time.time()
+    model.learn(total_timesteps=iterations * n_steps * env.num_envs, callback=timer)
+    total_time = time.time() - start
+    env.close()
+    return timer.rollout_time, total_time, env.num_envs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--num_envs', type=int, default=0, help="overrides num_envs of cfg.yaml")
+    parser.add_argument('--learner', type=str, default='both', choices=['both', 'ppo', 'sb3'])
+    args = parser.parse_args()
+
+    benchmark_path = os.path.dirname(os.path.realpath(__file__))
+    rsc_path = benchmark_path + "/../../rsc"
+    cfg = YAML().load(open(benchmark_path + "/../env/envs/command_tracking_flat/cfg.yaml", 'r'))
+    cfg['environment']['render'] = False
+    if args.num_envs > 0:
+        cfg['environment']['num_envs'] = args.num_envs
+    n_steps = math.floor(cfg['environment']['max_time'] / cfg['environment']['control_dt'])
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    learners = {'ppo': benchmark_in_repo_ppo, 'sb3': benchmark_sb3_ppo}
+    names = list(learners.keys()) if args.learner == 'both' else [args.learner]
+    for name in names:
+        rollout_time, total_time, num_envs = learners[name](cfg, rsc_path, n_steps, args.iterations)
+        env_steps = args.iterations * n_steps * num_envs
+        print('----------------------------------------------------')
+        print('{:<40} {:>10}'.format("learner: ", name))
+        print('{:<40} {:>10}'.format("rollout fps: ", '{:.0f}'.format(env_steps / rollout_time)))
+        print('{:<40} {:>10}'.format("overall fps: ", '{:.0f}'.format(env_steps / total_time)))
+        print('{:<40} {:>10}'.format("time per iteration [s]: ", '{:.3f}'.format(total_time / args.iterations)))
+    print('----------------------------------------------------')
@@ -0,0 +1,14 @@
+import os
+import sys
+import types
+
+# The repository is the raisimGymTorch package (raisimGymTutorial/raisimGymTorch of raisimLib). Without an installed
+# raisimGymTorch the tests import it from this checkout. The compiled environment module (env/bin) is not needed.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import raisimGymTorch
+except ImportError:
+    raisimGymTorch = types.ModuleType('raisimGymTorch')
+    raisimGymTorch.__path__ = [ROOT]
+    sys.modules['raisimGymTorch'] = raisimGymTorch
@@ -0,0 +1,99 @@
+import threading
+import time
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.nn as nn
+from raisimGymTorch.algo.ppo import module as ppo_module
+from raisimGymTorch.helper.policy_server import PolicyServer, PolicyClient, _REQUEST
+
+OB_DIM, ACT_DIM, N_CLIENTS, N_REQUESTS = 6, 3, 8, 5
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    torch.manual_seed(0)
+    actor = ppo_module.MLP([16, 16], nn.LeakyReLU, OB_DIM, ACT_DIM)
+    weight_path = str(tmp_path / "full_10.pt")
+    torch.save({'actor_architecture_state_dict': actor.state_dict()}, weight_path)
+    rng = np.random.default_rng(0)
+    mean, var = rng.normal(size=OB_DIM).astype(np.float32), rng.uniform(0.5, 2., size=OB_DIM).astype(np.float32)
+    np.savetxt(str(tmp_path / "mean10.csv"), mean)
+    np.savetxt(str(tmp_path / "var10.csv"), var)
+    return weight_path, actor, mean, var
+
+
+def direct_action(actor, mean, var, obs):
+    obs = np.clip((obs - mean) / np.sqrt(var + 1e-8), -10., 10.)
+    with torch.no_grad():
+        return actor.architecture(torch.from_numpy(obs.astype(np.float32))).numpy()
+
+
+def wait_for(condition, timeout=2.):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_concurrent_requests_match_direct_forward_pass(tmp_path, checkpoint):
+    weight_path, actor, mean, var = checkpoint
+    socket_path = str(tmp_path / "policy.sock")
+    results, errors = {}, []
+    barrier = threading.Barrier(N_CLIENTS)
+
+    def run_client(client_id):
+        try:
+            rng = np.random.default_rng(client_id + 1)
+            with PolicyClient(socket_path, timeout=10.) as client:
+                assert (client.n_policies, client.ob_dim, client.act_dim) == (1, OB_DIM, ACT_DIM)
+                barrier.wait()
+                for request in range(N_REQUESTS):
+                    obs = rng.normal(size=(1 + client_id % 3, OB_DIM)).astype(np.float32) * 3.
+                    results[client_id, request] = (obs, client.act(obs))
+        except Exception as error:
+            errors.append(error)
+
+    with PolicyServer([weight_path], socket_path, max_batch=64, max_wait=0.05) as server:
+        clients = [threading.Thread(target=run_client, args=(client_id,)) for client_id in range(N_CLIENTS)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        assert errors == []
+
+        for obs, action in results.values():
+            np.testing.assert_allclose(action, direct_action(actor, mean, var, obs), rtol=1e-5, atol=1e-5)
+
+        report = server.latency_percentiles()
+        assert report['requests'] == N_CLIENTS * N_REQUESTS
+        # the clients waiting at the barrier share batches
+        assert 0 < report['batches'] < report['requests']
+        assert report['mean_batch_rows'] > 1.
+        for name in ['queue', 'inference', 'total']:
+            assert report[name][50] > 0.
+        assert report['total'][99] >= report['inference'][50]
+        assert 'requests in' in server.format_report()
+
+        server.reset_stats()
+        assert server.latency_percentiles()['requests'] == 0
+
+        # the connections of the clients that left are closed by the server
+        assert wait_for(lambda: len(server._connections) == 0)
+
+
+def test_client_leaving_with_a_request_in_flight(tmp_path, checkpoint):
+    weight_path, actor, mean, var = checkpoint
+    socket_path = str(tmp_path / "policy.sock")
+    obs = np.linspace(-1., 1., OB_DIM, dtype=np.float32)
+    with PolicyServer([weight_path], socket_path, max_wait=0.05) as server:
+        leaving = PolicyClient(socket_path)
+        leaving.connection.sendall(_REQUEST.pack(0, 1) + obs.tobytes())
+        leaving.close()
+
+        with PolicyClient(socket_path, timeout=10.) as client:
+            np.testing.assert_allclose(client.act(obs), direct_action(actor, mean, var, obs[None])[0], rtol=1e-5, atol=1e-5)
+            with pytest.raises(AssertionError):
+                client.act(obs, policy=1)
+        assert wait_for(lambda: len(server._connections) == 0)
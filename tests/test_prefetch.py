@@ -0,0 +1,63 @@
+import threading
+import time
+import pytest
+
+from raisimGymTorch.helper.prefetch import prefetch
+
+
+def producer_threads(name):
+    return [thread for thread in threading.enumerate() if thread.name == name]
+
+
+@pytest.mark.parametrize('depth', [0, 1, 3])
+def test_prefetch_keeps_order(depth):
+    assert list(prefetch(iter(range(50)), depth)) == list(range(50))
+
+
+def test_prefetch_raises_producer_error_after_its_items():
+    def items():
+        yield 1
+        yield 2
+        raise KeyError("producer failed")
+
+    consumed = []
+    with pytest.raises(KeyError, match="producer failed"):
+        for item in prefetch(items(), 2):
+            consumed.append(item)
+    assert consumed == [1, 2]
+
+
+def test_prefetch_runs_ahead_by_depth_only():
+    produced = []
+
+    def items():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    batches = prefetch(items(), 2, name="test_prefetch_depth")
+    assert next(batches) == 0
+    time.sleep(0.2)
+    # one item consumed, two in the queue and one waiting to be put
+    assert len(produced) <= 4
+    batches.close()
+
+
+def test_closing_early_stops_the_producer():
+    name = "test_prefetch_early_close"
+
+    def items():
+        i = 0
+        while True:
+            yield i
+            i += 1
+
+    batches = prefetch(items(), 2, name=name)
+    for item in batches:
+        if item == 5:
+            break
+    batches.close()
+    deadline = time.time() + 2.
+    while producer_threads(name) and time.time() < deadline:
+        time.sleep(0.01)
+    assert producer_threads(name) == []
@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+from raisimGymTorch.algo.ppo.storage import RolloutStorage
+from raisimGymTorch.helper.rollout_dataset import RolloutExporter, RolloutDataset
+
+NUM_ENVS, N_STEPS, OB_DIM, ACT_DIM = 4, 5, 3, 2
+
+
+def make_storage(seed):
+    rng = np.random.default_rng(seed)
+    storage = RolloutStorage(NUM_ENVS, N_STEPS, [OB_DIM], [OB_DIM], [ACT_DIM], 'cpu', shared_obs=True)
+    for step in range(N_STEPS):
+        obs = rng.normal(size=(NUM_ENVS, OB_DIM)).astype(np.float32)
+        storage.add_transitions(obs, obs, torch.from_numpy(rng.normal(size=(NUM_ENVS, ACT_DIM)).astype(np.float32)),
+                                rng.normal(size=NUM_ENVS).astype(np.float32), rng.random(NUM_ENVS) < 0.2,
+                                torch.zeros(NUM_ENVS, 1), torch.zeros(NUM_ENVS))
+    return storage
+
+
+def export(log_dir, compress):
+    storages = [make_storage(seed) for seed in range(3)]
+    # room for every rollout, none is dropped while the writer catches up
+    exporter = RolloutExporter(log_dir, compress=compress, max_pending=len(storages))
+    for update, storage in enumerate(storages):
+        commands = np.full((N_STEPS, NUM_ENVS, 3), update, dtype=np.float32)
+        exporter.export(storage, update, commands=commands)
+    exporter.close()
+    assert (exporter.n_exported, exporter.n_dropped) == (len(storages), 0)
+    return storages
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_exported_rollouts_round_trip(tmp_path, compress):
+    log_dir = str(tmp_path / "rollouts")
+    storages = export(log_dir, compress)
+    dataset = RolloutDataset(log_dir)
+
+    assert len(dataset) == len(storages) * N_STEPS * NUM_ENVS
+    assert set(dataset.columns) == {'obs', 'actions', 'actions_log_prob', 'rewards', 'dones', 'values', 'commands'}
+    np.testing.assert_array_equal(dataset.load('obs'), np.concatenate([storage.actor_obs.numpy().reshape(-1, OB_DIM)
+                                                                       for storage in storages]))
+    np.testing.assert_array_equal(dataset.load('dones'), np.concatenate([storage.dones.numpy().reshape(-1, 1)
+                                                                         for storage in storages]))
+    assert dataset.column(dataset.chunks[2], 'commands').shape == (N_STEPS * NUM_ENVS, 3)
+    assert (dataset.column(dataset.chunks[2], 'commands') == 2.).all()
+    # compressed chunks are decompressed once into the cache
+    assert os.path.isdir(dataset.cache_dir) == compress
+
+
+def test_mini_batch_generator(tmp_path):
+    log_dir = str(tmp_path / "rollouts")
+    export(log_dir, compress=True)
+    dataset = RolloutDataset(log_dir)
+    obs = dataset.load('obs')
+
+    batches = list(dataset.mini_batch_generator(6, columns=['obs', 'actions'], shuffle=False, drop_last=False))
+    assert all(set(batch) == {'obs', 'actions'} and batch['obs'].dtype == torch.float32 for batch in batches)
+    np.testing.assert_array_equal(torch.cat([batch['obs'] for batch in batches]).numpy(), obs)
+
+    # shuffled batches are drawn chunk by chunk, with the last incomplete batch of a chunk dropped
+    batches = list(dataset.mini_batch_generator(6, columns=['obs'], seed=0))
+    assert len(batches) == len(dataset.chunks) * (N_STEPS * NUM_ENVS // 6)
+    assert all(batch['obs'].shape == (6, OB_DIM) for batch in batches)
+    shuffled = torch.cat([batch['obs'] for batch in batches]).numpy()
+    assert len(np.unique(shuffled, axis=0)) == len(shuffled)
+    assert np.isin(shuffled, obs).all()
+    repeated = torch.cat([batch['obs'] for batch in dataset.mini_batch_generator(6, columns=['obs'], seed=0)]).numpy()
+    np.testing.assert_array_equal(repeated, shuffled)
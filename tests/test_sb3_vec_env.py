@@ -0,0 +1,152 @@
+import tracemalloc
+import numpy as np
+import pytest
+
+pytest.importorskip("gym")
+pytest.importorskip("stable_baselines3.common.vec_env")
+from raisimGymTorch.stable_baselines3.RaisimSbGymVecEnv import RaisimSbGymVecEnv
+
+
+class StandInEnvironment:
+    """
+    The methods of the compiled vectorized environment used by the adapter. Observations are random, the envs flagged in
+    terminate_next terminate at the next step (terminal observation: the observation before the reset).
+    """
+    def __init__(self, num_envs=4, ob_dim=3, act_dim=2, seed=0):
+        self.num_envs, self.ob_dim, self.act_dim = num_envs, ob_dim, act_dim
+        self.rng = np.random.default_rng(seed)
+        self.obs = self.rng.normal(size=(num_envs, ob_dim)).astype(np.float32)
+        self.terminal_obs = np.zeros_like(self.obs)
+        self.terminate_next = np.zeros(num_envs, dtype=bool)
+        self.partial_resets = []
+
+    def getObDim(self): return self.ob_dim
+    def getActionDim(self): return self.act_dim
+    def getNumOfEnvs(self): return self.num_envs
+    def setSeed(self, seed): pass
+    def enableTerminalObservation(self, enable): pass
+    def initialize_n_step(self): pass
+    def reset(self): self.rng.standard_normal(out=self.obs, dtype=np.float32)
+    def close(self): pass
+
+    def step(self, actions, reward, done):
+        np.copyto(self.terminal_obs, self.obs)
+        self.rng.standard_normal(out=self.obs, dtype=np.float32)
+        self.obs += 1.
+        np.sum(actions, axis=1, out=reward)
+        np.copyto(done, self.terminate_next)
+
+    def observe(self, ob):
+        np.copyto(ob, self.obs)
+
+    def getTerminalObservation(self, ob, mask):
+        ob[mask] = self.terminal_obs[mask]
+
+    def partial_reset(self, mask):
+        self.partial_resets.append(mask.copy())
+
+
+def make_env(num_envs=4, ob_dim=3, **kwargs):
+    wrapper = StandInEnvironment(num_envs, ob_dim)
+    return RaisimSbGymVecEnv(wrapper, {'control_dt': 0.01}, **kwargs), wrapper
+
+
+def test_load_scaling_of_runner_checkpoint(tmp_path):
+    env, wrapper = make_env()
+    mean = np.array([1., -2., 0.5], dtype=np.float32)
+    var = np.array([4., 0.25, 1.], dtype=np.float32)
+    # runner.py (RaisimGymVecEnv.save_scaling) writes one identical row per env
+    np.savetxt(str(tmp_path / "mean100.csv"), np.tile(mean, (wrapper.num_envs, 1)))
+    np.savetxt(str(tmp_path / "var100.csv"), np.tile(var, (wrapper.num_envs, 1)))
+
+    env.load_scaling(str(tmp_path), 100)
+    np.testing.assert_allclose(env.obs_rms.mean, mean)
+    np.testing.assert_allclose(env.obs_rms.var, var)
+    obs = env.observe(False)
+    np.testing.assert_allclose(obs, np.clip((wrapper.obs - mean) / np.sqrt(var + 1e-8), -10., 10.), rtol=1e-5, atol=1e-5)
+
+    # and the single row written by the adapter itself loads back unchanged
+    env.save_scaling(str(tmp_path), "200")
+    loaded, _ = make_env()
+    loaded.load_scaling(str(tmp_path), 200)
+    np.testing.assert_allclose(loaded.obs_rms.mean, mean)
+    np.testing.assert_allclose(loaded.obs_rms.var, var)
+
+
+def test_running_mean_std_matches_batch_statistics():
+    rng = np.random.default_rng(1)
+    batches = [rng.normal(2., 3., size=(64, 5)).astype(np.float32) for _ in range(4)]
+    env, _ = make_env()
+    rms = type(env.obs_rms)(epsilon=1e-8, shape=[5])
+    for batch in batches:
+        rms.update(batch)
+    data = np.concatenate(batches).astype(np.float64)
+    np.testing.assert_allclose(rms.mean, data.mean(axis=0), rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(rms.var, data.var(axis=0), rtol=1e-4)
+
+
+def test_terminal_observation_normalized_with_statistics_before_the_step():
+    env, wrapper = make_env(max_episode_steps=3)
+    env.reset()
+    actions = np.zeros((wrapper.num_envs, wrapper.act_dim), dtype=np.float32)
+    wrapper.terminate_next[1] = True
+    mean, var = env.obs_rms.mean.copy(), env.obs_rms.var.copy()
+
+    env.step_async(actions)
+    obs, reward, dones, infos = env.step_wait()
+    np.testing.assert_array_equal(dones, [False, True, False, False])
+    expected = np.clip((wrapper.terminal_obs[1] - mean) / np.sqrt(var + 1e-8), -10., 10.)
+    np.testing.assert_allclose(infos[1]["terminal_observation"], expected, rtol=1e-5, atol=1e-5)
+    assert infos[1]["TimeLimit.truncated"] is False
+    assert infos[0] == {}
+
+    # time limit: the other envs are truncated at step 3, their infos of step 1 are cleared in between
+    wrapper.terminate_next[:] = False
+    env.step_async(actions)
+    assert env.step_wait()[3][1] == {}
+    env.step_async(actions)
+    _, _, dones, infos = env.step_wait()
+    np.testing.assert_array_equal(dones, [True, False, True, True])
+    np.testing.assert_array_equal(wrapper.partial_resets[-1], dones)
+    assert infos[0]["TimeLimit.truncated"] is True
+
+
+def test_step_reuses_its_buffers():
+    env, wrapper = make_env(n_obs_buffers=2)
+    env.reset()
+    actions = np.ones((wrapper.num_envs, wrapper.act_dim), dtype=np.float32)
+    results = []
+    for _ in range(4):
+        env.step_async(actions)
+        results.append(env.step_wait())
+    for first, second in zip(results[:2], results[2:]):
+        for buffer_a, buffer_b in zip(first[:3], second[:3]):
+            assert buffer_a is buffer_b
+        assert first[3] is second[3]
+    assert results[0][0] is not results[1][0]
+    np.testing.assert_array_equal(results[-1][1], actions.sum(axis=1))
+
+
+def test_step_without_episode_ends_does_not_allocate_arrays():
+    env, wrapper = make_env(num_envs=1024, ob_dim=64)
+    env.reset()
+    actions = np.ones((wrapper.num_envs, wrapper.act_dim), dtype=np.float32)
+    env.step_async(actions)
+    env.step_wait()
+
+    tracemalloc.start()
+    for _ in range(10):
+        env.step_async(actions)
+        env.step_wait()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # one observation buffer is 256 kB, broadcasting ufuncs use a fixed iterator scratch of ~32 kB
+    assert peak < 64 * 1024
+
+
+def test_set_attr_rejects_a_subset_of_the_envs():
+    env, _ = make_env()
+    env.set_attr('clip_obs', 5.)
+    assert env.get_attr('clip_obs', indices=[0, 2]) == [5., 5.]
+    with pytest.raises(ValueError):
+        env.set_attr('clip_obs', 1., indices=[0])
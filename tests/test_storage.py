@@ -0,0 +1,114 @@
+import os
+import warnings
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+from raisimGymTorch.algo.ppo.storage import RolloutStorage, MemmapRolloutStorage, OBS_DTYPE_TOLERANCE
+
+NUM_ENVS, N_STEPS, OB_DIM, ACT_DIM = 8, 6, 5, 3
+
+
+def make_rollout(seed=0, obs_scale=1.):
+    rng = np.random.default_rng(seed)
+    return {'obs': np.clip(rng.normal(size=(N_STEPS, NUM_ENVS, OB_DIM)) * obs_scale, -10., 10.).astype(np.float32),
+            'actions': rng.normal(size=(N_STEPS, NUM_ENVS, ACT_DIM)).astype(np.float32),
+            'rewards': rng.normal(size=(N_STEPS, NUM_ENVS)).astype(np.float32),
+            'dones': rng.random((N_STEPS, NUM_ENVS)) < 0.1,
+            'values': rng.normal(size=(N_STEPS, NUM_ENVS)).astype(np.float32),
+            'actions_log_prob': rng.normal(size=(N_STEPS, NUM_ENVS)).astype(np.float32)}
+
+
+def fill(storage, rollout, critic_obs=None):
+    for step in range(N_STEPS):
+        obs = rollout['obs'][step]
+        storage.add_transitions(obs, obs if critic_obs is None else critic_obs[step],
+                                torch.from_numpy(rollout['actions'][step]), rollout['rewards'][step], rollout['dones'][step],
+                                torch.from_numpy(rollout['values'][step]).view(-1, 1),
+                                torch.from_numpy(rollout['actions_log_prob'][step]))
+    storage.compute_returns(torch.zeros(NUM_ENVS, 1), gamma=0.99, lam=0.95)
+
+
+def make_storage(storage_class=RolloutStorage, **kwargs):
+    return storage_class(NUM_ENVS, N_STEPS, [OB_DIM], [OB_DIM], [ACT_DIM], 'cpu', **kwargs)
+
+
+def test_shared_obs_stores_one_tensor():
+    rollout = make_rollout()
+    separate, shared = make_storage(), make_storage(shared_obs=True)
+    fill(separate, rollout)
+    fill(shared, rollout)
+    assert shared.critic_obs is shared.actor_obs
+    for batch_separate, batch_shared in zip(separate.mini_batch_generator_inorder(2), shared.mini_batch_generator_inorder(2)):
+        for tensor_separate, tensor_shared in zip(batch_separate, batch_shared):
+            torch.testing.assert_close(tensor_shared, tensor_separate)
+
+
+def test_shared_obs_rejects_different_critic_obs():
+    rollout = make_rollout()
+    storage = make_storage(shared_obs=True)
+    critic_obs = rollout['obs'].copy()
+    critic_obs[3, 2, 1] += 1.
+    with pytest.raises(ValueError):
+        fill(storage, rollout, critic_obs=critic_obs)
+    # the check runs on every transition, not only the first one of the rollout
+    assert storage.step == 3
+
+
+@pytest.mark.parametrize('obs_dtype', [torch.float16, torch.bfloat16])
+def test_reduced_precision_obs_within_tolerance(obs_dtype):
+    rollout = make_rollout()
+    storage = make_storage(shared_obs=True, obs_dtype=obs_dtype)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        fill(storage, rollout)
+    assert storage.actor_obs.dtype == obs_dtype
+    assert 0. < storage.obs_quantization_error <= OBS_DTYPE_TOLERANCE[obs_dtype]
+
+    actor_obs_batch = next(storage.mini_batch_generator_inorder(1))[0]
+    assert actor_obs_batch.dtype == torch.float32
+    error = (actor_obs_batch - torch.from_numpy(rollout['obs']).view(-1, OB_DIM)).abs().max().item()
+    assert error <= OBS_DTYPE_TOLERANCE[obs_dtype]
+
+
+@pytest.mark.parametrize('obs_dtype', [torch.float16, torch.bfloat16])
+def test_reduced_precision_obs_beyond_tolerance(obs_dtype):
+    # unnormalized observations of large magnitude lose more than the tolerance
+    rollout = make_rollout()
+    rollout['obs'] = rollout['obs'] * 100. + 1000.
+    with pytest.warns(UserWarning, match="observation storage error"):
+        fill(make_storage(obs_dtype=obs_dtype, shared_obs=True), rollout)
+    with pytest.raises(ValueError):
+        fill(make_storage(obs_dtype=obs_dtype, shared_obs=True, strict_obs_dtype=True), rollout)
+
+
+@pytest.mark.parametrize('obs_dtype', [torch.float32, torch.bfloat16])
+def test_memmap_storage_matches_memory_storage(tmp_path, obs_dtype):
+    rollout = make_rollout()
+    memory = make_storage(shared_obs=True, obs_dtype=obs_dtype)
+    memmap = make_storage(MemmapRolloutStorage, shared_obs=True, obs_dtype=obs_dtype, storage_dir=str(tmp_path))
+    fill(memory, rollout)
+    fill(memmap, rollout)
+    for batch_memory, batch_memmap in zip(memory.mini_batch_generator_inorder(3), memmap.mini_batch_generator_inorder(3)):
+        for tensor_memory, tensor_memmap in zip(batch_memory, batch_memmap):
+            torch.testing.assert_close(tensor_memmap, tensor_memory)
+
+    # shuffled batches cover every transition once
+    actions = torch.cat([batch[2] for batch in memmap.mini_batch_generator_shuffle(N_STEPS)])
+    torch.testing.assert_close(actions.sort(0)[0], torch.from_numpy(rollout['actions']).view(-1, ACT_DIM).sort(0)[0])
+
+    storage_dir = memmap.storage_dir
+    memmap.close()
+    assert not os.path.exists(storage_dir)
+
+
+def test_add_rollout_matches_add_transitions():
+    rollout = make_rollout()
+    stepped, whole = make_storage(shared_obs=True), make_storage(shared_obs=True)
+    fill(stepped, rollout)
+    whole.add_rollout(rollout['obs'], rollout['actions'], rollout['rewards'], rollout['dones'], rollout['values'],
+                      rollout['actions_log_prob'])
+    whole.compute_returns(torch.zeros(NUM_ENVS, 1), gamma=0.99, lam=0.95)
+    for batch_stepped, batch_whole in zip(stepped.mini_batch_generator_inorder(2), whole.mini_batch_generator_inorder(2)):
+        for tensor_stepped, tensor_whole in zip(batch_stepped, batch_whole):
+            torch.testing.assert_close(tensor_whole, tensor_stepped)
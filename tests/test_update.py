@@ -0,0 +1,91 @@
+import copy
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.nn as nn
+from raisimGymTorch.algo.ppo import module as ppo_module
+from raisimGymTorch.algo.ppo.update import EagerUpdate, FusedUpdate, make_optimizer, benchmark_update
+
+OB_DIM, ACT_DIM, BATCH_SIZE = 12, 4, 64
+LOSS_KWARGS = {'clip_param': 0.2, 'value_loss_coef': 0.5, 'entropy_coef': 0.01, 'use_clipped_value_loss': True}
+
+
+def make_networks():
+    torch.manual_seed(0)
+    actor = ppo_module.Actor(ppo_module.MLP([32, 32], nn.LeakyReLU, OB_DIM, ACT_DIM),
+                             ppo_module.MultivariateGaussianDiagonalCovariance(ACT_DIM, 1.0))
+    critic = ppo_module.Critic(ppo_module.MLP([32, 32], nn.LeakyReLU, OB_DIM, 1))
+    return actor, critic
+
+
+def make_batches(n_batches=3):
+    generator = torch.Generator().manual_seed(1)
+    batches = []
+    for _ in range(n_batches):
+        obs = torch.randn(BATCH_SIZE, OB_DIM, generator=generator)
+        batches.append((obs, obs, torch.randn(BATCH_SIZE, ACT_DIM, generator=generator),
+                        torch.randn(BATCH_SIZE, 1, generator=generator), torch.randn(BATCH_SIZE, 1, generator=generator),
+                        torch.randn(BATCH_SIZE, 1, generator=generator), torch.randn(BATCH_SIZE, 1, generator=generator) - 5.))
+    return batches
+
+
+def make_update(update_class, actor, critic, **kwargs):
+    actor, critic = copy.deepcopy(actor), copy.deepcopy(critic)
+    optimizer = make_optimizer([*actor.parameters(), *critic.parameters()], 1e-3, fused=update_class is FusedUpdate)
+    return update_class(actor, critic, optimizer, 0.5, **kwargs, **LOSS_KWARGS)
+
+
+def gradient_views_in_place(update):
+    start = update.flat_gradients.data_ptr()
+    end = start + update.flat_gradients.numel() * update.flat_gradients.element_size()
+    return all(parameter.grad is not None and start <= parameter.grad.data_ptr() < end for parameter in update.parameters)
+
+
+@pytest.mark.parametrize('compile_backend', ['eager', 'inductor'])
+def test_fused_update_matches_eager_update(compile_backend):
+    actor, critic = make_networks()
+    eager = make_update(EagerUpdate, actor, critic)
+    fused = make_update(FusedUpdate, actor, critic, compile_backend=compile_backend)
+
+    for batch in make_batches() * 2:
+        eager_result = eager.step(*batch)
+        fused_result = fused.step(*batch)
+        assert eager_result[3] and fused_result[3]
+        for eager_value, fused_value in zip(eager_result[:3], fused_result[:3]):
+            torch.testing.assert_close(fused_value, eager_value, rtol=1e-4, atol=1e-5)
+        for eager_parameter, fused_parameter in zip(eager.parameters, fused.parameters):
+            # clipped gradients of the step and the parameters after it
+            torch.testing.assert_close(fused_parameter.grad, eager_parameter.grad, rtol=1e-4, atol=1e-5)
+            torch.testing.assert_close(fused_parameter.data, eager_parameter.data, rtol=1e-4, atol=1e-5)
+        assert gradient_views_in_place(fused)
+
+
+def test_fused_zero_grad_keeps_gradient_views():
+    actor, critic = make_networks()
+    fused = make_update(FusedUpdate, actor, critic, compile_backend='eager')
+    batch = make_batches(1)[0]
+    fused.step(*batch)
+    assert fused.flat_gradients.abs().sum() > 0.
+
+    # the optimizer's own zero_grad (set_to_none=True by default) would detach .grad from the buffer
+    fused.optimizer.zero_grad()
+    fused.optimizer.zero_grad(set_to_none=True)
+    assert gradient_views_in_place(fused)
+    assert fused.flat_gradients.abs().sum() == 0.
+    fused.step(*batch)
+    assert fused.flat_gradients.abs().sum() > 0.
+
+
+def test_fused_step_detects_detached_gradients():
+    actor, critic = make_networks()
+    fused = make_update(FusedUpdate, actor, critic, compile_backend='eager')
+    fused.parameters[0].grad = None
+    with pytest.raises(AssertionError):
+        fused.step(*make_batches(1)[0])
+
+
+def test_benchmark_update_reports_parity():
+    actor, critic = make_networks()
+    result = benchmark_update(actor, critic, make_batches(2), n_repeats=1, compile_backend='eager', **LOSS_KWARGS)
+    assert result['parity']
+    assert result['eager_time'] > 0. and result['fused_time'] > 0.